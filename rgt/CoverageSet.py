@@ -11,6 +11,8 @@ from __future__ import division
 
 # Python
 from functools import reduce
+import atexit
+import json
 import os
 import sys
 
@@ -19,6 +21,344 @@ import pysam
 import numpy as np
 import pyBigWig
 
+# bigWig handles opened by the bulk reader, kept open for the whole run
+_bigwig_pool = {}
+
+
+def get_bigwig(bigwig_file):
+    """Return an open pyBigWig handle for <bigwig_file>.
+
+    Handles are kept in a pool and reused by all later calls, so that a bigWig file is opened only once per run.
+    """
+    bwf = _bigwig_pool.get(bigwig_file)
+    if bwf is None:
+        bwf = pyBigWig.open(bigwig_file)
+        _bigwig_pool[bigwig_file] = bwf
+    return bwf
+
+
+def close_bigwig_pool():
+    """Close all bigWig handles of the pool."""
+    for bwf in _bigwig_pool.values():
+        bwf.close()
+    _bigwig_pool.clear()
+
+
+atexit.register(close_bigwig_pool)
+
+# library sizes by BAM file, see get_library_size
+_library_sizes = {}
+
+
+def _read_library_size(bam_file, stamp):
+    """Return the library sizes stored in the sidecar file of <bam_file>, if they belong to the BAM file <stamp>."""
+    try:
+        with open(bam_file + ".libsize") as f:
+            sizes = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    return sizes if sizes.get("stamp") == stamp else None
+
+
+def _write_library_size(bam_file, sizes):
+    """Store the library sizes in the sidecar file of <bam_file>, silently skip read-only locations."""
+    try:
+        with open(bam_file + ".libsize", "w") as f:
+            json.dump(sizes, f)
+    except (IOError, OSError):
+        pass
+
+
+def get_library_size(bam_file, unique=False):
+    """Return the library sizes of the indexed <bam_file> as dictionary with the keys
+
+    - mapped -- number of mapped reads
+    - unmapped -- number of unmapped reads
+    - chroms -- number of mapped reads by chromosome
+    - unique -- number of unique reads (distinct start, strand and mate position), None if not computed yet
+
+    The numbers are computed once per BAM file and stored next to it in <bam_file>.libsize, later calls return them
+    without reading the BAM file. The unique reads require a full pass over the BAM file and are only computed if
+    <unique> is set.
+    """
+    st = os.stat(bam_file)
+    stamp = [st.st_size, int(st.st_mtime)]
+    sizes = _library_sizes.get(bam_file)
+    if sizes is None or sizes["stamp"] != stamp:
+        sizes = _read_library_size(bam_file, stamp)
+
+    changed = False
+    if sizes is None:
+        bam = pysam.Samfile(bam_file, "rb")
+        stats = bam.get_index_statistics()
+        sizes = {"stamp": stamp,
+                 "mapped": sum(s.mapped for s in stats),
+                 "unmapped": sum(s.unmapped for s in stats) + bam.nocoordinate,
+                 "chroms": dict((s.contig, s.mapped) for s in stats),
+                 "unique": None}
+        bam.close()
+        changed = True
+
+    if unique and sizes["unique"] is None:
+        bam = pysam.Samfile(bam_file, "rb")
+        sizes["unique"] = 0
+        for chrom in bam.references:
+            origins, reverse, mates = [], [], []
+            for r in bam.fetch(chrom):
+                if r.is_unmapped:
+                    continue
+                origins.append(r.pos)
+                reverse.append(r.is_reverse)
+                mates.append(r.next_reference_start if r.is_paired and not r.mate_is_unmapped else -1)
+            sizes["unique"] += _duplicate_filter(_duplicate_keys(origins, reverse, mates))[1]
+        bam.close()
+        changed = True
+
+    if changed:
+        _write_library_size(bam_file, sizes)
+    _library_sizes[bam_file] = sizes
+    return sizes
+
+
+def _bin_mean(values, bins):
+    """Return the mean of the non-NaN <values> in <bins> consecutive bins (0 for bins without data).
+
+    The bin borders are the same as the ones of pyBigWig's stats() with nBins=<bins>.
+    """
+    if bins <= 0:
+        return np.zeros(0)
+    if len(values) == 0:
+        return np.zeros(bins)
+
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0)
+    if len(values) % bins == 0:
+        sums = values.reshape(bins, -1).sum(axis=1)
+        counts = valid.reshape(bins, -1).sum(axis=1)
+    else:
+        borders = (len(values) * np.arange(bins)) // bins
+        sums = np.add.reduceat(values, borders)
+        counts = np.add.reduceat(valid.astype(int), borders)
+
+    return np.where(counts > 0, sums / np.maximum(counts, 1), 0)
+
+
+def _duplicate_keys(positions, reverse, mates):
+    """Return int64 keys packing the read <positions>, the strand and the mate positions (-1 for none)."""
+    return (np.asarray(positions, dtype=np.int64) << 32) | (np.asarray(reverse, dtype=np.int64) << 31) | \
+        (np.asarray(mates, dtype=np.int64) + 1)
+
+
+def _duplicate_filter(keys, maxdup=None):
+    """Return a boolean mask keeping the first <maxdup> reads of each key (all reads if <maxdup> is None) and the
+    number of distinct keys."""
+    if len(keys) == 0:
+        return np.ones(0, dtype=bool), 0
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    first = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+    if maxdup is None:
+        return np.ones(len(keys), dtype=bool), len(first)
+
+    rank = np.arange(len(keys)) - np.repeat(first, np.diff(np.append(first, len(keys))))
+    keep = np.empty(len(keys), dtype=bool)
+    keep[order] = rank < maxdup
+    return keep, len(first)
+
+
+def _unique_reads_key(bam_file, **filters):
+    """Return the key of CoverageSet.unique_reads: <bam_file>, followed by the active read <filters> if any."""
+    active = tuple(sorted((k, v) for k, v in filters.items() if v))
+    return (bam_file,) + active if active else bam_file
+
+
+def _count_overlaps(starts, ends, bin_start, bin_end):
+    """Return for each interval [<bin_start>, <bin_end>) the number of reads [<starts>, <ends>) overlapping it."""
+    return np.searchsorted(np.sort(starts), bin_end) - np.searchsorted(np.sort(ends), bin_start, side='right')
+
+
+def _count_windows(starts, lasts, win_e, win_s, side='left', weights=None):
+    """Return for each window the number of intervals [<starts>, <lasts>] that start before <win_e> and do not end
+    before <win_s> (side='left') resp. end after <win_s> (side='right'). If <weights> are given (one row per interval),
+    return the sum of their weights instead."""
+    if weights is None:
+        return np.searchsorted(np.sort(starts), win_e) - np.searchsorted(np.sort(lasts), win_s, side=side)
+
+    s_order = np.argsort(starts, kind='mergesort')
+    l_order = np.argsort(lasts, kind='mergesort')
+    zero = np.zeros((1,) + weights.shape[1:], dtype=weights.dtype)
+    s_sum = np.concatenate((zero, np.cumsum(weights[s_order], axis=0)))
+    l_sum = np.concatenate((zero, np.cumsum(weights[l_order], axis=0)))
+    return s_sum[np.searchsorted(starts[s_order], win_e)] - \
+        l_sum[np.searchsorted(lasts[l_order], win_s, side=side)]
+
+
+def _window_bounds(i, initial, binsize, stepsize, fragments):
+    """Return start and end of the windows <i> (numpy array) of a region starting at <initial>, see coverage_from_bam.
+    Window i covers [win_s, win_e); without <fragments>, win_s is the start of the previous window (-inf for the
+    first window)."""
+    win = np.asarray(i) * stepsize
+    win_e = win + binsize * 0.5 + initial
+    if fragments:
+        win_s = np.maximum(0, win - binsize * 0.5) + initial
+    else:
+        win_s = np.where(win > 0, np.maximum(0, win - stepsize - binsize * 0.5) + initial, -np.inf)
+    return win_s, win_e
+
+
+def read_bigwig_bins(bigwig_file, regions, bins, max_span=10000000):
+    """Return the binned mean signal of a bigWig file for each region.
+
+    Regions are grouped by chromosome and neighbouring regions are merged to spans of at most <max_span> bp.
+    Each span is fetched once as a numpy array and sliced afterwards.
+
+    *Keyword arguments:*
+
+        - bigwig_file -- path to bigwig file, or a function that returns the path for a given chromosome
+        - regions -- list of GenomicRegions
+        - bins -- number of bins for each region
+        - max_span -- maximal length of a span that is fetched at once
+
+    *Output:*
+
+    List of numpy arrays in the order of <regions>. Regions on chromosomes that are not contained in the bigWig
+    file have zero signal.
+    """
+    result = [None] * len(regions)
+    by_chrom = {}
+    for i, region in enumerate(regions):
+        by_chrom.setdefault(region.chrom, []).append(i)
+
+    for chrom, indices in by_chrom.items():
+        path = bigwig_file(chrom) if callable(bigwig_file) else bigwig_file
+        try:
+            bwf = get_bigwig(path)
+            chrom_len = bwf.chroms(chrom)
+        except RuntimeError:
+            chrom_len = None
+        if not chrom_len:
+            for i in indices:
+                result[i] = np.zeros(max(bins[i], 0))
+            continue
+
+        indices.sort(key=lambda x: regions[x].initial)
+        spans = []
+        for i in indices:
+            r = regions[i]
+            if spans and r.initial <= spans[-1][1] and max(spans[-1][1], r.final) - spans[-1][0] <= max_span:
+                spans[-1][1] = max(spans[-1][1], r.final)
+                spans[-1][2].append(i)
+            else:
+                spans.append([r.initial, r.final, [i]])
+
+        for start, end, members in spans:
+            values = np.empty(end - start)
+            values.fill(np.nan)
+            if start < chrom_len:
+                values[:min(end, chrom_len) - start] = bwf.values(chrom, start, min(end, chrom_len), numpy=True)
+            for i in members:
+                r = regions[i]
+                result[i] = _bin_mean(values[r.initial - start:r.final - start], bins[i])
+
+    return result
+
+
+class BigWigWriter:
+    """Write binned signals to a bigWig file without intermediate files or external binaries.
+
+    The header is given by the chromosome size file <chrom_sizes> (tab-separated: chrom, size). Signals have to be
+    added chromosome by chromosome in the order of that file, within a chromosome with increasing positions.
+
+    *Keyword arguments:*
+
+        - filename -- path of the bigWig file
+        - chrom_sizes -- chromosome size file
+    """
+
+    def __init__(self, filename, chrom_sizes):
+        self.chrom_sizes = []
+        with open(chrom_sizes) as f:
+            for line in f:
+                line = line.strip().split('\t')
+                if len(line) > 1:
+                    self.chrom_sizes.append((line[0], int(line[1])))
+        self.chrom_index = dict((c, i) for i, (c, _) in enumerate(self.chrom_sizes))
+
+        self.bw = pyBigWig.open(filename, "w")
+        self.bw.addHeader(self.chrom_sizes)
+        self.last = (-1, 0)  # (chromosome index, end) of the last written entry
+
+    def add(self, chrom, start, values, stepsize, span=None):
+        """Add a fixed-step signal. Bin i of <values> covers position <start> + i * <stepsize>. Zero bins, bins
+        beyond the chromosome's end and bins overlapping already written entries are skipped.
+
+        *Keyword arguments:*
+
+            - chrom -- chromosome
+            - start -- start of the first bin
+            - values -- numpy array with the value of each bin
+            - stepsize -- distance between two bins
+            - span -- length of a bin, default is <stepsize>
+        """
+        if chrom not in self.chrom_index or len(values) == 0:
+            return
+        c = self.chrom_index[chrom]
+        if c < self.last[0]:
+            raise ValueError("bigWig entries for %s have to be added in the order of the chromosome size file" % chrom)
+        min_start = self.last[1] if c == self.last[0] else 0
+        chrom_len = self.chrom_sizes[c][1]
+
+        values = np.asarray(values, dtype=np.float64).ravel()
+        starts = int(start) + int(stepsize) * np.arange(len(values), dtype=np.int64)
+        keep = (values != 0) & (starts >= min_start) & (starts < chrom_len)
+        if not keep.any():
+            return
+        starts = starts[keep]
+        ends = np.minimum(starts + int(span or stepsize), chrom_len)
+        self.bw.addEntries([chrom] * len(starts), starts, ends=ends, values=values[keep])
+        self.last = (c, int(ends[-1]))
+
+    def add_runs(self, chrom, start, ends, values, stepsize):
+        """Add a run-length encoded signal. Run i covers the bins [<ends>[i-1], <ends>[i]) and has value
+        <values>[i]; bin j starts at <start> + j * <stepsize>. Zero runs are skipped."""
+        if chrom not in self.chrom_index or len(ends) == 0:
+            return
+        c = self.chrom_index[chrom]
+        if c < self.last[0]:
+            raise ValueError("bigWig entries for %s have to be added in the order of the chromosome size file" % chrom)
+        min_start = self.last[1] if c == self.last[0] else 0
+        chrom_len = self.chrom_sizes[c][1]
+
+        ends = np.asarray(ends, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        starts = int(start) + int(stepsize) * np.concatenate(([0], ends[:-1]))
+        stops = np.minimum(int(start) + int(stepsize) * ends, chrom_len)
+        starts = np.maximum(starts, min_start)
+        keep = (values != 0) & (starts < stops)
+        if not keep.any():
+            return
+        self.bw.addEntries([chrom] * int(keep.sum()), starts[keep], ends=stops[keep], values=values[keep])
+        self.last = (c, int(stops[keep][-1]))
+
+    def add_coverage(self, cov_set):
+        """Add the signal of CoverageSet <cov_set>, where each GenomicRegion has a coverage array (numpy array or
+        RunLengthArray)."""
+        offset = (cov_set.binsize - cov_set.stepsize) // 2
+        order = [i for i, r in enumerate(cov_set.genomicRegions) if r.chrom in self.chrom_index]
+        order.sort(key=lambda i: (self.chrom_index[cov_set.genomicRegions[i].chrom],
+                                  cov_set.genomicRegions[i].initial))
+        for i in order:
+            region = cov_set.genomicRegions[i]
+            cov = cov_set.coverage[i]
+            if hasattr(cov, 'ends'):
+                self.add_runs(region.chrom, region.initial + offset, cov.ends, cov.values, cov_set.stepsize)
+            else:
+                self.add(region.chrom, region.initial + offset, cov, cov_set.stepsize)
+
+    def close(self):
+        """Write the bigWig index and close the file."""
+        self.bw.close()
+
 
 class CoverageSet:
     """*Keyword arguments:*
@@ -35,6 +375,7 @@ class CoverageSet:
         self.binsize = 100
         self.mapped_reads = None  # number of mapped read
         self.reads = None  # number of reads
+        self.unique_reads = {}  # number of unique reads by BAM file and read filters, by-product of coverage_from_bam
         self.stepsize = 50
 
     def subtract(self, cs):
@@ -48,20 +389,10 @@ class CoverageSet:
             negative values are set to 0.
         """
 
-        cs_chroms = cs.genomicRegions.get_chrom()
-        assert len(cs_chroms) == len(set(cs_chroms))  # no double entries
-        assert len(self.genomicRegions.get_chrom()) == len(set(self.genomicRegions.get_chrom()))
-
-        i = 0
-        for c in self.genomicRegions.get_chrom():  # c corresponds to self.coverage[i]
-            try:
-                j = cs_chroms.index(c)
-                assert len(self.coverage[i]) == len(cs.coverage[j])
-                self.coverage[i] -= cs.coverage[j]
-                self.coverage[i] = self.coverage[i].clip(0, max(max(self.coverage[i]), 0))  # neg. values to 0
-            except ValueError:
-                pass
-            i += 1
+        for i, j in self._coverage_index(cs):
+            assert len(self.coverage[i]) == len(cs.coverage[j])
+            self.coverage[i] -= cs.coverage[j]
+            self.coverage[i] = np.maximum(self.coverage[i], 0)  # neg. values to 0
 
     def add(self, cs):
         """Add CoverageSet <cs>.
@@ -71,19 +402,18 @@ class CoverageSet:
         - cs -- instance of CoverageSet, which is used to add up
         
         """
+        for i, j in self._coverage_index(cs):
+            assert len(self.coverage[i]) == len(cs.coverage[j])
+            self.coverage[i] += cs.coverage[j]
+
+    def _coverage_index(self, cs):
+        """Return pairs (i, j) such that self.coverage[i] and cs.coverage[j] describe the same chromosome."""
         cs_chroms = cs.genomicRegions.get_chrom()
         assert len(cs_chroms) == len(set(cs_chroms))  # no double entries
         assert len(self.genomicRegions.get_chrom()) == len(set(self.genomicRegions.get_chrom()))
 
-        i = 0
-        for c in self.genomicRegions.get_chrom():  # c corresponds to self.coverage[i]
-            try:
-                j = cs_chroms.index(c)
-                assert len(self.coverage[i]) == len(cs.coverage[j])
-                self.coverage[i] += cs.coverage[j]
-            except ValueError:
-                pass
-            i += 1
+        cs_index = dict((c, j) for j, c in enumerate(cs_chroms))
+        return [(i, cs_index[c]) for i, c in enumerate(self.genomicRegions.get_chrom()) if c in cs_index]
 
     def scale(self, factor):
         """Scale coverage with <factor>.
@@ -177,33 +507,18 @@ class CoverageSet:
         
         """
 
-        tmp_path = filename + '.wig'
-        self.write_wig(tmp_path)
-        t = ['wigToBigWig', "-clip", tmp_path, chrom_file, filename]
-        c = " ".join(t)
-        os.system(c)
+        writer = BigWigWriter(filename, chrom_file)
+        writer.add_coverage(self)
+        writer.close()
 
-        if not save_wig:
-            os.remove(tmp_path)
+        if save_wig:
+            self.write_wig(filename + '.wig')
 
     def _init_read_number(self, bamFile):
         """Compute number of reads and number of mapped reads for CoverageSet"""
-        # XXX ToDo add number of mapped reads in all cases
-        # try:
-        from distutils.version import LooseVersion
-        if LooseVersion("0.9.0") <= LooseVersion(pysam.__version__):
-            a = pysam.idxstats(bamFile)
-            mapped_reads = sum([int(el.split('\t')[2]) for el in a.split('\n')[:len(a.split('\n')) - 1]])
-            unmapped_read = sum([int(el.split('\t')[3]) for el in a.split('\n')[:len(a.split('\n')) - 1]])
-            self.reads = mapped_reads + unmapped_read
-            self.mapped_reads = mapped_reads
-        else:
-            self.reads = reduce(lambda x, y: x + y,
-                                [eval('+'.join(l.rstrip('\n').split('\t')[2:])) for l in pysam.idxstats(bamFile)])
-            self.mapped_reads = None
-        # except:
-        #     self.reads = None
-        #     self.mapped_reads = None
+        sizes = get_library_size(bamFile)
+        self.reads = sizes["mapped"] + sizes["unmapped"]
+        self.mapped_reads = sizes["mapped"]
 
     def coverage_from_genomicset(self, input_file, readSize=200, strand_specific=False):
 
@@ -228,43 +543,47 @@ class CoverageSet:
         if input_file.endswith(".bam"):
             bam = pysam.Samfile(input_file, "rb")
             self._init_read_number(input_file)
+            cov = np.zeros(len(self.genomicRegions), dtype=np.int64)
 
+            regions_by_chrom = {}
             for i, region in enumerate(self.genomicRegions):
+                regions_by_chrom.setdefault(region.chrom, []).append(i)
 
+            for chrom, index in regions_by_chrom.items():
+                regions = [self.genomicRegions.sequences[i] for i in index]
+                index = np.array(index)
+                bin_start = np.array([max(0, r.initial - readSize) for r in regions], dtype=np.int64)
+                bin_end = np.array([r.final + readSize for r in regions], dtype=np.int64)
                 try:
-                    bin_start = max(0, region.initial - readSize)
-                    bin_end = region.final + readSize
-
-                    if not strand_specific:
-                        for r in bam.fetch(region.chrom, bin_start, bin_end):
-                            cov[i] += 1
-                    else:
-                        for r in bam.fetch(region.chrom, bin_start, bin_end):
-                            # print(region.orientation)
-                            # print(r.is_reverse)
-                            if region.orientation == "+" and not r.is_reverse:
-                                cov[i] += 1
-                            elif region.orientation == "-" and r.is_reverse:
-                                cov[i] += 1
-
-                except:
-                    print("\tSkip: " + region.toString())
+                    starts, ends, reverse = [], [], []
+                    # one pass over the reads of the chromosome instead of one fetch per region
+                    for r in bam.fetch(chrom, int(bin_start.min()), int(bin_end.max())):
+                        starts.append(r.pos)
+                        ends.append(r.aend if r.aend is not None else r.pos + 1)
+                        reverse.append(r.is_reverse)
+                except ValueError:
+                    for r in regions:
+                        print("\tSkip: " + r.toString())
+                    continue
+
+                starts, ends, reverse = np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64), \
+                    np.array(reverse, dtype=bool)
+                if not strand_specific:
+                    cov[index] = _count_overlaps(starts, ends, bin_start, bin_end)
+                else:
+                    orientation = np.array([r.orientation for r in regions])
+                    for o, reads in [("+", ~reverse), ("-", reverse)]:
+                        mask = orientation == o
+                        cov[index[mask]] = _count_overlaps(starts[reads], ends[reads], bin_start[mask], bin_end[mask])
+            cov = cov.tolist()
 
         elif input_file.lower().endswith(".bigwig") or input_file.lower().endswith(".bw"):
 
             self.coverage = []
 
-            bwf = pyBigWig.open(input_file)
-            for i, region in enumerate(self.genomicRegions):
-                # bin_start = max(0, region.initial - readSize)
-                # bin_end = region.final + readSize
-                # steps = int(len(region) / 10)
-                c = bwf.stats(region.chrom, region.initial, region.final, type="mean", nBins=1)
-                # print(c)
-                if c[0] is None:
-                    c = [0]
-                cov[i] = c[0]
-            bwf.close()
+            regions = self.genomicRegions.sequences
+            means = read_bigwig_bins(input_file, regions, [1] * len(regions))
+            cov = [float(c[0]) for c in means]
         self.coverage = cov
         self.coverageOrig = cov
 
@@ -278,7 +597,8 @@ class CoverageSet:
 
     def coverage_from_bam(self, bam_file, extension_size=200, binsize=100, stepsize=50, rmdup=False,
                           maxdup=None, mask_file=None, paired_reads=False,
-                          get_strand_info=False, get_sense_info=False, no_gaps=False):
+                          get_strand_info=False, get_sense_info=False, no_gaps=False,
+                          fragments=False, min_fragment_size=None, max_fragment_size=None):
         """Compute coverage based on GenomicRegionSet. 
         
         Iterate over each GenomicRegion in class variable genomicRegions (GenomicRegionSet). The GenomicRegion is divided into consecutive bins with lenth <binsize>.
@@ -290,17 +610,24 @@ class CoverageSet:
         - extension_size -- used read size
         - binsize -- size of bins
         - stepsize -- stepsize for the window-based approach to generat the signal
-        - rmdup -- remove dupliacted reads (reads with same starting coordinate)
+        - rmdup -- remove dupliacted reads (reads with same starting coordinate, strand and mate position)
         - maxdup -- define the maximum count for the dupliacted reads (0: remove all;-1:no limit)
         - mask_file -- ignore region described in <mask_file> (tab-separated: chrom, start, end)
         - get_strand_info -- compute strand information for each bin
         - get_sense_info -- compute strand information for each bin when the region and the read are at the same strand
+        - fragments -- paired-end mode: count each properly paired fragment once, from its leftmost mate to the end
+          given by the template length, instead of extending every read by <extension_size>
+        - min_fragment_size -- in fragment mode, ignore fragments shorter than <min_fragment_size>
+        - max_fragment_size -- in fragment mode, ignore fragments longer than <max_fragment_size>
         
         
         *Output:*
         
         - Class variable <coverage>: a list of lists: the elements correspond a GenomicRegion. This list gives the coverage of each bin.
         - Class variable <overall_cov>: a list: concatenation of class variable <coverage>.
+        - Class variable <unique_reads>: the number of reads starting in the regions without duplicates (reads with
+          the same start, strand and mate position) is stored for <bam_file>. If reads are filtered by <mask_file>,
+          <no_gaps> or <fragments>, the key also contains these filters.
         - If option <get_strand_info> is set, a numpy array class variable  <cov_strand_all> of tuples. The tuples give the number of forward and backward reads for each bin.
         
         *Example:*
@@ -371,142 +698,151 @@ class CoverageSet:
                 get_sense_info = False
                 self.cov_strand_all = []
 
-        for region in self.genomicRegions:
-            cov = [0] * (len(region) // stepsize)
+        if rmdup or maxdup == 0:
+            maxdup = 1
+        elif maxdup is not None and maxdup < 0:
+            maxdup = None
+        unique_reads = 0
 
-            if get_strand_info or get_sense_info:
-                cov_strand = [[0, 0]] * (len(region) // stepsize)
-                strand_info = {}
+        # in fragment mode, the leftmost mate of a fragment overlapping the region may lie further upstream
+        padding = max(fragment_size, max_fragment_size or 1000) if fragments else fragment_size
 
-            positions = []
-            j = 0
+        for region in self.genomicRegions:
+            starts, lasts, reverse, eligible, origins, mates = [], [], [], [], [], []
             read_length = -1
             try:
-                for read in bam.fetch(region.chrom, max(0, region.initial - fragment_size),
-                                      region.final + fragment_size):
-                    if len(read.get_blocks()) > 1 and no_gaps: continue  # ignore sliced reads
-                    j += 1
+                for read in bam.fetch(region.chrom, max(0, region.initial - padding), region.final + padding):
+                    if no_gaps and len(read.get_blocks()) > 1: continue  # ignore sliced reads
                     read_length = read.rlen
-                    if not read.is_unmapped:
-                        # pos = read.pos - extension_size if read.is_reverse else read.pos
-                        # pos_help = read.pos - read.qlen if read.is_reverse else read.pos
+                    if read.is_unmapped:
+                        continue
+                    if fragments:
+                        # count each fragment once at its leftmost mate
+                        tlen = read.template_length
+                        if not read.is_proper_pair or read.is_secondary or read.is_supplementary or tlen <= 0:
+                            continue
+                        if (min_fragment_size is not None and tlen < min_fragment_size) or \
+                                (max_fragment_size is not None and tlen > max_fragment_size):
+                            continue
+                        pos = pos_help = read.pos
+                        is_reverse = read.is_reverse if read.is_read1 else read.mate_is_reverse
+                    else:
                         pos = read.pos - extension_size if read.is_reverse else read.pos
                         pos_help = read.pos - read.qlen if read.is_reverse else read.pos
-
-                        within_gap = False
-                        if no_gaps:
-                            blocks = read.get_blocks()
-                            if len(blocks) > 1:
-                                # print(read.is_reverse)
-                                # print(read.pos)
-                                # print(blocks)
-                                for b_ind in range(len(blocks) - 1):
-                                    # print([blocks[b_ind][1], read.pos, blocks[b_ind+1][0]])
-                                    if blocks[b_ind][1] <= read.pos < blocks[b_ind + 1][0]:
-                                        within_gap = True
-
-                        # if position in mask region, then ignore
-                        if mask:
-                            while next_it and c_help not in chrom_regions:  # do not consider this deadzone
-                                c_help, s_help, e_help, next_it = self._get_bedinfo(f.readline())
-                            # deadzones behind, go further
-                            if c_help != -1 and chrom_regions.index(region.chrom) >= chrom_regions.index(c_help):
-                                while next_it and c_help != region.chrom:  # get right chromosome
-                                    c_help, s_help, e_help, next_it = self._get_bedinfo(f.readline())
-                            while next_it and e_help <= pos_help and c_help == region.chrom:  # check right position
+                        is_reverse = read.is_reverse
+
+                    # if position in mask region, then ignore
+                    if mask:
+                        while next_it and c_help not in chrom_regions:  # do not consider this deadzone
+                            c_help, s_help, e_help, next_it = self._get_bedinfo(f.readline())
+                        # deadzones behind, go further
+                        if c_help != -1 and chrom_regions.index(region.chrom) >= chrom_regions.index(c_help):
+                            while next_it and c_help != region.chrom:  # get right chromosome
                                 c_help, s_help, e_help, next_it = self._get_bedinfo(f.readline())
-                            if next_it and s_help <= pos_help and c_help == region.chrom:
-                                continue  # pos in mask region
-                        if within_gap:
-                            continue
-                        else:
-                            positions.append(pos)
-
-                        if get_strand_info:
-                            if pos not in strand_info:
-                                strand_info[pos] = (1, 0) if not read.is_reverse else (0, 1)
-                        if get_sense_info:
-                            if pos not in strand_info:
-                                if paired_reads and not read.is_read1:
-                                    continue
-                                else:
-                                    if region.orientation == "+":
-                                        strand_info[pos] = (1, 0) if read.is_reverse else (0, 1)
-                                    elif region.orientation == "-":
-                                        strand_info[pos] = (1, 0) if not read.is_reverse else (0, 1)
+                        while next_it and e_help <= pos_help and c_help == region.chrom:  # check right position
+                            c_help, s_help, e_help, next_it = self._get_bedinfo(f.readline())
+                        if next_it and s_help <= pos_help and c_help == region.chrom:
+                            continue  # pos in mask region
+
+                    starts.append(pos)
+                    reverse.append(is_reverse)
+                    origins.append(read.pos)
+                    mates.append(read.next_reference_start if read.is_paired and not read.mate_is_unmapped else -1)
+                    if fragments:
+                        lasts.append(pos + tlen)
+                    if get_sense_info:
+                        eligible.append(fragments or not paired_reads or read.is_read1)
             except ValueError as e:
                 print("warning: {}".format(e))
                 pass
 
-            # if maxdup == -1: # No limit
-            # elif maxdup == 0: # Remove all duplicates
-            # else: # 
-
-            if rmdup:
-                positions = list(set(positions))
+            starts = np.array(starts, dtype=np.int64)
+            reverse = np.array(reverse, dtype=bool)
+            if fragments:
+                lasts = np.array(lasts, dtype=np.int64)
+            else:
+                lasts = starts + (extension_size + read_length)
 
-            positions.sort()
-            positions.reverse()
-            i = 0
-            while positions:
-                win_s = max(0, i * stepsize - binsize * 0.5) + region.initial
-                win_e = i * stepsize + binsize * 0.5 + region.initial
-                c = 0
+            if get_strand_info or get_sense_info:
+                strand_info = self._get_strand_info(starts, reverse, np.array(eligible, dtype=bool),
+                                                    None if get_strand_info else region.orientation)
+
+            origins = np.array(origins, dtype=np.int64)
+            keys = _duplicate_keys(origins, reverse, mates)
+            in_region = (origins >= region.initial) & (origins < region.final)
+            unique_reads += _duplicate_filter(keys[in_region])[1]
+            if maxdup is not None:
+                keep = _duplicate_filter(keys, maxdup)[0]
+                starts, lasts = starts[keep], lasts[keep]
                 if get_strand_info or get_sense_info:
-                    sum_strand_info = [0, 0]
-                # if get_sense_info:
-                #     sum_sense_info = [0,0]
-
-                taken = []
-                while True:
-                    s = positions.pop()
-
-                    taken.append(s)
-                    if s < win_e:  # read within window
-                        c += 1
-                        if get_strand_info or get_sense_info:
-                            sum_strand_info[0] += strand_info[s][0]
-                            sum_strand_info[1] += strand_info[s][1]
-                        # if get_sense_info:
-                        #     try:
-                        #         sum_sense_info[0] += sense_info[s][0]
-                        #         sum_sense_info[1] += sense_info[s][1]
-                        #     except:
-                        #         pass
-                    if s >= win_e or not positions:
-                        taken.reverse()
-                        for s in taken:
-                            if s + extension_size + read_length >= win_s:  # consider read in next iteration
-                                positions.append(s)
-                            else:
-                                break  # as taken decreases monotonously
-                        taken = []
-                        break
-                if i < len(cov):
-                    cov[i] = c
-                    if get_strand_info or get_sense_info:
-                        cov_strand[i] = sum_strand_info
-                    # if get_sense_info:
-                    #     cov_sense[i] = sum_sense_info
-                i += 1
+                    strand_info = strand_info[keep]
+
+            n_windows = len(region) // stepsize
+            cov = self._get_region_coverage(starts, lasts, region.initial, n_windows, binsize, stepsize, fragments)
+            if get_strand_info or get_sense_info:
+                win_s, win_e = _window_bounds(np.arange(n_windows), region.initial, binsize, stepsize, fragments)
+                cov_strand = _count_windows(starts, lasts, win_e, win_s, 'right' if fragments else 'left',
+                                            weights=strand_info)
 
             if not log_aver:
-                self.coverage.append(np.array(cov))
+                self._add_region_coverage(cov)
             else:
-                cov = [x + 1 for x in cov]
-                self.coverage.append(np.log(np.array(cov)))
+                self._add_region_coverage(np.log(cov + 1))
 
             if get_strand_info or get_sense_info:
-                self.cov_strand_all.append(np.array(cov_strand))
+                self.cov_strand_all.append(cov_strand)
             # if get_sense_info:
             #     self.cov_sense_all.append(np.array(cov_sense))
             # print(np.array(cov_sense))
 
         self.coverageorig = self.coverage[:]
-        self.overall_cov = reduce(lambda x, y: np.concatenate((x, y)),
-                                  [self.coverage[i] for i in range(len(self.genomicRegions))])
+        self.overall_cov = self._get_overall_cov()
+        key = _unique_reads_key(bam_file, mask_file=mask_file if mask else None, no_gaps=no_gaps, fragments=fragments,
+                                min_fragment_size=min_fragment_size if fragments else None,
+                                max_fragment_size=max_fragment_size if fragments else None)
+        self.unique_reads[key] = unique_reads
         if mask: f.close()
 
+    def _get_strand_info(self, starts, reverse, eligible, orientation=None):
+        """Return the strand information (forward, backward) of each read. All reads starting at the same position
+        get the information of the first (eligible) read there. If <orientation> is given, the information is relative
+        to the orientation of the region (sense, antisense)."""
+        info = np.zeros((len(starts), 2), dtype=np.int64)
+        if orientation is None:
+            eligible = np.ones(len(starts), dtype=bool)
+        elif orientation not in ["+", "-"]:
+            return info
+
+        index = np.flatnonzero(eligible)
+        if len(index) == 0:
+            return info
+        pos, first = np.unique(starts[index], return_index=True)
+        first = index[first]
+        j = np.minimum(np.searchsorted(pos, starts), len(pos) - 1)
+        found = pos[j] == starts
+
+        backward = reverse[first[j[found]]]
+        if orientation == "+":
+            backward = ~backward
+        info[np.flatnonzero(found), backward.astype(int)] = 1
+        return info
+
+    def _get_region_coverage(self, starts, lasts, initial, n_windows, binsize, stepsize, fragments):
+        """Return the coverage of the <n_windows> windows of a region starting at <initial> by the reads
+        [<starts>, <lasts>]. As the windows move on, a read is dropped once its extended end lies before the start
+        of the previous window, a fragment once it ends before the start of the window."""
+        win_s, win_e = _window_bounds(np.arange(n_windows), initial, binsize, stepsize, fragments)
+        return _count_windows(starts, lasts, win_e, win_s, 'right' if fragments else 'left')
+
+    def _add_region_coverage(self, cov):
+        """Store the coverage array <cov> of the next GenomicRegion"""
+        self.coverage.append(cov)
+
+    def _get_overall_cov(self):
+        """Return the concatenation of all coverage arrays"""
+        return reduce(lambda x, y: np.concatenate((x, y)),
+                      [self.coverage[i] for i in range(len(self.genomicRegions))])
+
     def array_transpose(self, flip=False):
         """Transpose the arrays in strand coverage"""
         self.transpose_cov1 = []
@@ -566,24 +902,55 @@ class CoverageSet:
             >>>        print(chrom, s, e)
         
         """
-        r = regions
-        iter = r.__iter__()
-        r = iter.next()
-        sum = r.final
-        last = 0
-        i = 0
-        while sum <= index * self.stepsize:
-            last += len(self.coverage[i])
-            try:
-                r = iter.next()
-            except StopIteration:
-                sum += r.final
-                i += 1
-                break
-            sum += r.final
-            i += 1
+        chroms, starts, ends = self.indices2coordinates([index], regions)
 
-        return r.chrom, (index - last) * self.stepsize, min((index - last) * self.stepsize + self.stepsize, r.final)
+        return chroms[0], int(starts[0]), int(ends[0])
+
+    def get_offsets(self):
+        """Return the index of the first bin of each GenomicRegion in <overall_cov>, followed by the number of bins."""
+        return np.cumsum([0] + [len(c) for c in self.coverage])
+
+    def indices2coordinates(self, indices, regions, offsets=None):
+        """Convert the indices of class variable <overall_cov> to genomic coordinates, see index2coordinates.
+        The region of each index is found by binary search in <offsets> (see get_offsets), which are computed
+        if not given.
+
+        *Output:*
+
+        Arrays of the chromosomes, the start- and the end-coordinates of the bins associated to <indices>.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if offsets is None:
+            offsets = self.get_offsets()
+        i = np.clip(np.searchsorted(offsets, indices, side='right') - 1, 0, len(offsets) - 2)
+        chroms = np.array([r.chrom for r in regions.sequences], dtype=object)
+        initial = np.array([r.initial for r in regions.sequences], dtype=np.int64)
+        final = np.array([r.final for r in regions.sequences], dtype=np.int64)
+
+        starts = initial[i] + (indices - offsets[i]) * self.stepsize
+        return chroms[i], starts, np.minimum(starts + self.stepsize, final[i])
+
+    def coordinates2indices(self, chrom, start, end, regions, offsets=None):
+        """Return the indices of <overall_cov> whose bins overlap the genomic interval [<start>, <end>) on
+        <chrom>, the inverse of indices2coordinates.
+
+        *Keyword arguments:*
+
+        - chrom, start, end -- genomic interval
+        - regions -- instance of GenomicRegionSet the conversion is based on
+        - offsets -- see get_offsets, computed if not given
+        """
+        if offsets is None:
+            offsets = self.get_offsets()
+        i = np.array([k for k, r in enumerate(regions.sequences) if r.chrom == chrom], dtype=np.int64)
+        if not len(i):
+            return np.zeros(0, dtype=np.int64)
+        initial = np.array([regions.sequences[k].initial for k in i], dtype=np.int64)
+        n_bins = offsets[i + 1] - offsets[i]
+
+        first = np.clip((start - initial) // self.stepsize, 0, n_bins)
+        last = np.clip(-((initial - end) // self.stepsize), first, n_bins)  # ceil((end - initial) / stepsize)
+        return np.concatenate([np.arange(offsets[k] + f, offsets[k] + l) for k, f, l in zip(i, first, last)])
 
     def coverage_from_bigwig(self, bigwig_file, stepsize=100):
 
@@ -601,20 +968,8 @@ class CoverageSet:
         
         """
 
-        self.coverage = []
-
-        bwf = pyBigWig.open(bigwig_file)
-
-        for gr in self.genomicRegions:
-            steps = int(len(gr) / stepsize)
-            try:
-                ds = bwf.stats(gr.chrom, gr.initial, gr.final, type="mean", nBins=steps)
-                ds = [x if x else 0 for x in ds]
-            except:
-                ds = [0] * steps
-            self.coverage.append(np.array(ds))
-
-        bwf.close()
+        regions = self.genomicRegions.sequences
+        self.coverage = read_bigwig_bins(bigwig_file, regions, [int(len(gr) / stepsize) for gr in regions])
 
     def phastCons46way_score(self, stepsize=100):
         """Load the phastCons46way bigwig files to fetch the scores as coverage.
@@ -623,14 +978,10 @@ class CoverageSet:
         
         - stepsize -- used stepsize
         """
-        self.coverage = []
         phastCons46way_dir = "/data/phastCons46way/"
-        grs = self.genomicRegions.split_by_chromosome()
-        for gr in grs:
-            cov = CoverageSet("chrom", gr)
-            bwpath = os.path.join(phastCons46way_dir, gr.sequences[0].chrom + ".phastCons46way.bw")
-            cov.coverage_from_bigwig(bigwig_file=bwpath, stepsize=stepsize)
-            self.coverage += cov.coverage
+        regions = self.genomicRegions.sequences
+        self.coverage = read_bigwig_bins(lambda c: os.path.join(phastCons46way_dir, c + ".phastCons46way.bw"),
+                                         regions, [int(len(gr) / stepsize) for gr in regions])
 
     def count_unique_reads(self, bamFile):
         """Count the number of unique reads on for class variable <genomicRegions>.
@@ -641,19 +992,20 @@ class CoverageSet:
         
         *Output:*
         
-        number of unique reads
+        number of unique reads, that is distinct read names of the reads overlapping the regions (both mates of a
+        pair are counted once). See class variable <unique_reads> of coverage_from_bam for the number of reads
+        without duplicates.
         
         """
 
         bam = pysam.Samfile(bamFile, "rb")
 
-        reads = []
-        for i, region in enumerate(self.genomicRegions):
+        names = set()
+        for region in self.genomicRegions:
             for r in bam.fetch(region.chrom, region.initial, region.final):
-                reads.append(r.qname)
+                names.add(r.qname)
 
-        reads = list(set(reads))
-        return len(reads)
+        return len(names)
 
     def norm_gc_content(self, cov, genome_path, chrom_sizes):
         chrom_sizes_dict = {}
@@ -680,66 +1032,53 @@ class CoverageSet:
             self.coverage[i] = self.coverage[i].astype(int)
 
 
-def get_gc_context(stepsize, binsize, genome_path, cov_list, chrom_sizes_dict):
-    """Get GC content"""
+# GC-content index (percentage) of each bin, cached by (genome_path, chromosome, binsize, stepsize)
+_gc_content_cache = {}
 
-    class HelpContent:
-        def __init__(self):
-            self.content = [[] for _ in range(101)]
-            self.g_gc = []
-            self.g = -1
 
-        def add(self, d, c):
-            self.content[int(c * 100)].append(round(float(d), 2))
+def _get_gc_index(genome_path, chrom, stepsize, binsize):
+    """Return GC-content in percent (int) for each bin of <chrom>. Bin i covers the sequence
+    [i * stepsize, i * stepsize + binsize], truncated at the end of the chromosome. The result is cached for
+    each genome, chromosome and bin layout."""
+    key = (genome_path, chrom, binsize, stepsize)
+    if key not in _gc_content_cache:
+        genome_fasta = pysam.Fastafile(genome_path)
+        seq = genome_fasta.fetch(reference=chrom)
+        genome_fasta.close()
+        if not isinstance(seq, bytes):
+            seq = seq.encode('ascii')
+        seq = np.frombuffer(seq, dtype=np.uint8)
+        is_gc = (seq == ord('C')) | (seq == ord('G')) | (seq == ord('c')) | (seq == ord('g'))
+        gc_cumsum = np.concatenate(([0], np.cumsum(is_gc, dtype=np.int64)))
 
-        def _compute(self):
-            for l in self.content:
-                r = sum(l) / float(len(l)) if len(l) > 0 else 0
-                self.g_gc.append(r)
+        starts = np.arange(0, len(seq), stepsize, dtype=np.int64)
+        ends = np.minimum(starts + binsize + 1, len(seq))
+        gc_content = (gc_cumsum[ends] - gc_cumsum[starts]) / (ends - starts).astype(float)
+        _gc_content_cache[key] = (gc_content * 100).astype(int)
 
-            self.g = sum(self.g_gc) / float(len(self.g_gc))
+    return _gc_content_cache[key]
 
-        def _map(self, x):
-            return self.g_gc[x]
 
-    # chromosomes = []
+def get_gc_context(stepsize, binsize, genome_path, cov_list, chrom_sizes_dict):
+    """Get GC content"""
     # get first chromosome, typically chr1
-    # for s in FastaReader(genome_path):
-    #    chromosomes.append(s.name)
-    tmp = chrom_sizes_dict.keys()
-    # tmp = map(lambda x: x.replace('chr',''), chromosomes)
-    tmp.sort()
-    genome_fasta = pysam.Fastafile(genome_path)
-    genome = genome_fasta.fetch(reference=tmp[0])
-
-    content = HelpContent()
+    chrom = sorted(chrom_sizes_dict.keys())[0]
+    gc_index = _get_gc_index(genome_path, chrom, stepsize, binsize)
+
+    gc_sum = np.zeros(101)
+    gc_count = np.zeros(101)
     gc_content_cov = []
 
     for cov in cov_list:
-        cur_gc_value = []
-
-        for i in range(len(cov)):
-            s = i * stepsize
-            e = i * stepsize + binsize
-            seq = genome[s: e + 1]
-            seq = seq.upper()
-            count = seq.count("C") + seq.count("G")
-            if len(seq) > 0:
-                gc_content = float(count) / len(seq)
-                # print(float(count), len(seq), float(count) / len(seq), cov[i], file=sys.stderr)
-                content.add(cov[i], gc_content)
-                cur_gc_value.append(int(gc_content * 100))
-            else:
-                #                print("Bins exceed genome (%s - %s), add pseudo counts" %(s, e), file=sys.stderr)
-                #                     content.add(cov[i], 0.5)
-                cur_gc_value.append(0)
-
+        cov = np.asarray(cov, dtype=float)
+        n = min(len(cov), len(gc_index))
+        cur_gc_value = np.zeros(len(cov), dtype=int)  # bins that exceed the genome get GC-content 0
+        cur_gc_value[:n] = gc_index[:n]
+        gc_sum += np.bincount(gc_index[:n], weights=np.round(cov[:n], 2), minlength=101)
+        gc_count += np.bincount(gc_index[:n], minlength=101)
         gc_content_cov.append(cur_gc_value)
 
-    content._compute()
-    r = []
-    for l in gc_content_cov:
-        tmp = map(content._map, l)
-        r.append(tmp)
+    g_gc = np.where(gc_count > 0, gc_sum / np.maximum(gc_count, 1), 0)
+    r = [g_gc[l] for l in gc_content_cov]
 
-    return r, content.g, content.g_gc
+    return r, np.mean(g_gc), list(g_gc)
@@ -6,13 +6,13 @@ from argparse import SUPPRESS
 from rgt.Util import ErrorHandler, HmmData, GenomeData, OverlapType
 from rgt.GenomicRegion import GenomicRegion
 from rgt.GenomicRegionSet import GenomicRegionSet
+from rgt.CoverageSet import get_library_size
 from rgt.HINT.signalProcessing import GenomicSignal
 from rgt.HINT.hmm import HMM, _compute_log_likelihood
 from rgt.HINT.biasTable import BiasTable
 
 # External
 import types
-import pysam
 from numpy import array, sum, isnan
 from hmmlearn.hmm import GaussianHMM
 from sklearn.externals import joblib
@@ -831,8 +831,7 @@ def post_processing(footprints, original_regions, fp_min_size, fp_ext, genome_da
     footprints_overlap.write(output_file_name)
 
     # the number of reads
-    lines = pysam.idxstats(reads_file.file_name).splitlines()
-    num_reads = sum(map(int, [x.split("\t")[2] for x in lines if not x.startswith("#")]))
+    num_reads = get_library_size(reads_file.file_name)["mapped"]
 
     # the number of peaks and tag count within peaks
     num_peaks = 0
@@ -0,0 +1,242 @@
+"""
+SparseCoverageSet
+===================
+SparseCoverageSet represents the coverage data of a GenomicRegionSet as run-length encoded arrays. For sparse signals
+like ChIP-seq or ATAC-seq most bins are zero, so that genome-wide coverage needs only a fraction of the memory of
+CoverageSet.
+
+"""
+
+# Python 3 compatibility
+from __future__ import print_function
+from __future__ import division
+
+# Python
+import sys
+
+# Internal
+from .CoverageSet import CoverageSet, BigWigWriter, _window_bounds
+
+# External
+import numpy as np
+
+
+def _first_window(bound, values, n, strict):
+    """Return for each of <values> the first window i in [0, <n>] whose <bound>(i) is greater than (if <strict>) or
+    equal to the value, <n> if there is none. <bound> is non-decreasing, it is evaluated by a binary search on
+    all values at once."""
+    values = np.asarray(values, dtype=float)
+    lo = np.zeros(len(values), dtype=np.int64)
+    hi = np.full(len(values), n, dtype=np.int64)
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi) // 2
+        found = bound(mid) > values if strict else bound(mid) >= values
+        hi = np.where(active & found, mid, hi)
+        lo = np.where(active & ~found, mid + 1, lo)
+        active = lo < hi
+    return lo
+
+
+class RunLengthArray:
+    """Run-length encoded one-dimensional array.
+
+    *Keyword arguments:*
+
+        - ends -- end (exclusive) of each run, strictly increasing
+        - values -- value of each run
+    """
+
+    def __init__(self, ends, values):
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.values = np.asarray(values)
+
+    @classmethod
+    def from_dense(cls, a):
+        """Return RunLengthArray of the numpy array <a>."""
+        a = np.asarray(a)
+        if len(a) == 0:
+            return cls([], a[:0])
+        ends = np.append(np.flatnonzero(a[1:] != a[:-1]) + 1, len(a))
+        return cls(ends, a[ends - 1])
+
+    @classmethod
+    def from_events(cls, up, down, n):
+        """Return RunLengthArray of length <n>, whose value at i is the number of indices in <up> minus the number
+        of indices in <down> that are at most i."""
+        up, down = np.sort(up), np.sort(down)
+        breaks = np.unique(np.concatenate(([0], up, down)).astype(np.int64))
+        breaks = breaks[breaks < n]
+        values = np.searchsorted(up, breaks, side='right') - np.searchsorted(down, breaks, side='right')
+        return cls(np.append(breaks[1:], n) if n > 0 else [], values)._compact()
+
+    @classmethod
+    def concatenate(cls, arrays):
+        """Return the concatenation of RunLengthArrays <arrays>."""
+        ends, values, offset = [], [], 0
+        for a in arrays:
+            ends.append(a.ends + offset)
+            values.append(a.values)
+            offset += len(a)
+        if not ends:
+            return cls([], [])
+        return cls(np.concatenate(ends), np.concatenate(values))._compact()
+
+    def __len__(self):
+        return int(self.ends[-1]) if len(self.ends) else 0
+
+    def _compact(self):
+        """Merge neighbouring runs with equal values."""
+        if len(self.values) > 1:
+            keep = np.append(self.values[1:] != self.values[:-1], True)
+            self.ends = self.ends[keep]
+            self.values = self.values[keep]
+        return self
+
+    def to_dense(self):
+        """Return numpy array."""
+        return np.repeat(self.values, np.diff(np.concatenate(([0], self.ends))))
+
+    def _binary_op(self, other, op):
+        if isinstance(other, np.ndarray):
+            other = RunLengthArray.from_dense(other)
+        if not isinstance(other, RunLengthArray):
+            return RunLengthArray(self.ends.copy(), op(self.values, other))._compact()
+
+        assert len(self) == len(other)
+        ends = np.union1d(self.ends, other.ends)
+        values = op(self.values[np.searchsorted(self.ends, ends)], other.values[np.searchsorted(other.ends, ends)])
+        return RunLengthArray(ends, values)._compact()
+
+    def __add__(self, other):
+        return self._binary_op(other, np.add)
+
+    def __sub__(self, other):
+        return self._binary_op(other, np.subtract)
+
+    def __mul__(self, other):
+        return self._binary_op(other, np.multiply)
+
+    __radd__ = __add__
+    __rmul__ = __mul__
+
+    def clip(self, a_min, a_max=None):
+        """Clip values to [<a_min>, <a_max>]."""
+        return RunLengthArray(self.ends.copy(), np.clip(self.values, a_min, a_max))._compact()
+
+    def astype(self, dtype):
+        return RunLengthArray(self.ends.copy(), self.values.astype(dtype))._compact()
+
+    def sum(self):
+        """Return the sum over all elements."""
+        return np.sum(self.values * np.diff(np.concatenate(([0], self.ends))))
+
+    def max(self):
+        return self.values.max()
+
+    def nbytes(self):
+        """Return the memory used by the encoding."""
+        return self.ends.nbytes + self.values.nbytes
+
+
+class SparseCoverageSet(CoverageSet):
+    """CoverageSet, whose coverage of each GenomicRegion is a RunLengthArray. coverage_from_bam builds the runs from
+    the read positions without a dense array of the region; strand information is still stored dense.
+
+    *Keyword arguments:*
+
+        - name -- names.
+        - genomicRegions -- instance of GenomicRegionSet
+    """
+
+    def _get_region_coverage(self, starts, lasts, initial, n_windows, binsize, stepsize, fragments):
+        """Return the coverage of a region as RunLengthArray, see CoverageSet._get_region_coverage. The coverage
+        changes only at the windows where a read enters or is dropped, which are found by binary search, so that
+        the memory depends on the number of reads and not on the length of the region."""
+        bounds = lambda i: _window_bounds(i, initial, binsize, stepsize, fragments)
+        enter = _first_window(lambda i: bounds(i)[1], starts, n_windows, True)
+        drop = _first_window(lambda i: bounds(i)[0], lasts, n_windows, not fragments)
+        return RunLengthArray.from_events(enter, drop, n_windows)
+
+    def _add_region_coverage(self, cov):
+        """Store the coverage <cov> of the next GenomicRegion run-length encoded"""
+        self.coverage.append(cov if isinstance(cov, RunLengthArray) else RunLengthArray.from_dense(cov))
+
+    def _get_overall_cov(self):
+        """Return the concatenation of all coverage arrays as RunLengthArray"""
+        return RunLengthArray.concatenate(self.coverage)
+
+    def subtract(self, cs):
+        """Substract CoverageSet <cs>.
+
+        *Keyword arguments:*
+
+        - cs -- instance of CoverageSet or SparseCoverageSet
+
+        .. note::
+            negative values are set to 0.
+        """
+        for i, j in self._coverage_index(cs):
+            assert len(self.coverage[i]) == len(cs.coverage[j])
+            self.coverage[i] = (self.coverage[i] - cs.coverage[j]).clip(0)
+
+    def add(self, cs):
+        """Add CoverageSet <cs>.
+
+        *Keyword arguments:*
+
+        - cs -- instance of CoverageSet or SparseCoverageSet, which is used to add up
+        """
+        for i, j in self._coverage_index(cs):
+            assert len(self.coverage[i]) == len(cs.coverage[j])
+            self.coverage[i] = self.coverage[i] + cs.coverage[j]
+
+    def scale(self, factor):
+        """Scale coverage with <factor>.
+
+        *Keyword arguments:*
+
+        - factor -- float
+        """
+        for i in range(len(self.coverage)):
+            c = self.coverage[i]
+            self.coverage[i] = RunLengthArray(c.ends, np.rint(c.values * float(factor)).astype(int))._compact()
+
+    def normRPM(self):
+        """Normalize to read per million (RPM)."""
+        if self.reads == 0:
+            print("Error! The reads number is zero in " + self.name)
+            print("** Please try to reindex the file by \'samtools index\'.")
+            sys.exit(1)
+
+        factor = 1000000 / float(self.reads)
+        self.coverage = [c * factor for c in self.coverage]
+
+    def to_dense(self):
+        """Return the coverage as CoverageSet with numpy arrays."""
+        cs = CoverageSet(self.name, self.genomicRegions)
+        cs.binsize, cs.stepsize = self.binsize, self.stepsize
+        cs.reads, cs.mapped_reads = self.reads, self.mapped_reads
+        cs.coverage = [c.to_dense() for c in self.coverage]
+        return cs
+
+    def write_bigwig(self, filename, chrom_file, end=True, save_wig=False):
+        """Output coverage in bigwig format.
+
+        *Keyword arguments:*
+
+        - filename -- filepath
+        - chrom_file -- chromosome size file
+        - end -- boolean, deprecated
+        - save_wig -- boolean, if set, wig file is also saved.
+        """
+        writer = BigWigWriter(filename, chrom_file)
+        writer.add_coverage(self)
+        writer.close()
+
+        if save_wig:
+            self.to_dense().write_wig(filename + '.wig')
+
+    def nbytes(self):
+        """Return the memory used by the coverage."""
+        return sum(c.nbytes() for c in self.coverage)
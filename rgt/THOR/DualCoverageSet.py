@@ -24,7 +24,7 @@ from os import path
 from random import sample
 from rgt.CoverageSet import CoverageSet
 from rgt.CoverageSet import get_gc_context
-from normalize import get_normalization_factor
+from .normalize import get_normalization_factor
 
 EPSILON=1e-320
 
@@ -79,6 +79,12 @@ class DualCoverageSet():
                                                      binsize=binsize, stepsize=stepsize)
                 map_input[i]['cov-input'] = input['cov-input']
 
+            if input['input'] is not None and norm_strategy == 5: #Diaz factor of the coverage before GC-correction
+                _, input['diaz_factor'] = get_normalization_factor(input['cov-ip'], input['cov-input'],
+                                                                   step_width=1000, zero_counts=0,
+                                                                   filename=name + '-norm' + str(i), debug=debug,
+                                                                   two_sample=False)
+
             if not no_gc_content and input['input'] is not None:
                 gc_content_cov, avg_gc_content, gc_hist = get_gc_context(stepsize, binsize, genome_path,
                                                                          input['cov-input'].coverage, chrom_sizes_dict)
@@ -167,16 +173,8 @@ class DualCoverageSet():
         # diaz and naive
         if i != 1 and norm_strategy == 5:
             # apply diaz
-            _, map_input[1]['input_factor'] = get_normalization_factor(map_input[1]['ip'], map_input[1]['input'],
-                                                                       step_width=1000, zero_counts=0, \
-                                                                       filename=name + '-norm' + str(i), debug=debug,
-                                                                       chrom_sizes_dict=chrom_sizes_dict,
-                                                                       two_sample=False)
-            _, map_input[2]['input_factor'] = get_normalization_factor(map_input[2]['ip'], map_input[2]['input'],
-                                                                       step_width=1000, zero_counts=0, \
-                                                                       filename=name + '-norm' + str(i), debug=debug,
-                                                                       chrom_sizes_dict=chrom_sizes_dict,
-                                                                       two_sample=False)
+            map_input[1]['input_factor'] = map_input[1]['diaz_factor']
+            map_input[2]['input_factor'] = map_input[2]['diaz_factor']
 
             print("Normalize input with factor %s and %s" % (
             round(map_input[1]['input_factor'], 3), round(map_input[2]['input_factor'], 3)), file=sys.stderr)
@@ -235,24 +233,7 @@ class DualCoverageSet():
 
     def _index2coordinates(self, index):
         """Translate index within coverage array to genomic coordinates."""
-        iter = self.genomicRegions.__iter__()
-        r = iter.next()
-        sum = r.final
-        last = 0
-        i = 0
-        while sum <= index * self.stepsize:
-            last += len(self.cov1.coverage[i])
-            try:
-                r = iter.next()
-            except StopIteration:
-                sum += r.final
-                i += 1
-                break
-            sum += r.final
-            i += 1
-
-        return r.chrom, (index - last) * self.stepsize, \
-               min((index - last) * self.stepsize + self.stepsize, r.final)
+        return self.cov1.index2coordinates(index, self.genomicRegions)
 
     def __len__(self):
         """Return number of observations."""
@@ -23,7 +23,6 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import print_function
 import sys
 import gc
-from random import sample
 import numpy as np
 from .normalize import get_normalization_factor
 from .DualCoverageSet import DualCoverageSet
@@ -31,11 +30,24 @@ from .norm_genelevel import norm_gene_level
 from ..CoverageSet import CoverageSet, get_gc_context
 
 EPSILON = 1**-320
+COV_DTYPE = np.int32 #dtype of the overall coverage
 ROUND_PRECISION = 3
 DEBUG = None
 VERBOSE = None
 
 
+def _top_indices(values, k):
+    """Return the ascending indices of the <k> largest <values>, ties are resolved by the smaller index"""
+    if len(values) <= k:
+        return np.arange(len(values))
+    if k <= 0:
+        return np.zeros(0, dtype=int)
+    threshold = np.partition(values, len(values) - k)[len(values) - k]
+    above = np.flatnonzero(values > threshold)
+    ties = np.flatnonzero(values == threshold)[:k - len(above)]
+    return np.sort(np.concatenate((above, ties)))
+
+
 class MultiCoverageSet(DualCoverageSet):
     def _help_init(self, path_bamfiles, exts, rmdup, binsize, stepsize, path_inputs, exts_inputs, dim, regions, norm_regionset, strand_cov):
         """Return self.covs and self.inputs as CoverageSet"""
@@ -135,34 +147,37 @@ class MultiCoverageSet(DualCoverageSet):
                 yield self.norm_regions[i].coverage[j]
     
     def _help_init_overall_coverage(self, cov_strand=True):
-        """Convert coverage data (and optionally strand data) to matrix list"""
+        """Convert coverage data (and optionally strand data) to one (#replicates X #bins) array per signal. The
+        arrays are allocated once and filled region by region, the strand data of a signal is one
+        (2 X #replicates X #bins) array, whose positive and negative strand are views."""
+        type = 'cov' if cov_strand else 'normregion'
+        bins = sum(len(c) for c in self._help_get_data(0, type))
+        dims = [self.dim_1, self.dim_2]
         
-        tmp = [[], []]
-        tmp2 = [[[], []], [[], []]]
+        overall_coverage = [np.empty((d, bins), dtype=COV_DTYPE) for d in dims]
+        overall_coverage_strand = [np.empty((2, d, bins), dtype=COV_DTYPE) for d in dims] if cov_strand else None
         
         for k in range(2):
-            it = range(self.dim_1) if k == 0 else range(self.dim_1, self.dim_1 + self.dim_2)
-            for i in it:
+            for rep in range(dims[k]):
+                i = rep if k == 0 else rep + self.dim_1
+                start = 0
+                for c in self._help_get_data(i, type):
+                    overall_coverage[k][rep, start:start + len(c)] = c
+                    start += len(c)
                 if cov_strand:
-                    tmp_el = reduce(lambda x,y: np.concatenate((x,y)), self._help_get_data(i, 'cov'))
-                    tmp[k].append(tmp_el)
-                 
-                    tmp_el = map(lambda x: (x[0], x[1]), reduce(lambda x,y: np.concatenate((x,y)), self._help_get_data(i, 'strand')))
-                    tmp2[k][0].append(map(lambda x: x[0], tmp_el))
-                    tmp2[k][1].append(map(lambda x: x[1], tmp_el))
-                else:
-                    tmp_el = reduce(lambda x,y: np.concatenate((x,y)), self._help_get_data(i, 'normregion'))
-                    tmp[k].append(tmp_el)
-
+                    start = 0
+                    for c in self._help_get_data(i, 'strand'):
+                        overall_coverage_strand[k][:, rep, start:start + len(c)] = np.asarray(c).T
+                        start += len(c)
+        
         if cov_strand:
-            #1. or 2. signal -> pos/neg strand -> matrix with rep x bins
-            overall_coverage_strand = [[np.matrix(tmp2[0][0]), np.matrix(tmp2[0][1])], [np.matrix(tmp2[1][0]), np.matrix(tmp2[0][1])]]
-            #list of matrices: #replicates (row) x #bins (columns)
-            overall_coverage = [np.matrix(tmp[0]), np.matrix(tmp[1])]
-         
             return overall_coverage, overall_coverage_strand
         else:
-            return [np.matrix(tmp[0]), np.matrix(tmp[1])]
+            return overall_coverage
+    
+    def nbytes(self):
+        """Return the memory used by the overall coverage arrays"""
+        return sum(c.nbytes for c in self.overall_coverage + self.overall_coverage_strand)
     
     def count_positive_signal(self):
         return np.sum([self.covs[i].coverage for i in range(self.dim_1 + self.dim_2)])
@@ -171,7 +186,8 @@ class MultiCoverageSet(DualCoverageSet):
                  verbose, debug, no_gc_content, rmdup, path_bamfiles, exts, path_inputs, exts_inputs, \
                  factors_inputs, chrom_sizes_dict, scaling_factors_ip, save_wig, strand_cov, housekeeping_genes,\
                  tracker, end, counter, gc_content_cov=None, avg_gc_content=None, gc_hist=None, output_bw=True,\
-                 folder_report=None, report=None, save_input=False, m_threshold=80, a_threshold=95):
+                 folder_report=None, report=None, save_input=False, m_threshold=80, a_threshold=95,\
+                 tmm_sample_size=None):
         """Compute CoverageSets, GC-content and normalize input-DNA and IP-channel"""
         self.genomicRegions = regions
         self.binsize = binsize
@@ -196,24 +212,29 @@ class MultiCoverageSet(DualCoverageSet):
         
         #make data nice
         self._help_init(path_bamfiles, exts, rmdup, binsize, stepsize, path_inputs, exts_inputs, sum(dims), regions, norm_regionset, strand_cov = strand_cov)
+        self.offsets = self.covs[0].get_offsets() #first bin of each region
         if self.count_positive_signal() < 1:
             self.no_data = True
             return None
+        diaz_factors = self._get_input_factors(name) if path_inputs and not factors_inputs else None
         self._compute_gc_content(no_gc_content, path_inputs, stepsize, binsize, genome_path, name, chrom_sizes, chrom_sizes_dict)
-        self._normalization_by_input(path_bamfiles, path_inputs, name, factors_inputs, save_input)
+        self._normalization_by_input(path_bamfiles, path_inputs, name, factors_inputs, save_input, diaz_factors)
         if save_input:
             self._output_input_bw(name, chrom_sizes, save_wig) 
             
         self.overall_coverage, self.overall_coverage_strand = self._help_init_overall_coverage(cov_strand=True)
         
         self._normalization_by_signal(name, scaling_factors_ip, path_bamfiles, housekeeping_genes, tracker, norm_regionset, report,
-                                      m_threshold, a_threshold)
+                                      m_threshold, a_threshold, tmm_sample_size)
         
         if output_bw:
             self._output_bw(name, chrom_sizes, save_wig, save_input) 
         
-        self.scores = np.zeros(len(self.overall_coverage[0]))
+        self.scores = np.zeros(self._get_bin_number())
         self.indices_of_interest = []
+        
+        if VERBOSE:
+            print("Overall coverage uses %s MB" % round(self.nbytes() / 1024.0 ** 2, ROUND_PRECISION), file=sys.stderr)
     
     def get_max_colsum(self):
         """Sum over all columns and add maximum"""
@@ -225,8 +246,16 @@ class MultiCoverageSet(DualCoverageSet):
             for i in range(self.overall_coverage[j].shape[1]):
                 print(self.overall_coverage[j][:,i].T, file=f)
     
-    def _normalization_by_input(self, path_bamfiles, path_inputs, name, factors_inputs, save_input):
-        """Normalize input-DNA. Use predefined factors or follow Diaz et al, 2012"""
+    def _get_input_factors(self, name):
+        """Return the factor of Diaz et al, 2012 of each input-DNA, None if it cannot be computed. Call it before the
+        GC-content correction, as the factors are defined on the uncorrected coverage."""
+        return [get_normalization_factor(self.covs[i], self.inputs[i], step_width=1000, zero_counts=0,
+                                         filename=name + '-norm' + str(i), debug=DEBUG, two_sample=False)[1]
+                for i in range(len(self.covs))]
+    
+    def _normalization_by_input(self, path_bamfiles, path_inputs, name, factors_inputs, save_input, diaz_factors=None):
+        """Normalize input-DNA. Use predefined factors or follow Diaz et al, 2012 with the factors <diaz_factors>
+        given by _get_input_factors"""
         
         if VERBOSE:
             print("Normalize input-DNA", file=sys.stderr)
@@ -244,8 +273,7 @@ class MultiCoverageSet(DualCoverageSet):
                 rep = i if i < self.dim_1 else i-self.dim_1
                 sig = 0 if i < self.dim_1 else 1
                 j = 0 if i < self.dim_1 else 1
-                _, n = get_normalization_factor(path_bamfiles[i], path_inputs[i], step_width=1000, zero_counts=0, \
-                                                filename=name + '-norm' + str(i), debug=DEBUG, chrom_sizes_dict=self.chrom_sizes_dict, two_sample=False, stop=True)
+                n = diaz_factors[i]
                 if n is not None:
                     print("Normalize input of Signal %s, Rep %s with factor %s"\
                            %(sig, rep, round(n, ROUND_PRECISION)) , file=sys.stderr)
@@ -258,67 +286,71 @@ class MultiCoverageSet(DualCoverageSet):
         
                     
     def _trim4TMM(self, m_values, a_values, m_threshold=80, a_threshold=95):
-        """q=20 or q=5"""
+        """Return M and A values within the percentiles of <m_threshold> and <a_threshold>, q=20 or q=5"""
         assert len(m_values) == len(a_values)
         
-        mask = np.asarray([not x for x in np.isinf(m_values) + np.isinf(a_values)])
-        
+        mask = ~(np.isinf(m_values) | np.isinf(a_values))
         m_values = m_values[mask]
         a_values = a_values[mask]
         
-        perc_m_l = np.percentile(m_values, 100-m_threshold)
-        perc_m_h = np.percentile(m_values, m_threshold)
-        perc_a_l = np.percentile(a_values, 100-a_threshold)
-        perc_a_h = np.percentile(a_values, a_threshold)
+        perc_m_l, perc_m_h = np.percentile(m_values, [100-m_threshold, m_threshold])
+        perc_a_l, perc_a_h = np.percentile(a_values, [100-a_threshold, a_threshold])
         
-        try:
-            res = filter(lambda x: not(x[0]>perc_m_h or x[0]<perc_m_l),\
-                     filter(lambda x: not(x[1]>perc_a_h or x[1]<perc_a_l), zip(list(m_values.squeeze()),list(a_values.squeeze()))))
-        except:
-            print('something wrong %s %s' %(len(m_values), len(a_values)), file=sys.stderr)
-            return np.asarray(m_values), np.asarray(a_values)
-        
-        if res:
-            return np.asarray(map(lambda x: x[0], res)), np.asarray(map(lambda x: x[1], res))
+        keep = (m_values >= perc_m_l) & (m_values <= perc_m_h) & (a_values >= perc_a_l) & (a_values <= perc_a_h)
+        if keep.any():
+            return m_values[keep], a_values[keep]
         else:
             print('TMM normalization: nothing trimmed...', file=sys.stderr)
-            return np.asarray(m_values), np.asarray(a_values)
+            return m_values, a_values
     
-    def _norm_TMM(self, overall_coverage, m_threshold, a_threshold):
-        """Normalize with TMM approach, based on PePr"""
+    def _norm_TMM(self, overall_coverage, m_threshold, a_threshold, top=10000, sample_size=None):
+        """Normalize with TMM approach, based on PePr. Consider the <top> bins with highest coverage in the replicate
+        and the reference (mean of all replicates). If <sample_size> is given, at most <sample_size> bins with
+        coverage are sampled. Return the scaling factors and the M/A statistics of each replicate."""
+        ref = (overall_coverage[0].sum(axis=0, dtype=float) + overall_coverage[1].sum(axis=0, dtype=float)) / \
+              (self.dim_1 + self.dim_2)
+        bins = np.flatnonzero(ref > 0)
+        if sample_size is not None and len(bins) > sample_size:
+            bins = np.sort(np.random.RandomState(42).choice(bins, sample_size, replace=False))
+        ref = ref[bins]
+        
         scaling_factors_ip = []
+        stats = []
         for j, cond_max in enumerate([self.dim_1, self.dim_2]):
             for i in range(cond_max): #normalize all replicates
-                ref = np.asarray(np.sum(overall_coverage[0], axis=0) + np.sum(overall_coverage[1], axis=0), dtype='float')/ (self.dim_1 + self.dim_2)
-                
-                mask_ref = ref > 0
-                ref = ref[mask_ref]
-                data_rep = np.asarray(overall_coverage[j][i,:])[mask_ref]
-                tmp = zip(data_rep, ref, data_rep + ref)
-                tmp.sort(key = lambda x: x[2], reverse=True)
-                tmp = tmp[:min(len(tmp), 10000)]
-                
-                data_rep = np.asarray(map(lambda x: x[0], tmp))
-                ref = np.asarray(map(lambda x: x[1], tmp))
-                assert len(data_rep) == len(ref)
+                data_rep = overall_coverage[j][i, bins].astype(float)
+                top_bins = _top_indices(data_rep + ref, top)
+                data_rep, ref_rep = data_rep[top_bins], ref[top_bins]
                 m = data_rep > 0
                 data_rep = data_rep[m]
-                ref = ref[m]
+                ref_rep = ref_rep[m]
                 
-                m_values = np.log(ref / data_rep)
-                a_values = 0.5 * np.log(data_rep * ref)
+                m_values = np.log(ref_rep / data_rep)
+                a_values = 0.5 * np.log(data_rep * ref_rep)
                 try:
                     m_values, a_values = self._trim4TMM(m_values, a_values, m_threshold, a_threshold)
                     f = 2 ** (np.sum(m_values * a_values) / np.sum(a_values))
                     scaling_factors_ip.append(f)
+                    stats.append((len(data_rep), len(m_values), np.mean(m_values), np.mean(a_values)))
                 except:
                     print('TMM normalization not successfully performed, do not normalize data', file=sys.stderr)
                     scaling_factors_ip.append(1)
+                    stats.append((len(data_rep), 0, np.nan, np.nan))
                 
-        return scaling_factors_ip
+        return scaling_factors_ip, stats
+    
+    def _write_TMM_stats(self, tracker, stats):
+        """Write M/A statistics of the TMM normalization to tracker"""
+        text = []
+        for k, (n, n_trimmed, m_mean, a_mean) in enumerate(stats):
+            rep = k if k < self.dim_1 else k-self.dim_1
+            sig = 1 if k < self.dim_1 else 2
+            text.append("s%s-rep%s: %s bins, %s bins after trimming, mean M %s, mean A %s"
+                        % (sig, rep, n, n_trimmed, round(m_mean, ROUND_PRECISION), round(a_mean, ROUND_PRECISION)))
+        tracker.write(text="\n".join(text), header="TMM normalization (M/A statistics)")
     
     def _normalization_by_signal(self, name, scaling_factors_ip, bamfiles, housekeeping_genes, tracker, norm_regionset, report,
-                                 m_threshold, a_threshold):
+                                 m_threshold, a_threshold, tmm_sample_size=None):
         """Normalize signal"""
         
         if VERBOSE:
@@ -331,10 +363,13 @@ class MultiCoverageSet(DualCoverageSet):
             if norm_regionset:
                 print('Use TMM approach based on peaks', file=sys.stderr)
                 norm_regionset_coverage = self._help_init_overall_coverage(cov_strand=False) #TMM approach based on peaks
-                scaling_factors_ip = self._norm_TMM(norm_regionset_coverage,m_threshold, a_threshold)
+                scaling_factors_ip, stats = self._norm_TMM(norm_regionset_coverage, m_threshold, a_threshold,
+                                                           sample_size=tmm_sample_size)
             else:
                 print('Use global TMM approach ', file=sys.stderr)
-                scaling_factors_ip = self._norm_TMM(self.overall_coverage, m_threshold, a_threshold) #TMM approach
+                scaling_factors_ip, stats = self._norm_TMM(self.overall_coverage, m_threshold, a_threshold,
+                                                           sample_size=tmm_sample_size) #TMM approach
+            self._write_TMM_stats(tracker, stats)
         
         for i in range(len(scaling_factors_ip)):
             self.covs[i].scale(scaling_factors_ip[i]) 
@@ -343,7 +378,7 @@ class MultiCoverageSet(DualCoverageSet):
             for j, cond in enumerate([self.dim_1, self.dim_2]):
                 for i in range(cond): #normalize all replicates
                     k = i if j == 0 else i+self.dim_1
-                    self.overall_coverage[j][i,:] *= scaling_factors_ip[k]
+                    self.overall_coverage[j][i,:] = np.rint(self.overall_coverage[j][i,:] * scaling_factors_ip[k])
                     if DEBUG:
                         print('Use scaling factor %s' %round(scaling_factors_ip[k], ROUND_PRECISION), file=sys.stderr)
         
@@ -354,24 +389,16 @@ class MultiCoverageSet(DualCoverageSet):
                 
     def _index2coordinates(self, index):
         """Translate index within coverage array to genomic coordinates."""
-        iter = self.genomicRegions.__iter__()
-        r = iter.next()
-        sum = r.final
-        last = 0
-        i = 0
-        while sum <= index * self.stepsize:
-            last += len(self.covs[0].coverage[i])
-            try:
-                r = iter.next()
-            except StopIteration:
-                sum += r.final
-                i += 1
-                break
-            sum += r.final
-            i += 1
-        
-        return r.chrom, (index-last) * self.stepsize, \
-            min((index-last) * self.stepsize + self.stepsize, r.final)
+        chroms, starts, ends = self._indices2coordinates([index])
+        return chroms[0], int(starts[0]), int(ends[0])
+    
+    def _indices2coordinates(self, indices):
+        """Translate indices within coverage array to arrays of chromosomes, starts and ends."""
+        return self.covs[0].indices2coordinates(indices, self.genomicRegions, self.offsets)
+    
+    def _coordinates2indices(self, chrom, start, end):
+        """Return indices within coverage array of the bins that overlap [<start>, <end>) on <chrom>."""
+        return self.covs[0].coordinates2indices(chrom, start, end, self.genomicRegions, self.offsets)
                               
     def __len__(self):
         """Return number of observations."""
@@ -381,12 +408,17 @@ class MultiCoverageSet(DualCoverageSet):
         """Return indices of observations. Do not consider indices contained in <mask> array"""
         mask = np.asarray(mask)
         if not mask.size:
-            mask = np.array([True]*self._get_bin_number())
-        return np.asarray(np.concatenate((self.overall_coverage[0][:,mask].T, self.overall_coverage[1][:,mask].T), axis=1))
+            mask = np.arange(self._get_bin_number())
+        elif mask.dtype == bool:
+            mask = np.flatnonzero(mask)
+        obs = np.empty((self.dim_1 + self.dim_2, len(mask)), dtype=COV_DTYPE)
+        np.take(self.overall_coverage[0], mask, axis=1, out=obs[:self.dim_1])
+        np.take(self.overall_coverage[1], mask, axis=1, out=obs[self.dim_1:])
+        return obs.T
     
     def _compute_score(self):
         """Compute score for each observation (based on Xu et al.)"""
-        self.scores = sum([np.squeeze(np.asarray(np.mean(self.overall_coverage[i], axis=0))) / float(np.mean(self.overall_coverage[i])) for i in range(2)])
+        self.scores = sum([np.mean(self.overall_coverage[i], axis=0) / float(np.mean(self.overall_coverage[i])) for i in range(2)])
     
     def _get_bin_number(self):
         """Return number of bins"""
@@ -399,10 +431,9 @@ class MultiCoverageSet(DualCoverageSet):
         
         try:
             self._compute_score()
-            self.indices_of_interest = np.where(self.scores > 0)[0] #2/(m*n)
-            tmp = np.where(np.squeeze(np.asarray(np.mean(self.overall_coverage[0], axis=0))) + np.squeeze(np.asarray(np.mean(self.overall_coverage[1], axis=0))) > 10)[0]
-            tmp2 = np.intersect1d(self.indices_of_interest, tmp)
-            self.indices_of_interest = tmp2
+            mask = self.scores > 0 #2/(m*n)
+            mask &= np.mean(self.overall_coverage[0], axis=0) + np.mean(self.overall_coverage[1], axis=0) > 10
+            self.indices_of_interest = np.flatnonzero(mask)
         except:
             self.indices_of_interest = None
         #print(len(self.indices_of_interest), file=sys.stderr)
@@ -433,11 +464,15 @@ class MultiCoverageSet(DualCoverageSet):
         self.write_test_samples(name + '-s1', s1_v)
         self.write_test_samples(name + '-s2', s2_v)
     
-    def get_training_set(self, test, exp_data, name, foldchange, min_t, y=5000, ex=2):
-        """Return HMM's training set (max <y> positions). Enlarge each contained bin by <ex>."""
+    def get_training_set(self, test, exp_data, name, foldchange, min_t, y=5000, ex=2, seed=42):
+        """Return HMM's training set (max <y> positions). Enlarge each contained bin by <ex>. The positions are
+        sampled with the random seed <seed>."""
+        random_state = np.random.RandomState(seed)
         threshold = foldchange
-        diff_cov = int(np.percentile(np.abs(np.squeeze(np.asarray(np.mean(self.overall_coverage[0], axis=0))) - \
-                                            np.squeeze(np.asarray(np.mean(self.overall_coverage[1], axis=0)))), min_t))
+        mean1 = np.mean(exp_data.overall_coverage[0][:, self.indices_of_interest], axis=0)
+        mean2 = np.mean(exp_data.overall_coverage[1][:, self.indices_of_interest], axis=0)
+        diff_cov = int(np.percentile(np.abs(np.mean(self.overall_coverage[0], axis=0) - \
+                                            np.mean(self.overall_coverage[1], axis=0)), min_t))
 
         if test:
             diff_cov, threshold = 2, 1.5
@@ -445,33 +480,28 @@ class MultiCoverageSet(DualCoverageSet):
         if DEBUG:  
             print('Training set parameters: threshold: %s, diff_cov: %s' %(threshold, diff_cov), file=sys.stderr)
         
-        s0, s1, s2 = [], [], []
-        
         #compute training set parameters, re-compute training set if criteria do not hold
         rep=True
         while rep:
-            for i in sample(range(len(self.indices_of_interest)), min(y, len(self.indices_of_interest))):
-                cov1, cov2 = self._get_covs(exp_data, i)
-                
-                #apply criteria for initial peak calling
-                if (cov1 / max(float(cov2), 1) > threshold and cov1+cov2 > diff_cov/2) or cov1-cov2 > diff_cov:
-                    s1.append((self.indices_of_interest[i], cov1, cov2))
-                elif (cov1 / max(float(cov2), 1) < 1/threshold and cov1+cov2 > diff_cov/2) or cov2-cov1 > diff_cov:
-                    s2.append((self.indices_of_interest[i], cov1, cov2))
-                else:
-                    s0.append((self.indices_of_interest[i], cov1, cov2))
+            i = random_state.choice(len(self.indices_of_interest), min(y, len(self.indices_of_interest)), replace=False)
+            #(index, cov1, cov2) of sampled positions, coverage is the mean over replicates as int
+            el = np.column_stack((self.indices_of_interest[i], mean1[i].astype(int), mean2[i].astype(int)))
+            cov1, cov2 = el[:,1], el[:,2]
             
-                if len(s0) > y and len(s1) > y and len(s2) > y:
-                    break
+            #apply criteria for initial peak calling
+            ratio = cov1 / np.maximum(cov2, 1).astype(float)
+            gain = ((ratio > threshold) & (cov1 + cov2 > diff_cov // 2)) | (cov1 - cov2 > diff_cov)
+            lose = ~gain & (((ratio < 1./threshold) & (cov1 + cov2 > diff_cov // 2)) | (cov2 - cov1 > diff_cov))
+            s0, s1, s2 = el[~gain & ~lose], el[gain], el[lose]
             
             if diff_cov == 1 and threshold == 1.1:
                 print("No differential peaks detected", file=sys.stderr)
                 sys.exit()
             
             if len(s1) < 100/2 and len(s2) > 2*100:
-                s1 = map(lambda x: (x[0], x[2], x[1]), s2)
+                s1 = s2[:, [0, 2, 1]]
             if len(s2) < 100/2 and len(s1) > 2*100:
-                s2 = map(lambda x: (x[0], x[2], x[1]), s1)
+                s2 = s1[:, [0, 2, 1]]
             
             if len(s1) < 100 or len(s2) < 100:
                 diff_cov -= 15
@@ -486,37 +516,25 @@ class MultiCoverageSet(DualCoverageSet):
         
         #optimize training set, extend each bin
         tmp = []
-        for i, el in enumerate([s0, s1, s2]):
-            el = np.asarray(el)
+        for el in [s0, s1, s2]:
             if not test:
                 el = el[el[:,1] < np.percentile(el[:,1], 90)]
                 el = el[el[:,2] < np.percentile(el[:,2], 90)]
             tmp.append(el)
         
-        s0 = tmp[0]
-        s1 = tmp[1]
-        s2 = tmp[2]
+        l = np.min([len(tmp[0]), len(tmp[1]), len(tmp[2]), y])
         
-        l = np.min([len(s1), len(s2), len(s0), y])
+        s0, s1, s2 = [el[random_state.choice(len(el), l, replace=False)] for el in tmp]
         
-        s0 = sample(s0, l)
-        s1 = sample(s1, l)
-        s2 = sample(s2, l)
+        s0_v = s0[:, 1:]
+        s1_v = s1[:, 1:]
+        s2_v = s2[:, 1:]
         
-        s0_v = map(lambda x: (x[1], x[2]), s0)
-        s1_v = map(lambda x: (x[1], x[2]), s1)
-        s2_v = map(lambda x: (x[1], x[2]), s2)
+        indices = np.concatenate((s0[:,0], s1[:,0], s2[:,0]))
+        extension_set = np.unique(indices[:, np.newaxis] + np.arange(-ex, ex + 1)) #extend bins
+        extension_set = extension_set[(extension_set >= 0) & (extension_set < self._get_bin_number())]
         
-        extension_set = set()
-        for i, _, _ in s0 + s1 + s2:
-            for j in range(max(0, i - ex), i + ex + 1): #extend bins
-                extension_set.add(j)
-         
-        tmp = s0 + s1 + s2
-        training_set = map(lambda x: x[0], tmp) + list(extension_set)
-         
-        training_set = list(training_set)
-        training_set.sort()
+        training_set = np.sort(np.concatenate((indices, extension_set)))
         
         if DEBUG:
             self.output_training_set(name, training_set, s0_v, s1_v, s2_v)
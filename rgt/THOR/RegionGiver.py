@@ -43,6 +43,10 @@ class RegionGiver:
                 #if c in contained_chrom:
                         self.regionset.add(GenomicRegion(chrom=c, initial=s, final=e))
                         self.chrom_sizes_dict[c] = e
+            # iterate regions in the order of the chromosome size file, as required by the bigWig output
+            with open(chrom_sizes) as f:
+                chrom_order = dict((line.split()[0], i) for i, line in enumerate(f) if line.strip())
+            self.regionset.sequences.sort(key=lambda r: (chrom_order.get(r.chrom, len(chrom_order)), r.initial))
         else:
             print("Call DPs on whole genome.", file=sys.stderr)
             with open(chrom_sizes) as f:
@@ -25,21 +25,29 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # Python
 from __future__ import print_function
 import sys
+from collections import deque
+import multiprocessing
 
 # Internal
-from .dpc_help import get_peaks, _fit_mean_var_distr, initialize, merge_output, handle_input
-from .tracker import Tracker
-from .postprocessing import _output_BED, _output_narrowPeak
+from .dpc_help import get_peaks, _fit_mean_var_distr, initialize, handle_input, get_bigwig_writers, \
+    close_bigwig_writers, get_peak_memory
+from .tracker import Tracker, get_usage, get_profile
+from .postprocessing import PeakWriter, peak_dtype
 from ..THOR.neg_bin_rep_hmm import NegBinRepHMM, get_init_parameters, _get_pvalue_distr
 from ..THOR.RegionGiver import RegionGiver
-from ..THOR.postprocessing import filter_by_pvalue_strand_lag
+from .checkpoint import Checkpoint, _get_normalization, get_fingerprint
+from ..CoverageSet import CoverageSet
 from .. import __version__
 
 # External
+import numpy as np
 
 
 TEST = False #enable to test THOR locally
 
+# state of run_HMM, inherited by the worker processes that decode the chromosomes
+_DECODE_CONTEXT = {}
+
 
 def _write_info(tracker, report, **data):
     """Write information to tracker"""
@@ -55,9 +63,15 @@ def _write_info(tracker, report, **data):
         tracker.make_html()
 
 
-def train_HMM(region_giver, options, bamfiles, genome, chrom_sizes, dims, inputs, tracker):
-    """Train HMM"""
+def train_HMM(region_giver, options, bamfiles, genome, chrom_sizes, dims, inputs, tracker, checkpoint):
+    """Train HMM, the normalization and the HMM are stored in <checkpoint>. If the checkpoint contains the
+    normalization, extension sizes and scaling factors are not estimated again."""
+    if checkpoint.has('normalization'):
+        norm = checkpoint.get_normalization()
+        options.exts, options.exts_inputs = norm['exts'], norm['exts_inputs']
+        options.scaling_factors_ip, options.factors_inputs = norm['scaling_factors_ip'], norm['factors_inputs']
     
+    start = get_usage()
     while True:
         train_regions = region_giver.get_training_regionset()
         exp_data = initialize(name=options.name, dims=dims, genome_path=genome, regions=train_regions,
@@ -69,13 +83,19 @@ def train_HMM(region_giver, options, bamfiles, genome, chrom_sizes, dims, inputs
                               scaling_factors_ip=options.scaling_factors_ip, save_wig=options.save_wig,
                               housekeeping_genes=options.housekeeping_genes, test=TEST, report=options.report,
                               chrom_sizes_dict=region_giver.get_chrom_dict(), end=True, counter=0, output_bw=False,
-                              save_input=options.save_input, m_threshold=options.m_threshold,
-                              a_threshold=options.a_threshold, rmdup=options.rmdup)
+                              save_input=False, m_threshold=options.m_threshold,
+                              a_threshold=options.a_threshold, rmdup=options.rmdup,
+                              tmm_sample_size=options.tmm_sample_size)
         if exp_data.count_positive_signal() > len(train_regions.sequences[0]) * 0.00001:
             tracker.write(text=" ".join(map(lambda x: str(x), exp_data.exts)), header="Extension size (rep1, rep2, input1, input2)")
             tracker.write(text=map(lambda x: str(x), exp_data.scaling_factors_ip), header="Scaling factors")
             break
+    checkpoint.set_normalization(exp_data)
+    checkpoint.save()
+    tracker.write(text=str(round(get_peak_memory(), 1)), header="Peak memory usage after normalization (MB)")
+    tracker.add_profile(get_profile('normalization', start))
     
+    start = get_usage()
     func, func_para = _fit_mean_var_distr(exp_data.overall_coverage, options.name, options.debug,
                                           verbose=options.verbose, outputdir=options.outputdir,
                                           report=options.report, poisson=options.poisson)
@@ -90,72 +110,196 @@ def train_HMM(region_giver, options, bamfiles, genome, chrom_sizes, dims, inputs
      
     print('Train HMM', file=sys.stderr)
     m.fit([training_set_obs], options.hmm_free_para)
-    distr = _get_pvalue_distr(m.mu, m.alpha, tracker)
+    checkpoint.set_model(m, func_para)
+    checkpoint.save()
+    distr = _get_pvalue_distr(m.mu, m.alpha, tracker, options.name + '-pvalue-table.npz')
+    tracker.add_profile(get_profile('training', start))
          
     return m, exp_data, func_para, init_mu, init_alpha, distr
 
 
-def run_HMM(region_giver, options, bamfiles, genome, chrom_sizes, dims, inputs, tracker, exp_data, m, distr):
-    """Run trained HMM chromosome-wise on genomic signal and call differential peaks"""
-    output, pvalues, ratios, no_bw_files = [], [], [], []
-    print("Compute HMM's posterior probabilities and Viterbi path to call differential peaks", file=sys.stderr)
+def _bigwig_coverage(cov):
+    """Return a CoverageSet with the data of <cov> that is needed to write its bigWig signal"""
+    res = CoverageSet(cov.name, cov.genomicRegions)
+    res.binsize, res.stepsize, res.coverage = cov.binsize, cov.stepsize, cov.coverage
+    return res
+
+
+def _is_same_region(regions1, regions2):
+    """Return whether the GenomicRegionSets <regions1> and <regions2> contain the same regions"""
+    key = lambda regions: [(r.chrom, r.initial, r.final) for r in regions]
+    return key(regions1) == key(regions2)
+
+
+def _decode_chromosome(i):
+    """Return the results of _call_peaks for the i-th chromosome and the profile of its decoding"""
+    start = get_usage()
+    res = _call_peaks(i)
+    stage = 'signal' if i in _DECODE_CONTEXT['done'] else 'decoding'
+    return res + (get_profile(stage, start, _DECODE_CONTEXT['regions'][i].sequences[0].chrom),)
+
+
+def _call_peaks(i):
+    """Compute the signal of the i-th chromosome and call its differential peaks with the trained HMM.
+    Return the peak table as well as the signals and input signals to write to the bigWig files. For chromosomes
+    that are done in the checkpoint, only the signals are computed and the peak table is None."""
+    c = _DECODE_CONTEXT
+    options, norm, r = c['options'], c['norm'], c['regions'][i]
+    print("- taking into account %s" % r.sequences[0].chrom, file=sys.stderr)
     
-    for i, r in enumerate(region_giver):
-        end = True if i == len(region_giver) - 1 else False
-        print("- taking into account %s" % r.sequences[0].chrom, file=sys.stderr)
-        
-        exp_data = initialize(name=options.name, dims=dims, genome_path=genome, regions=r,
-                              stepsize=options.stepsize, binsize=options.binsize,
-                              bamfiles=bamfiles, exts=exp_data.exts, inputs=inputs,
-                              exts_inputs=exp_data.exts_inputs, debug=options.debug,
-                              verbose=False, no_gc_content=options.no_gc_content,
-                              factors_inputs=exp_data.factors_inputs, chrom_sizes=chrom_sizes,
-                              tracker=tracker, norm_regions=options.norm_regions,
-                              scaling_factors_ip=exp_data.scaling_factors_ip, save_wig=options.save_wig,
-                              housekeeping_genes=options.housekeeping_genes, test=TEST, report=False,
-                              chrom_sizes_dict=region_giver.get_chrom_dict(), gc_content_cov=exp_data.gc_content_cov,
-                              avg_gc_content=exp_data.avg_gc_content, gc_hist=exp_data.gc_hist,
-                              end=end, counter=i, m_threshold=options.m_threshold, a_threshold=options.a_threshold,
-                              rmdup=options.rmdup)
-        if exp_data.no_data:
-            continue
-        
-        no_bw_files.append(i)
-        exp_data.compute_putative_region_index()
+    train_data = c['train_data']
+    if train_data is not None and _is_same_region(train_data.genomicRegions, r):
+        data = train_data #signal of the training region is already in memory
+    else:
+        data = initialize(name=options.name, dims=c['dims'], genome_path=c['genome'], regions=r,
+                          stepsize=options.stepsize, binsize=options.binsize,
+                          bamfiles=c['bamfiles'], exts=norm['exts'], inputs=c['inputs'],
+                          exts_inputs=norm['exts_inputs'], debug=options.debug,
+                          verbose=False, no_gc_content=options.no_gc_content,
+                          factors_inputs=norm['factors_inputs'], chrom_sizes=c['chrom_sizes'],
+                          tracker=c['tracker'], norm_regions=options.norm_regions,
+                          scaling_factors_ip=norm['scaling_factors_ip'], save_wig=options.save_wig,
+                          housekeeping_genes=options.housekeeping_genes, test=TEST, report=False,
+                          chrom_sizes_dict=c['chrom_sizes_dict'], gc_content_cov=norm['gc_content_cov'],
+                          avg_gc_content=norm['avg_gc_content'], gc_hist=norm['gc_hist'],
+                          end=i == len(c['regions']) - 1, counter=i, output_bw=False,
+                          m_threshold=options.m_threshold, a_threshold=options.a_threshold, rmdup=options.rmdup,
+                          tmm_sample_size=options.tmm_sample_size)
+    if data.no_data:
+        return np.zeros(0, dtype=peak_dtype(*c['dims'])), [], []
+    
+    covs = [_bigwig_coverage(cov) for cov in data.covs]
+    inputs = [_bigwig_coverage(cov) for cov in data.inputs] if options.save_input else []
+    if i in c['done']:
+        return None, covs, inputs
+    
+    data.compute_putative_region_index()
+    
+    if data.indices_of_interest is None:
+        return np.zeros(0, dtype=peak_dtype(*c['dims'])), covs, inputs
+    
+    states = c['m'].predict(data.get_observation(data.indices_of_interest))
+    
+    peaks = get_peaks(name=options.name, states=states, DCS=data,
+                      distr=c['distr'], merge=options.merge, exts=data.exts, pcutoff=options.pcutoff,
+                      debug=options.debug, p=options.par, no_correction=options.no_correction,
+                      merge_bin=options.merge_bin, deadzones=options.deadzones)
+    return peaks, covs, inputs
 
-        if exp_data.indices_of_interest is None:
-            continue
-        
-        states = m.predict(exp_data.get_observation(exp_data.indices_of_interest))
-        
-        inst_ratios, inst_pvalues, inst_output = get_peaks(name=options.name, states=states, DCS=exp_data,
-                                                           distr=distr, merge=options.merge, exts=exp_data.exts,
-                                                           pcutoff=options.pcutoff, debug=options.debug, p=options.par,
-                                                           no_correction=options.no_correction,
-                                                           merge_bin=options.merge_bin, deadzones=options.deadzones)
-        # if not inst_output:
-        output += inst_output
-        pvalues += inst_pvalues
-        ratios += inst_ratios
-
-    res_output, res_pvalues, res_filter_pass = filter_by_pvalue_strand_lag(ratios, options.pcutoff, pvalues, output,
-                                                                           options.no_correction, options.name,
-                                                                           options.singlestrand)
+
+def _get_fork_context():
+    """Return the multiprocessing context that starts workers by fork, None if the platform cannot fork. The
+    workers inherit _DECODE_CONTEXT, which holds the HMM with its (unpicklable) mean-variance function."""
+    if not hasattr(multiprocessing, 'get_context'):
+        return multiprocessing #Python 2 forks on POSIX systems
+    try:
+        return multiprocessing.get_context('fork')
+    except ValueError:
+        return None
+
+
+def _decode_parallel(indices, jobs):
+    """Yield the results of _decode_chromosome for the chromosomes of <indices> in this order. The chromosomes are
+    decoded by <jobs> forked processes, at most 2*<jobs> chromosomes are pending at once to bound the memory."""
+    pool = _get_fork_context().Pool(processes=jobs, maxtasksperchild=1)
+    pending = deque()
+    try:
+        for i in indices:
+            pending.append(pool.apply_async(_decode_chromosome, (i,)))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def run_HMM(region_giver, options, bamfiles, genome, chrom_sizes, dims, inputs, tracker, norm, m, distr, checkpoint,
+            train_data=None):
+    """Run trained HMM chromosome-wise on genomic signal and call differential peaks. With options.jobs > 1, the
+    chromosomes are decoded in parallel; peaks and bigWig signals are written as soon as a chromosome is decoded,
+    in genome order as in a serial run.
+    The peaks of each chromosome are stored in <checkpoint>. For chromosomes that are done in <checkpoint>, the peaks
+    are taken from the checkpoint and only the signals for the bigWig files are computed.
+    If given, the signal of the training region is taken from the MultiCoverageSet <train_data>."""
+    peak_writer = PeakWriter(options.name, options.pcutoff, options.no_correction, options.singlestrand)
+    print("Compute HMM's posterior probabilities and Viterbi path to call differential peaks", file=sys.stderr)
+    bigwig_writers = get_bigwig_writers(bamfiles, dims, options.name, chrom_sizes)
+    input_bigwig_writers = None
+    if options.save_input and inputs:
+        input_bigwig_writers = get_bigwig_writers(bamfiles, dims, options.name, chrom_sizes, ext='input')
     
-    _output_BED(options.name, res_output, res_pvalues, res_filter_pass)
-    _output_narrowPeak(options.name, res_output, res_pvalues, res_filter_pass)
+    _DECODE_CONTEXT.update(options=options, bamfiles=bamfiles, genome=genome, chrom_sizes=chrom_sizes, dims=dims,
+                           inputs=inputs, tracker=tracker, norm=norm, m=m, distr=distr, train_data=train_data,
+                           regions=list(region_giver), chrom_sizes_dict=region_giver.get_chrom_dict())
+    regions = _DECODE_CONTEXT['regions']
+    _DECODE_CONTEXT['done'] = set(i for i, r in enumerate(regions) if checkpoint.is_done(r))
+    jobs = min(options.jobs, len(regions))
+    if jobs > 1 and _get_fork_context() is None:
+        print("Warning: chromosomes are decoded serially, as processes cannot be forked on this platform",
+              file=sys.stderr)
+        jobs = 1
+    indices = range(len(regions))
+    results = _decode_parallel(indices, jobs) if jobs > 1 else (_decode_chromosome(i) for i in indices)
     
-    merge_output(bamfiles, dims, options, no_bw_files, chrom_sizes)
+    for r in regions:
+        chrom = r.sequences[0].chrom
+        inst_peaks, covs, input_covs, profile = next(results)
+        tracker.add_profile(profile)
+        if checkpoint.is_done(r):
+            print("- peaks of %s are taken from checkpoint" % chrom, file=sys.stderr)
+            inst_peaks = checkpoint.get_region(r)
+        
+        with tracker.profile('output', chrom):
+            for writer, cov in zip(bigwig_writers, covs):
+                writer.add_coverage(cov)
+            for writer, cov in zip(input_bigwig_writers or [], input_covs):
+                writer.add_coverage(cov)
+            if not checkpoint.is_done(r):
+                checkpoint.add_region(r, inst_peaks)
+            peak_writer.add(inst_peaks)
+    _DECODE_CONTEXT.clear()
+    checkpoint.save()
+    
+    with tracker.profile('output'):
+        peak_writer.close()
+        close_bigwig_writers(bigwig_writers + (input_bigwig_writers or []))
+    tracker.write(text=str(round(get_peak_memory(), 1)), header="Peak memory usage (MB)")
 
 
 def main():
+    start = get_usage()
     options, bamfiles, genome, chrom_sizes, dims, inputs = handle_input()
 
     tracker = Tracker(options.name + '-setup.info', bamfiles, genome, chrom_sizes, dims, inputs, options, __version__)
     region_giver = RegionGiver(chrom_sizes, options.regions)
-    m, exp_data, func_para, init_mu, init_alpha, distr = train_HMM(region_giver, options, bamfiles, genome,
-                                                                   chrom_sizes, dims, inputs, tracker)
+    checkpoint_file = options.name + '-checkpoint.json'
+    fingerprint = get_fingerprint(options, bamfiles, genome, dims, inputs)
+    try:
+        checkpoint = Checkpoint.load(checkpoint_file, fingerprint) if options.resume \
+            else Checkpoint(checkpoint_file, fingerprint)
+    except ValueError as e:
+        print("Error: cannot resume: %s" % e, file=sys.stderr)
+        sys.exit(1)
+    
+    train_data = None
+    if checkpoint.has('model'):
+        print('Use HMM of checkpoint %s' % checkpoint_file, file=sys.stderr)
+        m, func_para = checkpoint.get_model()
+        norm = checkpoint.get_normalization()
+        init_mu, init_alpha = None, None
+        distr = _get_pvalue_distr(m.mu, m.alpha, tracker, options.name + '-pvalue-table.npz')
+    else:
+        m, exp_data, func_para, init_mu, init_alpha, distr = train_HMM(region_giver, options, bamfiles, genome,
+                                                                       chrom_sizes, dims, inputs, tracker, checkpoint)
+        norm = _get_normalization(exp_data)
+        if exp_data.gc_content_cov is None:
+            train_data = exp_data #the GC-content correction is only applied to the training region
     
-    run_HMM(region_giver, options, bamfiles, genome, chrom_sizes, dims, inputs, tracker, exp_data, m, distr)
+    run_HMM(region_giver, options, bamfiles, genome, chrom_sizes, dims, inputs, tracker, norm, m, distr, checkpoint,
+            train_data)
     
     _write_info(tracker, options.report, func_para=func_para, init_mu=init_mu, init_alpha=init_alpha, m=m)
+    tracker.add_profile(get_profile('total', start))
+    tracker.write_profile(options.name + '-profile.json')
@@ -27,8 +27,9 @@ import sys
 import string
 import numpy as np
 from scipy.stats import binom
+from scipy.special import gammaln, xlogy, xlog1py, logsumexp
 from hmmlearn.hmm import _BaseHMM
-from help_hmm import _valid_posteriors
+from .help_hmm import _valid_posteriors
 
 def get_init_parameters(s1, s2, **info):
     n_ = np.array([info['count'], info['count']])
@@ -66,27 +67,91 @@ class BinomialHMM(_BaseHMM):
         self.n_features = 2 #emission dimension
         self.init_state_seq = init_state_seq
         self.count_s1, self.count_s2 = 0, 0
-        self.lookup_logpmf = {}
+        self.lookup_log_binom = {}
+
+    def fit(self, obs, lengths=None):
+        """Estimate model parameters with EM.
+
+        Parameters
+        ----------
+        obs : list
+            List of array-like observation sequences, each of which
+            has shape (n_i, n_features), where n_i is the length of
+            the i_th observation.
+        lengths : list, optional
+            If given, <obs> is one array of the concatenated observation
+            sequences and <lengths> gives the length n_i of each of them.
+
+        Notes
+        -----
+        All sequences are handled as one batch: the emissions and the
+        sufficient statistics of the emissions are computed on the
+        concatenated sequences.
+        """
+        if lengths is not None:
+            obs = np.split(np.asarray(obs), np.cumsum(lengths)[:-1])
+        X = np.concatenate([np.asarray(seq) for seq in obs])
+        bounds = np.cumsum([0] + [len(seq) for seq in obs])
+
+        self._init(obs, self.init_params)
+
+        logprob = []
+        for i in range(self.n_iter):
+            # Expectation step
+            stats = self._initialize_sufficient_statistics()
+            curr_logprob = 0
+            all_framelogprob = self._compute_log_likelihood(X)
+            all_posteriors = np.zeros(all_framelogprob.shape)
+            for k, seq in enumerate(obs):
+                framelogprob = all_framelogprob[bounds[k]:bounds[k + 1]]
+                lpr, fwdlattice = self._do_forward_pass(framelogprob)
+                bwdlattice = self._do_backward_pass(framelogprob)
+                gamma = fwdlattice + bwdlattice
+                posteriors = np.exp(gamma.T - logsumexp(gamma, axis=1)).T
+                curr_logprob += lpr
+                super(BinomialHMM, self)._accumulate_sufficient_statistics(
+                    stats, seq, framelogprob, posteriors, fwdlattice,
+                    bwdlattice)
+                all_posteriors[bounds[k]:bounds[k + 1]] = posteriors
+            all_posteriors = _valid_posteriors(all_posteriors, X, self.dim)
+            self._help_accumulate_sufficient_statistics(X, stats, all_posteriors)
+            logprob.append(curr_logprob)
+
+            # Check for convergence.
+            if i > 0 and logprob[-1] - logprob[-2] < self.tol:
+                break
+
+            # Maximization step
+            self._do_mstep(stats)
+        return self
+
+    def _get_log_binom(self, n):
+        """Return log binomial coefficients log(<n> choose k) for k = 0..<n>, cached for each total count <n>"""
+        n = int(n)
+        if n not in self.lookup_log_binom:
+            k = np.arange(n + 1)
+            self.lookup_log_binom[n] = gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+        return self.lookup_log_binom[n]
 
     def _compute_log_likelihood(self, X):
-        res = []
+        """Return the log-likelihood of each observation (rows) for each HMM state (columns), that is the sum of the
+        binomial log-pmfs of the replicates. The binomial coefficients do not depend on the state, the success
+        probabilities enter with the summed up counts of each condition."""
+        X = np.asarray(X, dtype=int)
+        matrix = np.zeros((len(X), self.n_components))
+        valid = np.ones(len(X), dtype=bool)
         
-        for x in X: #over all observations
-            row = []
-            for i in range(self.n_components): #over number of HMM's state
-                r_sum = 0
-                for j in range(self.n_features): #over dim
-                    it = range(self.dim[0]) if j == 0 else range(self.dim[0], self.dim[0] + self.dim[1]) #grab proper observation
-                    for k in it:
-                        index = (int(x[k]), self.p[j][i], self.n[j])
-                        if not self.lookup_logpmf.has_key( index ):
-                            self.lookup_logpmf[index] = binom.logpmf(x[k], self.n[j], self.p[j][i])
-                        r_sum += self.lookup_logpmf[index]
-                row.append(r_sum)
+        for j in range(self.n_features): #over dim
+            cols = slice(0, self.dim[0]) if j == 0 else slice(self.dim[0], self.dim[0] + self.dim[1]) #grab proper ob
+            obs, n = X[:, cols], int(self.n[j])
+            p = np.asarray(self.p[j], dtype=float)[:self.n_components]
+            valid &= ((obs >= 0) & (obs <= n)).all(axis=1)
+            k = obs.sum(axis=1)[:, np.newaxis]
+            matrix += self._get_log_binom(n)[np.clip(obs, 0, n)].sum(axis=1)[:, np.newaxis]
+            matrix += xlogy(k, p) + xlog1py(n * obs.shape[1] - k, -p)
         
-            res.append(row)
-        
-        return np.asarray(res)
+        matrix[~valid] = -np.inf
+        return matrix
     
 
     def _generate_sample_from_state(self, state, random_state=None):
@@ -104,12 +169,13 @@ class BinomialHMM(_BaseHMM):
         return stats
     
     def _help_accumulate_sufficient_statistics(self, obs, stats, posteriors):
-        for t, symbol in enumerate(obs):
-            pot_it = [range(self.dim[0]), range(self.dim[0], self.dim[0] + self.dim[1])] #consider both classes
-            for j, it in enumerate(pot_it):
-                for i in it:
-                    stats['post'] += posteriors[t]
-                    stats['post_emission'][j] += posteriors[t] * symbol[i]
+        """Add the posterior weights of all replicates and the posterior weighted counts of each condition"""
+        obs = np.asarray(obs, dtype=float)
+        counts = [obs[:, :self.dim[0]].sum(axis=1), obs[:, self.dim[0]:self.dim[0] + self.dim[1]].sum(axis=1)]
+        
+        stats['post'] += posteriors.sum(axis=0) * sum(self.dim)
+        for j in range(self.n_features):
+            stats['post_emission'][j] += np.dot(counts[j], posteriors)
             
         stats['posterior'] = np.copy(posteriors)
         
@@ -123,15 +189,12 @@ class BinomialHMM(_BaseHMM):
         posteriors = _valid_posteriors(posteriors, obs, self.dim)
         self._help_accumulate_sufficient_statistics(obs, stats, posteriors)
 
-    def _add_pseudo_counts(arr):
+    def _add_pseudo_counts(self, arr):
+        """Return <arr> with values of at least 1e-323"""
         if type(arr) is np.ndarray:
-            tmp = np.array([1e-323 if x < 1e-323 else x for x in arr], np.float64)
-            # tmp2 = np.array([1.0 - 1.0e-5 if x == 1.0 else x for x in tmp], np.float64)
-            return tmp
+            return np.maximum(arr, 1e-323).astype(np.float64)
         else:
-            tmp = 1e-323 if arr < 1e-323 else arr
-            # tmp2 = 1.0 - 1.0e-10 if tmp == 1.0 else tmp
-            return tmp
+            return 1e-323 if arr < 1e-323 else arr
 
     def _help_do_mstep(self, stats):
         for i in range(self.n_features):
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+THOR detects differential peaks in multiple ChIP-seq profiles associated
+with two distinct biological conditions.
+
+Copyright (C) 2014-2016 Manuel Allhoff (allhoff@aices.rwth-aachen.de)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Checkpoint of a THOR run.
+
+The checkpoint is a JSON file that is written after each stage of THOR:
+
+- fingerprint: input files and options of the run, a run is resumed only with the same fingerprint
+- normalization: extension sizes, scaling factors and input factors
+- model: parameters of the mean-variance functions and of the HMM
+- regions: keys of the decoded regions
+
+The peak table of each decoded region is stored as NumPy file <key>.npy in the directory <name>-checkpoint next to
+the checkpoint <name>-checkpoint.json. A region file is written completely before it is renamed to its final name,
+so each region file in the directory belongs to a decoded region, even if the JSON file was not saved afterwards.
+
+@author: Manuel Allhoff
+"""
+
+from __future__ import print_function
+import os
+import json
+import numpy as np
+from os.path import isfile, isdir, join, splitext
+
+from .neg_bin_rep_hmm import NegBinRepHMM
+from .dpc_help import _func_quad_2p
+from .postprocessing import peak_dtype
+
+CHECKPOINT_VERSION = 3
+
+#options that change normalization, HMM or peaks of a run
+FINGERPRINT_OPTIONS = ['binsize', 'stepsize', 'exts', 'exts_inputs', 'factors_inputs', 'scaling_factors_ip',
+                       'no_gc_content', 'norm_regions', 'housekeeping_genes', 'rmdup', 'm_threshold', 'a_threshold',
+                       'tmm_sample_size', 'poisson', 'foldchange', 'threshold', 'size_ts', 'hmm_free_para',
+                       'pcutoff', 'par', 'no_correction', 'merge', 'merge_bin', 'deadzones', 'singlestrand']
+FINGERPRINT_FILES = ['norm_regions', 'housekeeping_genes', 'deadzones']
+
+
+def get_fingerprint(options, bamfiles, genome, dims, inputs):
+    """Return the input files and the options of a THOR run that determine its results. Call it before
+    training, as train_HMM overwrites the options with the normalization of the checkpoint."""
+    path = lambda f: os.path.abspath(f) if f else f
+    fingerprint = {'bamfiles': [path(f) for f in bamfiles], 'inputs': [path(f) for f in inputs or []],
+                   'genome': path(genome), 'dims': list(dims)}
+    for k in FINGERPRINT_OPTIONS:
+        fingerprint[k] = path(getattr(options, k)) if k in FINGERPRINT_FILES else getattr(options, k)
+    return json.loads(json.dumps(fingerprint)) #as stored in the JSON file
+
+
+def _get_normalization(exp_data):
+    """Return the normalization of MultiCoverageSet <exp_data> that is needed to compute further signals"""
+    return {'exts': exp_data.exts, 'exts_inputs': exp_data.exts_inputs, 'factors_inputs': exp_data.factors_inputs,
+            'scaling_factors_ip': exp_data.scaling_factors_ip, 'gc_content_cov': exp_data.gc_content_cov,
+            'avg_gc_content': exp_data.avg_gc_content, 'gc_hist': exp_data.gc_hist}
+
+
+def _to_list(x):
+    """Return lists of numbers for numpy arrays, lists of arrays or numbers"""
+    if x is None:
+        return None
+    if isinstance(x, (list, tuple)):
+        return [_to_list(el) for el in x]
+    return np.asarray(x).tolist()
+
+
+def _region_key(region):
+    """Return key of the GenomicRegionSet <region> with one region"""
+    r = region.sequences[0]
+    return '%s_%s_%s' % (r.chrom, r.initial, r.final)
+
+
+def _save_peaks(filename, peaks):
+    """Write the peak table <peaks> to the NumPy file <filename>, the object columns are stored as strings"""
+    descr = []
+    for field in peaks.dtype.descr:
+        if np.dtype(field[1]) == object:
+            field = (field[0], 'U%s' % max([1] + [len(x) for x in peaks[field[0]]]))
+        descr.append(field)
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, peaks.astype(descr))
+    os.rename(tmp, filename)
+
+
+def _load_peaks(filename, dim_1, dim_2):
+    """Return the peak table stored in <filename> by _save_peaks"""
+    data = np.load(filename)
+    peaks = np.zeros(len(data), dtype=peak_dtype(dim_1, dim_2))
+    for name in peaks.dtype.names:
+        peaks[name] = data[name].tolist() if peaks.dtype[name] == object else data[name]
+    return peaks
+
+
+class Checkpoint:
+    """Versioned checkpoint of a THOR run stored in <filename>, <fingerprint> is given by get_fingerprint. A new
+    checkpoint removes the region files of an earlier run."""
+
+    def __init__(self, filename, fingerprint, data=None):
+        self.filename = filename
+        self.region_dir = splitext(filename)[0]
+        if data is None:
+            data = {'version': CHECKPOINT_VERSION, 'fingerprint': fingerprint, 'regions': []}
+            if isdir(self.region_dir):
+                for f in os.listdir(self.region_dir):
+                    os.remove(join(self.region_dir, f))
+        self.data = data
+        self.done = set(data['regions'])
+
+    @classmethod
+    def load(cls, filename, fingerprint):
+        """Return the checkpoint of <filename>, an empty checkpoint if the file does not exist. Raise ValueError
+        if the checkpoint belongs to a run with another version or another fingerprint."""
+        if not isfile(filename):
+            return cls(filename, fingerprint)
+        with open(filename) as f:
+            data = json.load(f)
+        if data.get('version') != CHECKPOINT_VERSION:
+            raise ValueError("Checkpoint %s has version %s, expected version %s"
+                             % (filename, data.get('version'), CHECKPOINT_VERSION))
+        stored = data['fingerprint']
+        changed = sorted(k for k in set(stored) | set(fingerprint) if stored.get(k) != fingerprint.get(k))
+        if changed:
+            raise ValueError("Checkpoint %s belongs to a run with other input files or options (%s)"
+                             % (filename, ", ".join(changed)))
+        checkpoint = cls(filename, fingerprint, data)
+        if isdir(checkpoint.region_dir): #including the regions that were decoded after the last save
+            checkpoint.done = set(splitext(f)[0] for f in os.listdir(checkpoint.region_dir) if f.endswith('.npy'))
+        return checkpoint
+
+    def save(self):
+        """Write checkpoint, the previous checkpoint is replaced only if writing succeeds"""
+        self.data['regions'] = sorted(self.done)
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f)
+        os.rename(tmp, self.filename)
+
+    def has(self, stage):
+        """Return whether the stage 'normalization' or 'model' is done"""
+        return stage in self.data
+
+    def set_normalization(self, exp_data):
+        """Store extension sizes and normalization factors of MultiCoverageSet <exp_data>"""
+        norm = _get_normalization(exp_data)
+        self.data['normalization'] = dict((k, _to_list(norm[k])) for k in
+                                          ['exts', 'exts_inputs', 'factors_inputs', 'scaling_factors_ip',
+                                           'avg_gc_content', 'gc_hist'])
+
+    def get_normalization(self):
+        """Return normalization as _get_normalization. The GC-content of the training bins is not stored, as it
+        only indicates that the GC-content does not have to be computed for further signals."""
+        norm = dict(self.data['normalization'])
+        norm['gc_content_cov'] = [] if norm['avg_gc_content'] is not None else None
+        return norm
+
+    def set_model(self, m, func_para):
+        """Store HMM <m> and the parameters <func_para> of its mean-variance functions"""
+        self.data['model'] = {'func_para': _to_list(func_para), 'dims': m.dim, 'mu': _to_list(m.mu),
+                              'alpha': _to_list(m.alpha), 'startprob': _to_list(m.startprob_),
+                              'transmat': _to_list(m.transmat_)}
+
+    def get_model(self):
+        """Return the stored HMM and the parameters of its mean-variance functions"""
+        d = self.data['model']
+        p = d['func_para'][-1]
+        m = NegBinRepHMM(alpha=np.matrix(d['alpha']), mu=np.matrix(d['mu']), dim_cond_1=d['dims'][0],
+                         dim_cond_2=d['dims'][1], func=lambda x: _func_quad_2p(x, p[0], p[1]))
+        m.startprob_ = np.array(d['startprob'])
+        m.transmat_ = np.array(d['transmat'])
+        return m, [np.array(el) for el in d['func_para']]
+
+    def is_done(self, region):
+        """Return whether GenomicRegionSet <region> is decoded"""
+        return _region_key(region) in self.done
+
+    def add_region(self, region, peaks):
+        """Write the peak table of the decoded GenomicRegionSet <region> to its region file. The key of the region
+        is added to the JSON file by the next save()."""
+        if not isdir(self.region_dir):
+            os.mkdir(self.region_dir)
+        key = _region_key(region)
+        _save_peaks(join(self.region_dir, key + '.npy'), peaks)
+        self.done.add(key)
+
+    def get_region(self, region):
+        """Return the peak table of the decoded GenomicRegionSet <region>, read from its region file"""
+        dims = self.data['model']['dims']
+        return _load_peaks(join(self.region_dir, _region_key(region) + '.npy'), dims[0], dims[1])
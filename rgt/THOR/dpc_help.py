@@ -15,22 +15,23 @@ conditions. Please see LICENSE file for details.
 from __future__ import print_function
 import os
 import sys
+import resource
 import pysam
 import numpy as np
 from math import fabs, log, ceil
-from operator import add
 from os.path import splitext, basename, join, isfile, isdir, exists
 from optparse import OptionParser, OptionGroup
 from datetime import datetime
 
 # Internal
-from ..THOR.postprocessing import merge_delete, filter_deadzones
+from ..THOR.postprocessing import merge_delete, filter_deadzones, peak_dtype, get_log_ratios
 from .MultiCoverageSet import MultiCoverageSet
 from ..GenomicRegionSet import GenomicRegionSet
+from ..CoverageSet import BigWigWriter
 from ..THOR.get_extension_size import get_extension_size
-from ..THOR.get_fast_gen_pvalue import get_log_pvalue_new
+from ..THOR.get_fast_gen_pvalue import get_log_pvalues
 from .input_parser import input_parser
-from ..Util import which, npath
+from ..Util import npath
 from .. import __version__
 
 # External
@@ -46,36 +47,29 @@ FOLDER_REPORT = None
 np.random.seed(42)
 
 
-def merge_output(bamfiles, dims, options, no_bw_files, chrom_sizes):
+def get_bigwig_writers(bamfiles, dims, name, chrom_sizes, ext=''):
+    """Return one BigWigWriter for each BAM file. The signals of all chromosomes are streamed into
+    the file <name>[-<ext>]-s<sig>-rep<rep>.bw"""
+    writers = []
     for i in range(len(bamfiles)):
         rep = i if i < dims[0] else i - dims[0]
         sig = 1 if i < dims[0] else 2
+        prefix = name + '-' + ext if ext else name
+        writers.append(BigWigWriter(prefix + '-s%s-rep%s.bw' % (sig, rep), chrom_sizes))
+    return writers
 
-        temp_bed = npath(options.name + '-s%s-rep%s_temp.bed' % (sig, rep))
 
-        files = [options.name + '-' + str(j) + '-s%s-rep%s.bw' %(sig, rep) for j in no_bw_files]
-        if len(no_bw_files) > len(bamfiles):
-            files = filter(lambda x: isfile(x), files)
-            t = ['bigWigMerge'] + files + [temp_bed]
-            c = " ".join(t)
-            os.system(c)
+def close_bigwig_writers(writers):
+    """Finalize the bigWig files of <writers>"""
+    for writer in writers:
+        writer.close()
 
-            os.system("LC_COLLATE=C sort -k1,1 -k2,2n " + temp_bed + ' > ' + temp_bed +'.sort')
 
-            t = ['bedGraphToBigWig', temp_bed + '.sort', chrom_sizes, options.name + '-s%s-rep%s.bw' % (sig, rep)]
-            c = " ".join(t)
-            os.system(c)
-
-            for f in files:
-                os.remove(f)
-            os.remove(temp_bed)
-            os.remove(temp_bed + ".sort")
-        else:
-            ftarget = [options.name + '-s%s-rep%s.bw' %(sig, rep) for j in no_bw_files]
-            for i in range(len(ftarget)):
-                c = ['mv', files[i], ftarget[i]]
-                c = " ".join(c)
-                os.system(c)
+def get_peak_memory():
+    """Return the peak resident memory (MB) of THOR and its finished worker processes"""
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return usage / 1024.0 ** (2 if sys.platform == 'darwin' else 1) #bytes on macOS, kilobytes on Linux
 
 
 def _func_quad_2p(x, a, c):
@@ -223,65 +217,28 @@ def dump_posteriors_and_viterbi(name, posteriors, DCS, states):
     g.close()
 
 
-def _compute_pvalue((x, y, side, distr)):
-    a, b = int(np.mean(x)), int(np.mean(y))
-    return -get_log_pvalue_new(a, b, side, distr)
-
-
-def _get_log_ratio(l1, l2):
-    l1, l2 = float(np.sum(np.array(l1))), float(np.sum(np.array(l2)))
-    try:
-        res = l1/l2
-    except:
-        return sys.maxint
-    
-    if res > 0:
-        try:
-            res = log(res)
-            if np.isinf(res):
-                return sys.maxint
-            return res
-        except:
-            print('error to compute log ratio', l1, l2, file=sys.stderr)
-            return sys.maxint
+def _merge_consecutive_bins(bins, strands, cov1, cov2, pos, neg, distr, breaks, merge=True):
+    """Merge consecutive bins with the same strand and compute p-value. Bins are not merged over <breaks> (indices
+    of bins that start a new region). Return the first bin of each peak, the index of its last bin in <bins>,
+    the coverage sums (#replicates X #peaks) <v1>, <v2>, the reads on the positive and negative strand and the
+    p-values"""
+    if merge:
+        start = np.flatnonzero(np.diff(bins) != 1) + 1
+        start = np.union1d(start, np.flatnonzero(np.diff(strands) != 0) + 1)
+        start = np.union1d(start, np.flatnonzero(np.diff(np.searchsorted(breaks, bins, side='right')) != 0) + 1)
+        start = np.concatenate(([0], start)).astype(int)
     else:
-        return sys.maxint
-
-def _merge_consecutive_bins(tmp_peaks, distr, merge=True):
-    """Merge consecutive peaks and compute p-value. Return list
-    <(chr, s, e, c1, c2, strand)> and <(pvalue)>"""
-    peaks = []
-    pvalues = []
-    i, j, = 0, 0
-
-    while i < len(tmp_peaks):
-        j+=1
-        c, s, e, c1, c2, strand, strand_pos, strand_neg = tmp_peaks[i]
-        v1 = c1
-        v2 = c2
-
-        tmp_pos = [strand_pos]
-        tmp_neg = [strand_neg]
-        #merge bins
-        while merge and i+1 < len(tmp_peaks) and e == tmp_peaks[i+1][1] and strand == tmp_peaks[i+1][5]:
-            e = tmp_peaks[i+1][2]
-            v1 = map(add, v1, tmp_peaks[i+1][3])
-            v2 = map(add, v2, tmp_peaks[i+1][4])
-            tmp_pos.append(tmp_peaks[i+1][6])
-            tmp_neg.append(tmp_peaks[i+1][7])
-            i += 1
-
-        side = 'l' if strand == '+' else 'r'
-        pvalues.append((v1, v2, side, distr))
-
-        ratio = _get_log_ratio(tmp_pos, tmp_neg)
-        peaks.append((c, s, e, v1, v2, strand, ratio))
-        i += 1
-
-    pvalues = map(_compute_pvalue, pvalues)
-    assert len(pvalues) == len(peaks)
-
-    return pvalues, peaks
+        start = np.arange(len(bins))
+    last = np.append(start[1:], len(bins)) - 1
+    
+    v1 = np.add.reduceat(cov1, start, axis=1)
+    v2 = np.add.reduceat(cov2, start, axis=1)
+    pos, neg = np.add.reduceat(pos, start), np.add.reduceat(neg, start)
+    
+    side = np.where(strands[start] == 1, 'l', 'r')
+    pvalues = -get_log_pvalues(np.mean(v1, axis=0).astype(int), np.mean(v2, axis=0).astype(int), side, distr)
+
+    return start, last, v1, v2, pos, neg, pvalues
     
 
 def _get_covs(DCS, i, as_list=False):
@@ -290,71 +247,54 @@ def _get_covs(DCS, i, as_list=False):
         cov1 = int(np.mean(DCS.overall_coverage[0][:, DCS.indices_of_interest[i]]))
         cov2 = int(np.mean(DCS.overall_coverage[1][:, DCS.indices_of_interest[i]]))
     else:
-        cov1 = DCS.overall_coverage[0][:,DCS.indices_of_interest[i]]
-        cov1 = map(lambda x: x[0], np.asarray((cov1)))
-        cov2 = DCS.overall_coverage[1][:,DCS.indices_of_interest[i]]
-        cov2 = map(lambda x: x[0], np.asarray((cov2)))
+        cov1 = DCS.overall_coverage[0][:, DCS.indices_of_interest[i]].tolist()
+        cov2 = DCS.overall_coverage[1][:, DCS.indices_of_interest[i]].tolist()
     
     return cov1, cov2
 
 
 def get_peaks(name, DCS, states, exts, merge, distr, pcutoff, debug, no_correction, deadzones, merge_bin, p=70):
-    """Merge Peaks, compute p-value and give out *.bed and *.narrowPeak"""
+    """Merge Peaks, compute p-value and return the peak table (see postprocessing.peak_dtype)"""
     exts = np.mean(exts)
-    tmp_peaks = []
-    tmp_data = []
     
-    for i in range(len(DCS.indices_of_interest)):
-        if states[i] not in [1,2]:
-            continue #ignore background states
-
-        strand = '+' if states[i] == 1 else '-'
-        cov1, cov2 = _get_covs(DCS, i, as_list=True)
-        
-        cov1_strand = np.sum(DCS.overall_coverage_strand[0][0][:,DCS.indices_of_interest[i]]) + np.sum(DCS.overall_coverage_strand[1][0][:,DCS.indices_of_interest[i]])
-        cov2_strand = np.sum(DCS.overall_coverage_strand[0][1][:,DCS.indices_of_interest[i]] + DCS.overall_coverage_strand[1][1][:,DCS.indices_of_interest[i]])
-        
-        chrom, start, end = DCS._index2coordinates(DCS.indices_of_interest[i])
-        
-        tmp_peaks.append((chrom, start, end, cov1, cov2, strand, cov1_strand, cov2_strand))
-        side = 'l' if strand == '+' else 'r'
-        tmp_data.append((sum(cov1), sum(cov2), side, distr))
-    
-    if not tmp_data:
+    states = np.asarray(states)
+    sel = np.flatnonzero((states == 1) | (states == 2)) #ignore background states
+    if not len(sel):
         print('no data', file=sys.stderr)
-        return [], [], []
+        return np.zeros(0, dtype=peak_dtype(DCS.dim_1, DCS.dim_2))
     
-    tmp_pvalues = map(_compute_pvalue, tmp_data)
-    per = np.percentile(tmp_pvalues, p)
+    bins = np.asarray(DCS.indices_of_interest)[sel]
+    strands = states[sel]
+    cov1 = DCS.overall_coverage[0][:, bins]
+    cov2 = DCS.overall_coverage[1][:, bins]
+    pos = DCS.overall_coverage_strand[0][0][:, bins].sum(axis=0) + DCS.overall_coverage_strand[1][0][:, bins].sum(axis=0)
+    neg = DCS.overall_coverage_strand[0][1][:, bins].sum(axis=0) + DCS.overall_coverage_strand[1][1][:, bins].sum(axis=0)
     
-    tmp = []
-    res = tmp_pvalues > per
-    for j in range(len(res)):
-        if res[j]:
-            tmp.append(tmp_peaks[j])
-    tmp_peaks = tmp
-
-    pvalues, peaks, = _merge_consecutive_bins(tmp_peaks, distr, merge_bin) #merge consecutive peaks and compute p-value
-    regions = merge_delete(exts, merge, peaks, pvalues) #postprocessing, returns GenomicRegionSet with merged regions
+    side = np.where(strands == 1, 'l', 'r')
+    tmp_pvalues = -get_log_pvalues(cov1.sum(axis=0), cov2.sum(axis=0), side, distr)
+    keep = tmp_pvalues > np.percentile(tmp_pvalues, p)
+    bins, strands, cov1, cov2, pos, neg = bins[keep], strands[keep], cov1[:, keep], cov2[:, keep], pos[keep], neg[keep]
+    
+    #merge consecutive peaks and compute p-value
+    breaks = DCS.offsets[1:]
+    start, last, v1, v2, pos, neg, pvalues = _merge_consecutive_bins(bins, strands, cov1, cov2, pos, neg, distr,
+                                                                     breaks, merge_bin)
+    
+    peaks = np.zeros(len(start), dtype=peak_dtype(DCS.dim_1, DCS.dim_2))
+    peaks['chrom'], peaks['start'], _ = DCS._indices2coordinates(bins[start])
+    peaks['end'] = DCS._indices2coordinates(bins[last])[2]
+    peaks['strand'] = np.where(strands[start] == 1, '+', '-')
+    peaks['counts1'], peaks['counts2'] = v1.T, v2.T
+    peaks['pos'], peaks['neg'] = pos, neg
+    peaks['pvalue'] = pvalues
+    peaks['ratio'] = get_log_ratios(pos, neg)
+    
+    peaks = merge_delete(exts, merge, peaks) #postprocessing, returns sorted and merged peaks
 
     if deadzones:
-        regions = filter_deadzones(deadzones, regions)
-    output = []
-    pvalues = []
-    ratios = []
-    main_sep = ':' #sep <counts> main_sep <counts> main_sep <pvalue>
-    int_sep = ';' #sep counts in <counts>
+        peaks = filter_deadzones(deadzones, peaks)
     
-    for i, el in enumerate(regions):
-        tmp = el.data.split(',')
-        counts = ",".join(tmp[0:len(tmp)-1]).replace('], [', int_sep).replace('], ', int_sep).replace('([', '').replace(')', '').replace(', ', main_sep)
-        pvalue = float(tmp[len(tmp)-2].replace(")", "").strip())
-        ratio = float(tmp[len(tmp)-1].replace(")", "").strip())
-        pvalues.append(pvalue)
-        ratios.append(ratio)
-        output.append((el.chrom, el.initial, el.final, el.orientation, counts))
-    
-    return ratios, pvalues, output
+    return peaks
 
 
 def _output_ext_data(ext_data_list, bamfiles):
@@ -420,7 +360,8 @@ def initialize(name, dims, genome_path, regions, stepsize, binsize, bamfiles, ex
                inputs, exts_inputs, factors_inputs, chrom_sizes, verbose, no_gc_content, \
                tracker, debug, norm_regions, scaling_factors_ip, save_wig, housekeeping_genes, \
                test, report, chrom_sizes_dict, counter, end, gc_content_cov=None, avg_gc_content=None, \
-               gc_hist=None, output_bw=True, save_input=False, m_threshold=80, a_threshold=95, rmdup=False):
+               gc_hist=None, output_bw=True, save_input=False, m_threshold=80, a_threshold=95, rmdup=False, \
+               tmm_sample_size=None):
     """Initialize the MultiCoverageSet"""
     regionset = regions
     regionset.sequences.sort()
@@ -443,7 +384,8 @@ def initialize(name, dims, genome_path, regions, stepsize, binsize, bamfiles, ex
                                      tracker=tracker, gc_content_cov=gc_content_cov, avg_gc_content=avg_gc_content,
                                      gc_hist=gc_hist, end=end, counter=counter, output_bw=output_bw,
                                      folder_report=FOLDER_REPORT, report=report, save_input=save_input,
-                                     m_threshold=m_threshold, a_threshold=a_threshold)
+                                     m_threshold=m_threshold, a_threshold=a_threshold,
+                                     tmm_sample_size=tmm_sample_size)
     return multi_cov_set
 
 
@@ -535,8 +477,18 @@ def handle_input():
                      help="Define the M threshold of percentile for training TMM. [default: %default]")
     group.add_option("--a_threshold", default=95, dest="a_threshold", type="int",
                      help="Define the A threshold of percentile for training TMM. [default: %default]")
+    group.add_option("--tmm-sample-size", default=None, dest="tmm_sample_size", type="int",
+                     help="Sample at most this number of bins with coverage for TMM normalization, all bins if not "
+                          "given. [default: %default]")
     group.add_option("--rmdup", default=False, dest="rmdup", action="store_true",
                      help="Remove the duplicate reads [default: %default]")
+    group.add_option("--jobs", default=1, dest="jobs", type="int",
+                     help="Number of chromosomes that are decoded in parallel. [default: %default]")
+    group.add_option("--resume", default=False, dest="resume", action="store_true",
+                     help="Resume the run of the experiment --name from its checkpoint file <name>-checkpoint.json, "
+                          "skip normalization, HMM training and the decoding of chromosomes that are done. The "
+                          "input files and options have to be the same as in the checkpointed run. With a new "
+                          "region file, the trained HMM decodes the new regions. [default: %default]")
     parser.add_option_group(group)
 
     (options, args) = parser.parse_args()
@@ -563,6 +515,15 @@ def handle_input():
     if not genome:
         options.no_gc_content = True
 
+    if options.jobs < 1:
+        parser.error("Number of jobs must be at least 1")
+
+    if options.tmm_sample_size is not None and options.tmm_sample_size < 1:
+        parser.error("TMM sample size must be at least 1")
+
+    if options.resume and options.name is None:
+        parser.error("Please give the name (--name) of the experiment to resume")
+
     if options.exts and len(options.exts) != len(bamfiles):
         parser.error("Number of Extension Sizes must equal number of bamfiles")
 
@@ -599,13 +560,9 @@ def handle_input():
         d = str(datetime.now()).replace("-", "_").replace(":", "_").replace(" ", "_").replace(".", "_").split("_")
         options.name = "THOR-exp" + "-" + "_".join(d[:len(d) - 1])
 
-    if not which("wigToBigWig") or not which("bedGraphToBigWig") or not which("bigWigMerge"):
-        print("Warning: wigToBigWig, bigWigMerge or bedGraphToBigWig not found! Signal will not be stored!",
-              file=sys.stderr)
-
     if options.outputdir:
         options.outputdir = npath(options.outputdir)
-        if isdir(options.outputdir) and sum(
+        if not options.resume and isdir(options.outputdir) and sum(
                 map(lambda x: x.startswith(options.name), os.listdir(options.outputdir))) > 0:
             parser.error("Output directory exists and contains files with names starting with your chosen experiment "
                          "name! Do nothing to prevent file overwriting!")
@@ -616,12 +573,12 @@ def handle_input():
 
     options.name = join(options.outputdir, options.name)
 
-    if options.report and isdir(join(options.outputdir, 'report_'+basename(options.name))):
+    if options.report and not options.resume and isdir(join(options.outputdir, 'report_'+basename(options.name))):
         parser.error("Folder 'report_"+basename(options.name)+"' already exits in output directory!" 
                      "Do nothing to prevent file overwriting! "
                      "Please rename report folder or change working directory of THOR with the option --output-dir")
 
-    if options.report:
+    if options.report and not isdir(join(options.outputdir, 'report_'+basename(options.name))):
         os.mkdir(join(options.outputdir, 'report_'+basename(options.name)+"/"))
         os.mkdir(join(options.outputdir, 'report_'+basename(options.name), 'pics/'))
         os.mkdir(join(options.outputdir, 'report_'+basename(options.name), 'pics/data/'))
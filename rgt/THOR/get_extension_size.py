@@ -21,7 +21,8 @@ Estimate extension size of reads for an ChIP-seq experiment.
 Author: Manuel Allhoff
 
 Calculate the cross correlation between coverage of forward and backward reads
-on first chromosome.
+on blocks sampled from all chromosomes. The sample covers at least the largest
+chromosome with reads and is enlarged until it contains about MIN_READS reads.
 Methods is based on:
 
 Kharchenko et al., Design and analysis of ChIP-seq experiments for DNA-binding
@@ -38,14 +39,10 @@ Return shift/extension size of reads descriebed by BAM file.
 
 from __future__ import print_function
 import pysam
+import numpy as np
 
-cov_f = {}
-cov_r = {}
-
-
-def get_value(d, x):
-    """Return d[x] of dictionary d or 0"""
-    return d[x] if d.has_key(x) else 0
+SLOT_SIZE = 2 ** 17 #size of a sampled block including zero padding
+MIN_READS = 10 ** 6 #number of reads the sample should contain at least
 
 
 def get_read_size(filename):
@@ -65,52 +62,95 @@ def get_read_size(filename):
     return sum(s) / len(s)
 
 
-def init_cov(filename):
-    file = pysam.Samfile(filename, "rb")
-
-    for read in file.fetch(file.references[0]):
-        if not read.is_unmapped:
-            if not read.seq:
-                h = 0
-            else:
-                h = len(read.seq)
-            pos = read.pos + read.rlen - h if read.is_reverse else read.pos
-            if read.is_reverse:
-                if not cov_r.has_key(pos):
-                    cov_r[pos] = 1
-            else:
-                if not cov_f.has_key(pos):
-                    cov_f[pos] = 1
-
-
-def ccf(k):
-    """Return value of cross-correlation function"""
-    s = 0
-    forward_keys = set(cov_f.keys())
-    reverse_keys = set(map(lambda x: x - k, cov_r.keys()))
-    keys = forward_keys & reverse_keys
-
-    for p in keys:
-        s += get_value(cov_f, p) & get_value(cov_r, p + k)
-
-    return s, k
-
-
-def get_extension_size(filename, start=0, end=600, stepsize=5):
+def _sample_blocks(f, size, n):
+    """Return at most <n> blocks (chrom, start, end) of length <size> from the chromosomes with mapped reads of
+    BAM file <f>. The blocks are allocated one by one to the chromosome that lags most behind its share of the
+    reads, so chromosomes with few reads may get no block. A chromosome is taken whole if its blocks cover it,
+    otherwise each block is centered in one of equally long strides of the chromosome."""
+    chroms = [(s.contig, s.mapped, f.get_reference_length(s.contig)) for s in f.get_index_statistics()
+              if s.mapped > 0]
+    total = float(sum(m for _, m, _ in chroms))
+    capacity = [-(-length // size) for _, _, length in chroms] #blocks needed to cover chromosome
+    k = [0] * len(chroms)
+    for _ in range(n):
+        open_chroms = [i for i in range(len(chroms)) if k[i] < capacity[i]]
+        if not open_chroms:
+            break
+        i = max(open_chroms, key=lambda i: n * chroms[i][1] / total - k[i])
+        k[i] += 1
+
+    blocks = []
+    for (chrom, _, length), k_chrom, cap in zip(chroms, k, capacity):
+        if k_chrom == 0:
+            continue
+        if k_chrom == cap: #take whole chromosome
+            blocks += [(chrom, start, min(start + size, length)) for start in range(0, length, size)]
+        else:
+            step = length / float(k_chrom)
+            blocks += [(chrom, int(j * step + (step - size) / 2.), int(j * step + (step - size) / 2.) + size)
+                       for j in range(k_chrom)]
+    return blocks
+
+
+def _get_block_number(f, size, sample_size, min_reads):
+    """Return the number of blocks of length <size> for BAM file <f>, such that they cover <sample_size> bp (the
+    length of the largest chromosome with reads if None) and contain about <min_reads> reads"""
+    chroms = [(s.mapped, f.get_reference_length(s.contig)) for s in f.get_index_statistics() if s.mapped > 0]
+    if not chroms:
+        return 0
+    if sample_size is None:
+        sample_size = max(length for _, length in chroms)
+    reads_per_bp = sum(m for m, _ in chroms) / float(sum(length for _, length in chroms))
+    return int(np.ceil(max(sample_size, min_reads / reads_per_bp) / float(size)))
+
+
+def iter_strand_counts(f, blocks, slot_size=SLOT_SIZE):
+    """Yield for each block (chrom, start, end) of BAM file <f> arrays of length <slot_size> with the read starts
+    of the forward and reverse reads. The arrays are zero padded behind the block, such that the
+    cross-correlation of shifts smaller than the padding does not wrap around."""
+    for chrom, start, end in blocks:
+        pos, reverse = [], []
+        for read in f.fetch(chrom, start, end):
+            if not read.is_unmapped and start <= read.pos < end:
+                pos.append(read.pos)
+                reverse.append(read.is_reverse)
+        pos = np.array(pos, dtype=np.int64) - start
+        reverse = np.array(reverse, dtype=bool)
+        cov_f, cov_r = np.zeros(slot_size), np.zeros(slot_size)
+        cov_f[pos[~reverse]] = 1
+        cov_r[pos[reverse]] = 1
+        yield cov_f, cov_r
+
+
+def cross_correlation(cov_f, cov_r, shifts):
+    """Return the cross-correlation sum_p cov_f[p] * cov_r[p + k] for all shifts k of <shifts>. The shifts have
+    to be smaller than the zero padding of the arrays."""
+    n = len(cov_f)
+    cc = np.fft.irfft(np.conj(np.fft.rfft(cov_f)) * np.fft.rfft(cov_r), n)
+    return np.rint(cc[np.asarray(shifts) % n]).astype(int)
+
+
+def get_extension_size(filename, start=0, end=600, stepsize=5, sample_size=None, min_reads=MIN_READS):
     """Return extension/shift size of reads and all computed values of the convolution. 
-    Search value with a resolution of <stepsize> from start to end."""
-    read_length = get_read_size(filename)
+    Search value with a resolution of <stepsize> from start to end. The cross-correlation is computed on blocks
+    that cover at least <sample_size> bp (the largest chromosome with reads if None) and contain about
+    <min_reads> reads, or on the whole genome if it is smaller."""
+    read_length = int(get_read_size(filename))
     start -= read_length
 
-    init_cov(filename)
-
-    r = map(ccf, range(start, end, stepsize))
+    shifts = np.arange(start, end, stepsize)
+    pad = max(abs(start), end)
+    f = pysam.Samfile(filename, "rb")
+    n = _get_block_number(f, SLOT_SIZE - pad, sample_size, min_reads)
+    cc = np.zeros(len(shifts), dtype=int)
+    for cov_f, cov_r in iter_strand_counts(f, _sample_blocks(f, SLOT_SIZE - pad, n)):
+        cc += cross_correlation(cov_f, cov_r, shifts)
 
-    r = map(lambda x: (x[0], x[1]), r)
+    r = list(zip(cc.tolist(), shifts.tolist()))
 
     # print('extension size is %s' %max(r[read_length/stepsize*2:])[1])
 
-    return max(r[read_length / stepsize * 2:])[1], r
+    return max(r[read_length // stepsize * 2:])[1], r
 
 
 if __name__ == '__main__':
@@ -34,6 +34,8 @@ from rgt.THOR.neg_bin import NegBin
 lookup_pmf = {}
 lookup_pvalue = {}
 
+MAX_COUNT = 1000 #default size of the p-value tables
+
 
 def get_value(x, distr):
     if distr['distr_name'] == 'binomial':
@@ -92,6 +94,9 @@ def compute_pvalue(distr, N, side, current_p, x):
 
 def get_log_pvalue_new(x, y, side, distr):
     """compute log10 p-value"""
+    if 'table' in distr:
+        return distr['table'].get(x, y, side)
+    
     N = x + y
     if side == 'l':
         x, y = y, x
@@ -106,6 +111,89 @@ def get_log_pvalue_new(x, y, side, distr):
         return pvalue
 
 
+def get_log_pvalues(x, y, side, distr):
+    """compute log10 p-values of get_log_pvalue_new for arrays of counts <x>, <y> and sides <side>"""
+    if 'table' in distr:
+        return distr['table'].get_many(x, y, side)
+    
+    return np.array([get_log_pvalue_new(int(a), int(b), s, distr) for a, b, s in zip(x, y, side)], dtype=float)
+
+
+class PValueTable():
+    """Log10 p-values of get_log_pvalue_new for a NegBin distribution <distr>. The p-values of all counts
+    x, y <= <max_count> are precomputed, for larger counts the p-value is computed exactly.
+    
+    For N = x + y, the p-value of x (side 'r', x <= y) is the sum of pmf(i) * pmf(N-i) over i <= x divided by
+    the sum over all i <= N/2 and by 2. The partial sums of each N are computed at once, so that the table
+    costs O(max_count^2). Tables are stored by save() and reused by load()."""
+    
+    def __init__(self, distr, max_count=MAX_COUNT, table=None):
+        self.distr = distr
+        self.max_count = max_count
+        self.table = self._compute() if table is None else table
+    
+    def _compute(self):
+        """Return matrix with the log10 p-value of (x, y), where x <= y"""
+        m = self.max_count
+        logpmf = self.distr.logpmf(np.arange(2 * m + 1))
+        table = np.zeros((m + 1, m + 1))
+        for N in range(2 * m + 1):
+            x = np.arange(max(0, N - m), min(N // 2, m) + 1) #x <= y <= m
+            if not len(x):
+                continue
+            i = np.arange(N // 2 + 1)
+            num = np.logaddexp.accumulate(logpmf[i] + logpmf[N - i])
+            table[x, N - x] = (num[x] - (log(2) + num[-1])) / log(10)
+        return table
+    
+    def _exact(self, x, y):
+        """Return log10 p-value of (x, y), where x <= y"""
+        N = x + y
+        i = np.arange(N // 2 + 1)
+        p = self.distr.logpmf(i) + self.distr.logpmf(N - i)
+        return (logsumexp(p[:x + 1]) - (log(2) + logsumexp(p))) / log(10)
+    
+    def get(self, x, y, side):
+        """Return log10 p-value as get_log_pvalue_new"""
+        x, y = int(x), int(y)
+        if side == 'l':
+            x, y = y, x
+        if x > y:
+            return -log(2) / log(10) #all terms contribute
+        if y <= self.max_count:
+            return self.table[x, y]
+        return self._exact(x, y)
+    
+    def get_many(self, x, y, side):
+        """Return log10 p-values as get for arrays of counts <x>, <y> and sides <side>"""
+        x, y = np.asarray(x, dtype=int), np.asarray(y, dtype=int)
+        left = np.asarray(side) == 'l'
+        x, y = np.where(left, y, x), np.where(left, x, y)
+        
+        res = np.full(len(x), -log(2) / log(10))
+        small = (x <= y) & (y <= self.max_count)
+        res[small] = self.table[x[small], y[small]]
+        for k in np.flatnonzero((x <= y) & (y > self.max_count)):
+            res[k] = self._exact(x[k], y[k])
+        return res
+    
+    def save(self, filename):
+        """Store table and distribution parameters in the NumPy file <filename>"""
+        np.savez(filename, table=self.table, mu=self.distr.mu, alpha=self.distr.alpha)
+    
+    @classmethod
+    def load(cls, filename, distr):
+        """Return the PValueTable stored in <filename>, if it belongs to NegBin <distr>, otherwise None"""
+        try:
+            data = np.load(filename)
+            if float(data['mu']) != distr.mu or float(data['alpha']) != distr.alpha:
+                return None
+            table = data['table']
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        return cls(distr, max_count=len(table) - 1, table=table)
+
+
 def change_nb_WP2NB1(n, p):
     alpha = 1. / n
     mu = (1. / p - 1) / alpha
@@ -25,8 +25,6 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import print_function
 import sys
 import numpy as np
-from math import fabs
-import warnings
 
 
 def _count(posts):
@@ -43,43 +41,24 @@ def _count(posts):
     return c_1, c_2
 
 def _valid_posteriors(posteriors, obs, dim):
+    """Correct the posteriors of observations whose more likely differential state contradicts the counts: if the
+    counts of condition 1 are higher, the posterior of state 2 is moved to states 0 and 1 and vice versa.
+    <posteriors> is changed in place."""
+    obs = np.asarray(obs, dtype=float)
+    c1, c2 = obs[:, :dim[0]].mean(axis=1), obs[:, dim[0]:].mean(axis=1) #counts of samples
+    state_1 = posteriors[:, 0] > 0.5
     
-    warnings.filterwarnings('error')
-    
-    for i in range(len(obs)):
-        state_1 = False
-        c1, c2 = np.mean(obs[i][:dim[0]]), np.mean(obs[i][dim[0]:]) #counts of samples
-
-        if posteriors[i][0] > 0.5: 
-            state_1 = True
-            
-        if c1 > c2: #state 1
-            if fabs(posteriors[i][2] - 1) < 1e-200:
-                posteriors[i] = np.array([1, 0, 0])
-            else:
-                if not state_1 and posteriors[i][2] > posteriors[i][1]:
-                    try:                        
-                        post_s2 = 0
-                        post_s0 = posteriors[i][0] / (posteriors[i][0] + posteriors[i][1])
-                        post_s1 = posteriors[i][1] / (posteriors[i][0] + posteriors[i][1])
-                        posteriors[i] = np.array([post_s0, post_s1, post_s2])
-                    except RuntimeWarning:
-                        print(posteriors[i], c1, c2, file=sys.stderr)
+    for higher, keep, drop in [(c1 > c2, 1, 2), (c2 > c1, 2, 1)]: #state 1, state 2
+        certain = higher & (np.abs(posteriors[:, drop] - 1) < 1e-200)
+        move = np.flatnonzero(higher & ~certain & ~state_1 & (posteriors[:, drop] > posteriors[:, keep]))
+        norm = posteriors[move, 0] + posteriors[move, keep]
+        for i in move[norm == 0]:
+            print(posteriors[i], c1[i], c2[i], file=sys.stderr)
+        move, norm = move[norm > 0], norm[norm > 0]
         
-        if c2 > c1: #state 2
-            if fabs(posteriors[i][1] - 1) < 1e-200:
-                posteriors[i] = np.array([1, 0, 0])
-            else:
-                if not state_1 and posteriors[i][1] > posteriors[i][2]:
-                    try:
-                        post_s1 = 0
-                        post_s0 = posteriors[i][0] / (posteriors[i][0] + posteriors[i][2])
-                        post_s2 = posteriors[i][2] / (posteriors[i][0] + posteriors[i][2])
-                        posteriors[i] = np.array([post_s0, post_s1, post_s2])
-                    except RuntimeWarning:
-                        print(posteriors[i], c1, c2, file=sys.stderr)
-
-    warnings.resetwarnings()
+        posteriors[move, 0] /= norm
+        posteriors[move, keep] /= norm
+        posteriors[move, drop] = 0
+        posteriors[certain] = np.array([1, 0, 0])
 
     return posteriors
-
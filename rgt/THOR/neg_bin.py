@@ -23,13 +23,14 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from __future__ import print_function
-from mpmath import gamma, rf, loggamma
 import numpy as np
 from math import log
 from numpy.random import random_sample
 import sys
-from math import fabs
 from scipy.stats import nbinom
+from scipy.special import gammaln
+
+MAX_COUNT = 1000 #default size of the pmf tables
 
 class NegBin():
     """Negative Binomial distribution (NB1) with continuous parameter r,
@@ -41,64 +42,81 @@ class NegBin():
     
     - http://stackoverflow.com/questions/11373192/generating-discrete-random-variables-with-specified-weights-using-scipy-or-numpy
     - http://www.nehalemlabs.net/prototype/blog/2013/11/11/negative-binomial-with-continuous-parameters-in-python/
+    
+    The pmf, log-pmf and cdf of the counts 0, ..., <max_count> are precomputed as arrays, larger and non-integer
+    counts are computed directly. The tables are plain NumPy arrays, so that NegBin objects can be pickled and
+    shared with worker processes, and stored by save().
     """
     
     def _get_value_log(self, x, mu, v):
-        """log basic 2"""
-        try:
-            return loggamma(x+v) - loggamma(x+1) - loggamma(v) + v*log(v) - v*log(v+mu) + x*log(mu) - x*log(v+mu)
-        except ValueError:
-            #print('_get_value_log ValueError', x, mu, v, file=sys.stderr)
-            return 1
+        """log-pmf of the array <x>, the point mass at 0 if <mu> or <v> is not positive"""
+        if mu <= 0 or v <= 0:
+            return np.where(x == 0, 0., -np.inf)
+        return gammaln(x+v) - gammaln(x+1) - gammaln(v) + v*log(v) - v*log(v+mu) + x*(log(mu) - log(v+mu))
     
-    def _get_value(self, x, mu, v):
-        try:
-            return rf(v, x) / gamma(x+1) * ( v/float(v+mu) ) ** v * ( mu/float(v+mu) ) ** x
-        except ValueError:
-            print(x, mu, v, file=sys.stderr)
-            return 1
-            
-    def __init__(self, mu, alpha):
-        self.map_pdf = {}
-        self.map_logpdf = {}
-        self.bins = []
+    def __init__(self, mu, alpha, max_count=MAX_COUNT, tables=None):
         mu = float(mu)
         
         self.alpha = alpha
         self.mu = mu
         
-        self.nbin = np.frompyfunc(self._get_value, 3, 1)
-        self.nbin_log = np.frompyfunc(self._get_value_log, 3, 1)
-        
+        if tables is None:
+            self.logpmf_table = self._get_value_log(np.arange(max_count + 1, dtype=float), self.mu, 1./self.alpha)
+            self.cdf_table = np.cumsum(np.exp(self.logpmf_table))
+        else:
+            self.logpmf_table, self.cdf_table = tables
+        self.pmf_table = np.exp(self.logpmf_table)
+        self.max_count = len(self.logpmf_table) - 1
+    
+    def _lookup(self, x, table, tail):
+        """Evaluate <table> at the counts <x>, use function <tail> for counts that are not in the table"""
+        x = np.asarray(x, dtype=float)
+        index = np.clip(x, 0, self.max_count).astype(int)
+        res = np.array(table[index], dtype=float)
+        out = index != x
+        if out.any():
+            res[out] = tail(x[out])
+        return res
+    
+    def logpmf(self, x):
+        """Return the log-pmf of all counts in array <x>"""
+        return self._lookup(x, self.logpmf_table, lambda y: self._get_value_log(y, self.mu, 1./self.alpha))
+    
+    def pmf(self, x):
+        """Return the pmf of all counts in array <x>"""
+        return self._lookup(x, self.pmf_table, lambda y: np.exp(self._get_value_log(y, self.mu, 1./self.alpha)))
+    
+    def cdf(self, x):
+        """Return the cdf of all counts in array <x>"""
+        v = 1./self.alpha
+        return self._lookup(np.floor(x), self.cdf_table, lambda y: nbinom.cdf(y, v, v / (v + self.mu)))
+    
     def pdf(self, x):
-        if not self.map_pdf.has_key(x):
-            v_log = self.nbin(x, self.mu, 1./self.alpha)
-            self.map_pdf[x] = v_log
-        
-        return self.map_pdf[x]
+        """Return the pmf of count <x>, a float for scalars and an array for arrays"""
+        res = self.pmf(x)
+        return float(res) if res.ndim == 0 else res
     
     def logpdf(self, x):
-        if not self.map_logpdf.has_key(x):
-            v_log = self.nbin_log(x, self.mu, 1./self.alpha)
-            self.map_logpdf[x] = v_log
-        
-        return self.map_logpdf[x]
-        
+        """Return the log-pmf of count <x>, a float for scalars and an array for arrays"""
+        res = self.logpmf(x)
+        return float(res) if res.ndim == 0 else res
+    
     def rvs(self):
-        if not self.bins:
-            probs = []
-            i = 0
-            v_old = -1
-            while True:
-                v = self.nbin(i, self.mu, 1./self.alpha)
-                probs.append(v)
-                
-                i += 1
-                if fabs(v_old - v) < 10**-10:
-                    break
-                v_old = v
-            self.bins = map(lambda x: float(x), np.add.accumulate(probs))
-        return np.digitize(random_sample(1), self.bins)[0]
+        u = random_sample()
+        if u < self.cdf_table[-1]:
+            return int(np.searchsorted(self.cdf_table, u, side='right'))
+        v = 1./self.alpha
+        return int(nbinom.ppf(u, v, v / (v + self.mu)))
+    
+    def save(self, filename):
+        """Store distribution and tables in the NumPy file <filename>"""
+        np.savez(filename, mu=self.mu, alpha=self.alpha, logpmf=self.logpmf_table, cdf=self.cdf_table)
+    
+    @classmethod
+    def load(cls, filename):
+        """Return the NegBin stored in <filename> by save()"""
+        data = np.load(filename)
+        return cls(float(data['mu']), float(data['alpha']), tables=(data['logpmf'], data['cdf']))
 
 if __name__ == '__main__':
     neg_bin = NegBin(0.1, 0.00000000001)
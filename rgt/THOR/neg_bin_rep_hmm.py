@@ -32,19 +32,27 @@ from scipy.special import logsumexp
 
 import numpy as np
 from .neg_bin import NegBin
+from .get_fast_gen_pvalue import PValueTable
+from .help_hmm import _valid_posteriors
 
 import warnings
 
 
-def _get_pvalue_distr(mu, alpha, tracker):
-    """Derive NB1 parameters for p-value calculation"""
+def _get_pvalue_distr(mu, alpha, tracker, table_file=None):
+    """Derive NB1 parameters for p-value calculation. The p-value table is loaded from <table_file>, if it
+    was computed for the same parameters, otherwise it is computed and stored in <table_file>"""
     mu = mu[0,0]
     alpha = alpha[0,0] / 10000.
     tracker.write(text=str(mu), header="Neg. Bin. distribution for p-value estimates (mu)")
     tracker.write(text=str(alpha), header="Neg. Bin. distribution for p-value estimates (alpha)")
     
     nb = NegBin(mu, alpha)
-    return {'distr_name': 'nb', 'distr': nb}
+    table = PValueTable.load(table_file, nb) if table_file is not None else None
+    if table is None:
+        table = PValueTable(nb)
+        if table_file is not None:
+            table.save(table_file)
+    return {'distr_name': 'nb', 'distr': nb, 'table': table}
 
 def get_init_parameters(s0, s1, s2, **info):
     """For given training set (s0: Background, s1: Gaining, s2: loseing) get inital mu, alpha for NB1."""
@@ -97,7 +105,7 @@ class NegBinRepHMM(_BaseHMM):
         self.em_prob = 0
     
     
-    def fit(self, obs, three_para):
+    def fit(self, obs, three_para, lengths=None):
         """Estimate model parameters.
 
         An initialization step is performed before entering the EM
@@ -110,6 +118,9 @@ class NegBinRepHMM(_BaseHMM):
             List of array-like observation sequences, each of which
             has shape (n_i, n_features), where n_i is the length of
             the i_th observation.
+        lengths : list, optional
+            If given, <obs> is one array of the concatenated observation
+            sequences and <lengths> gives the length n_i of each of them.
 
         Notes
         -----
@@ -119,7 +130,15 @@ class NegBinRepHMM(_BaseHMM):
         small).  You can fix this by getting more training data,
         or strengthening the appropriate subclass-specific regularization
         parameter.
+        
+        All sequences are handled as one batch: the emissions and the
+        sufficient statistics of the emissions are computed on the
+        concatenated sequences.
         """
+        if lengths is not None:
+            obs = np.split(np.asarray(obs), np.cumsum(lengths)[:-1])
+        X = np.concatenate([np.asarray(seq) for seq in obs])
+        bounds = np.cumsum([0] + [len(seq) for seq in obs])
 
         # what does this mean??
         self._init(obs, self.init_params)
@@ -129,16 +148,21 @@ class NegBinRepHMM(_BaseHMM):
             # Expectation step
             stats = self._initialize_sufficient_statistics()
             curr_logprob = 0
-            for seq in obs:
-                framelogprob = self._compute_log_likelihood(seq)
+            all_framelogprob = self._compute_log_likelihood(X)
+            all_posteriors = np.zeros(all_framelogprob.shape)
+            for k, seq in enumerate(obs):
+                framelogprob = all_framelogprob[bounds[k]:bounds[k + 1]]
                 lpr, fwdlattice = self._do_forward_pass(framelogprob)
                 bwdlattice = self._do_backward_pass(framelogprob)
                 gamma = fwdlattice + bwdlattice
                 posteriors = np.exp(gamma.T - logsumexp(gamma, axis=1)).T
                 curr_logprob += lpr
-                self._accumulate_sufficient_statistics(
+                super(NegBinRepHMM, self)._accumulate_sufficient_statistics(
                     stats, seq, framelogprob, posteriors, fwdlattice,
                     bwdlattice)
+                all_posteriors[bounds[k]:bounds[k + 1]] = posteriors
+            all_posteriors = self._valid_posteriors(all_posteriors, X)
+            self._help_accumulate_sufficient_statistics(X, stats, all_posteriors)
             logprob.append(curr_logprob)
 
             # Check for convergence.
@@ -170,26 +194,17 @@ class NegBinRepHMM(_BaseHMM):
                 return 1e-300
     
     def _compute_log_likelihood(self, X):
-        matrix = []
-        lookup = {}
-        for x in X: #over all observations
-            row = []
+        """Return the log-likelihood of each observation (rows) for each HMM state (columns), that is the sum of the
+        Neg. Bin. log-pmfs of the replicates. Small integer counts are looked up in the NegBin's pmf tables."""
+        X = np.asarray(X, dtype=float)
+        matrix = np.zeros((len(X), self.n_components))
+        
+        for j in range(self.n_features): #over dim
+            cols = slice(0, self.dim[0]) if j == 0 else slice(self.dim[0], self.dim[0] + self.dim[1]) #grab proper ob
             for i in range(self.n_components): #over number of HMM's state
-                r_sum = 0
-                for j in range(self.n_features): #over dim
-                    it = range(self.dim[0]) if j == 0 else range(self.dim[0], self.dim[0] + self.dim[1]) #grab proper ob
-                    for k in it:
-                        index = (int(x[k]), i, j)
-                        if lookup.has_key( index ):
-                            r_sum += lookup[index]
-                        else:
-                            y = float(self.neg_distr[j,i].logpdf(x[k]))
-                            lookup[index] = y
-                            r_sum += y
-                row.append(r_sum)
+                matrix[:, i] += self.neg_distr[j, i].logpmf(X[:, cols]).sum(axis=1)
         
-            matrix.append(row)
-        return np.asarray(matrix)
+        return matrix
     
     
     def _generate_sample_from_state(self, state, random_state=None):
@@ -208,60 +223,19 @@ class NegBinRepHMM(_BaseHMM):
         return stats
     
     def _help_accumulate_sufficient_statistics(self, obs, stats, posteriors):
-        for t, symbol in enumerate(obs):
-            stats['post'][0] += posteriors[t]
-            stats['post'][1] += posteriors[t]
-            
-            pot_it = [range(self.dim[0]), range(self.dim[0], self.dim[0] + self.dim[1])] #consider both classes
-            for j, it in enumerate(pot_it):
-                for i in it:
-                    stats['post_emission'][j] += posteriors[t] * symbol[i]
+        """Add the posterior weights and the posterior weighted counts of each condition and state"""
+        obs = np.asarray(obs, dtype=float)
+        counts = [obs[:, :self.dim[0]].sum(axis=1), obs[:, self.dim[0]:self.dim[0] + self.dim[1]].sum(axis=1)]
+        post = posteriors.sum(axis=0)
         
-        stats['post'][0] = stats['post'][0] * self.dim[0]
-        stats['post'][1] = stats['post'][1] * self.dim[1]
+        for j in range(self.n_features):
+            stats['post'][j] += post * self.dim[j]
+            stats['post_emission'][j] += np.dot(counts[j], posteriors)
         
         stats['posterior'] = np.copy(posteriors)
     
     def _valid_posteriors(self, posteriors, obs):
-    
-        warnings.filterwarnings('error')
-        
-        for i in range(len(obs)):
-            state_1 = False
-            c1, c2 = np.mean(obs[i][:self.dim[0]]), np.mean(obs[i][self.dim[0]:]) #counts of samples
-    
-            if posteriors[i][0] > 0.5: 
-                state_1 = True
-                
-            if c1 > c2: #state 1
-                if fabs(posteriors[i][2] - 1) < 1e-200:
-                    posteriors[i] = np.array([1, 0, 0])
-                else:
-                    if not state_1 and posteriors[i][2] > posteriors[i][1]:
-                        try:                        
-                            post_s2 = 0
-                            post_s0 = posteriors[i][0] / (posteriors[i][0] + posteriors[i][1])
-                            post_s1 = posteriors[i][1] / (posteriors[i][0] + posteriors[i][1])
-                            posteriors[i] = np.array([post_s0, post_s1, post_s2])
-                        except RuntimeWarning:
-                            print(posteriors[i], c1, c2, file=sys.stderr)
-            
-            if c2 > c1: #state 2
-                if fabs(posteriors[i][1] - 1) < 1e-200:
-                    posteriors[i] = np.array([1, 0, 0])
-                else:
-                    if not state_1 and posteriors[i][1] > posteriors[i][2]:
-                        try:
-                            post_s1 = 0
-                            post_s0 = posteriors[i][0] / (posteriors[i][0] + posteriors[i][2])
-                            post_s2 = posteriors[i][2] / (posteriors[i][0] + posteriors[i][2])
-                            posteriors[i] = np.array([post_s0, post_s1, post_s2])
-                        except RuntimeWarning:
-                            print(posteriors[i], c1, c2, file=sys.stderr)
-
-        warnings.resetwarnings()
-
-        return posteriors
+        return _valid_posteriors(posteriors, obs, self.dim)
 
     def _accumulate_sufficient_statistics(self, stats, obs, framelogprob,
                                       posteriors, fwdlattice, bwdlattice
@@ -23,108 +23,73 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from __future__ import print_function
-from ..GenomicRegion import GenomicRegion
 from ..GenomicRegionSet import GenomicRegionSet
+import os
 import sys
-# import re
+import tempfile
 from scipy.stats.mstats import zscore
 from ..motifanalysis.Statistics import multiple_test_correction
 import numpy as np
 from numpy import log10
 
 
-def merge_data(regions):
-    for el in regions:
-        tmp = el.data
-        d = tmp.split('_$_')
-        c1, c2 = 0, 0
-        logpvalue = []
-        for tmp in d:
-            tmp = tmp.split(',')
-            c1 += int(tmp[0].replace("(", ""))
-            c2 += int(tmp[1])
-            logpvalue.append(float(tmp[2].replace(")", "")))
+def peak_dtype(dim_1, dim_2):
+    """Return dtype of the peak table for <dim_1> and <dim_2> replicates. Each peak has its coordinates, strand
+    ('+' gain, '-' loss), the counts of each replicate, the reads on the positive and negative strand, the
+    -log10 p-value and the log ratio of the strands."""
+    return np.dtype([('chrom', object), ('start', np.int64), ('end', np.int64), ('strand', object),
+                     ('counts1', np.int64, (dim_1,)), ('counts2', np.int64, (dim_2,)), ('pos', np.int64),
+                     ('neg', np.int64), ('pvalue', float), ('ratio', float)])
 
-        el.data = str((c1, c2, max(logpvalue)))
 
+def get_log_ratios(pos, neg):
+    """Return log ratio of the read counts <pos> and <neg> on the positive and negative strand,
+    sys.maxint where a count is zero"""
+    pos, neg = np.asarray(pos, dtype=float), np.asarray(neg, dtype=float)
+    res = np.full(len(pos), float(sys.maxint))
+    m = (pos > 0) & (neg > 0)
+    res[m] = np.log(pos[m] / neg[m])
+    return res
+
+
+def _sort_peaks(peaks):
+    """Return peaks sorted by chromosome, start and end"""
+    chroms = np.unique(peaks['chrom'], return_inverse=True)[1]
+    return peaks[np.lexsort((peaks['end'], peaks['start'], chroms))]
 
-def output(name, regions):
-    color = {'+': '255,0,0', '-': '0,255,0'}
-    output = []
-    
-    for i, el in enumerate(regions):
-        tmp = el.data.split(',')
-        #counts = ",".join(map(lambda x: re.sub("\D", "", x), tmp[:len(tmp)-1]))
-        main_sep = ':' #sep <counts> main_sep <counts> main_sep <pvalue>
-        int_sep = ';' #sep counts in <counts>
-        counts = ",".join(tmp).replace('], [', ';').replace('], ', int_sep).replace('([', '').replace(')', '').replace(', ', main_sep)
-        pvalue = float(tmp[len(tmp)-1].replace(")", "").strip())
-        
-        output.append("\t".join([el.chrom, el.initial, el.final, 'Peak'+str(i), 1000, el.orientation, el.initial, el.final, \
-              color[el.orientation], 0, counts]), pvalue)
-    
-    return output
 
-def merge_delete(ext_size, merge, peak_list, pvalue_list):
-#     peaks_gain = read_diffpeaks(path)
+def merge_delete(ext_size, merge, peaks):
+    """Return sorted peaks. If <merge>, merge peaks of the same strand with a distance less than <ext_size>: the
+    counts and strand reads are summed up, the p-value is the p-value of the most significant peak."""
+    if not merge or len(peaks) < 2:
+        return _sort_peaks(peaks)
     
-    regions_plus = GenomicRegionSet('regions') #pot. mergeable
-    regions_minus = GenomicRegionSet('regions') #pot. mergeable
-    regions_unmergable = GenomicRegionSet('regions')
-    last_orientation = ""
+    chroms = np.unique(peaks['chrom'], return_inverse=True)[1]
+    strands = (peaks['strand'] == '+').astype(int)
+    order = np.lexsort((peaks['start'], strands, chroms))
+    peaks, chroms, strands = peaks[order], chroms[order], strands[order]
     
-    for i, t in enumerate(peak_list):
-        chrom, start, end, c1, c2, strand, ratio = t[0], t[1], t[2], t[3], t[4], t[5], t[6]
-        r = GenomicRegion(chrom = chrom, initial = start, final = end, name = '',
-                          orientation = strand, data = str((c1, c2, pvalue_list[i], ratio)))
-        # if end - start > ext_size:
-        if strand == '+':
-            if last_orientation == '+':
-                regions_plus.add(r)
-            else:
-                regions_unmergable.add(r)
-        elif strand == '-':
-            if last_orientation == '-':
-                regions_minus.add(r)
-            else:
-                regions_unmergable.add(r)
-
-    if merge:
-        regions_plus.extend(ext_size/2, ext_size/2)
-        regions_plus.merge()
-        regions_plus.extend(-ext_size/2, -ext_size/2)
-        merge_data(regions_plus)
-        
-        regions_minus.extend(ext_size/2, ext_size/2)
-        regions_minus.merge()
-        regions_minus.extend(-ext_size/2, -ext_size/2)
-        merge_data(regions_minus)
+    new = (np.diff(chroms) != 0) | (np.diff(strands) != 0) | (peaks['start'][1:] - peaks['end'][:-1] >= ext_size)
+    first = np.concatenate(([0], np.flatnonzero(new) + 1))
     
-    results = GenomicRegionSet('regions')
-    for el in regions_plus:
-        results.add(el)
-    for el in regions_minus:
-        results.add(el)
-    for el in regions_unmergable:
-        results.add(el)
-    results.sort()
+    merged = peaks[first]
+    merged['end'] = np.maximum.reduceat(peaks['end'], first)
+    for k in ['counts1', 'counts2', 'pos', 'neg']:
+        merged[k] = np.add.reduceat(peaks[k], first, axis=0)
+    merged['pvalue'] = np.maximum.reduceat(peaks['pvalue'], first)
+    merged['ratio'] = get_log_ratios(merged['pos'], merged['neg'])
     
-    return results
+    return _sort_peaks(merged)
 
-def filter_by_pvalue_strand_lag(ratios, pcutoff, pvalues, output, no_correction, name, singlestrand):
-    """Filter DPs by strang lag and pvalue"""
 
+def filter_by_pvalue_strand_lag(pvalues, ratios, pcutoff, no_correction, singlestrand):
+    """Filter DPs by strang lag and pvalue. <pvalues> are -log10 p-values, return the (corrected) p-values and
+    whether each DP passes the filter"""
     if not singlestrand:
         zscore_ratios = zscore(ratios)
         ratios_pass = np.where(np.bitwise_and(zscore_ratios > -2, zscore_ratios < 2) == True, True, False)
     if not no_correction:
-        pv_pass = [True] * len(pvalues)
-        pvalues = map(lambda x: 10**-x, pvalues)
-        
-        _output_BED(name + '-uncor', output, pvalues, pv_pass)
-        _output_narrowPeak(name + '-uncor', output, pvalues, pv_pass)
-        
-        pv_pass, pvalues = multiple_test_correction(pvalues, alpha=pcutoff)
+        pv_pass, pvalues = multiple_test_correction(10 ** -pvalues, alpha=pcutoff)
     else:
         pv_pass = np.where(np.asarray(pvalues) >= -log10(pcutoff), True, False)
     
@@ -134,57 +99,104 @@ def filter_by_pvalue_strand_lag(ratios, pcutoff, pvalues, output, no_correction,
     else:
         filter_pass = pv_pass
     
-    assert len(output) == len(pvalues)
     assert len(filter_pass) == len(pvalues)
     
-    return output, pvalues, filter_pass
+    return pvalues, filter_pass
+
 
-def _output_BED(name, output, pvalues, filter):
-    f = open(name + '-diffpeaks.bed', 'w')
-     
+def _bed_line(i, fields, pvalue):
+    """Return line of DP <i> in BED format, <fields> are chromosome, start, end, strand and counts"""
+    chrom, start, end, strand, counts = fields
     colors = {'+': '255,0,0', '-': '0,255,0'}
-    bedscore = 1000
-    
-    for i in range(len(pvalues)):
-        c, s, e, strand, counts = output[i]
-        p_tmp = -log10(pvalues[i]) if pvalues[i] > 0 else sys.maxint
-        counts = ';'.join(counts.split(';')[:2] + [str(p_tmp)])
+    p_tmp = -log10(pvalue) if pvalue > 0 else sys.maxint
+    return '\t'.join(map(str, [chrom, start, end, 'Peak' + str(i), 1000, strand, start, end, colors[strand], 0,
+                                counts + ';' + str(p_tmp)]))
+
+
+def _narrowPeak_line(i, fields, pvalue):
+    """Return line of DP <i> in narrowPeak format, see http://genome.ucsc.edu/FAQ/FAQformat.html#format12"""
+    chrom, start, end, strand, _ = fields
+    p_tmp = -log10(pvalue) if pvalue > 0 else sys.maxint
+    return '\t'.join(map(str, [chrom, start, end, 'Peak' + str(i), 0, strand, 0, p_tmp, 0, -1]))
+
+
+class PeakWriter:
+    """Write the DPs of a THOR run, which are added chromosome by chromosome, to <name>-diffpeaks.bed and
+    <name>-diffpeaks.narrowPeak. The multiple test correction and the strand lag filter depend on all DPs, so
+    the DPs are spooled to a temporary file and only their p-values and ratios are kept in memory. Without
+    <no_correction>, the uncorrected DPs are written to <name>-uncor-diffpeaks.* as soon as they are added."""
+    
+    def __init__(self, name, pcutoff, no_correction, singlestrand):
+        self.name = name
+        self.pcutoff = pcutoff
+        self.no_correction = no_correction
+        self.singlestrand = singlestrand
+        self.tmp = tempfile.TemporaryFile(mode='w+', dir=os.path.dirname(os.path.abspath(name)))
+        self.pvalues = []
+        self.ratios = []
+        self.n = 0
+        self.uncor = None
+        if not no_correction:
+            self.uncor = [open(name + '-uncor-diffpeaks.bed', 'w'), open(name + '-uncor-diffpeaks.narrowPeak', 'w')]
+    
+    def add(self, peaks):
+        """Add peak table <peaks> (see peak_dtype) of the next chromosome"""
+        self.pvalues.append(peaks['pvalue'])
+        self.ratios.append(peaks['ratio'])
+        for el in peaks:
+            counts = ':'.join(map(str, el['counts1'])) + ';' + ':'.join(map(str, el['counts2']))
+            fields = [el['chrom'], el['start'], el['end'], el['strand'], counts]
+            print(*fields, sep='\t', file=self.tmp)
+            if self.uncor is not None:
+                pvalue = 10 ** -el['pvalue']
+                print(_bed_line(self.n, fields, pvalue), file=self.uncor[0])
+                print(_narrowPeak_line(self.n, fields, pvalue), file=self.uncor[1])
+            self.n += 1
+    
+    def close(self):
+        """Filter all DPs and write them"""
+        if self.uncor is not None:
+            for f in self.uncor:
+                f.close()
         
-        if filter[i]:
-            print(c, s, e, 'Peak' + str(i), bedscore, strand, s, e, colors[strand], 0, counts, sep='\t', file=f)
-    
-    f.close()
-
-def _output_narrowPeak(name, output, pvalues, filter):
-    """Output in narrowPeak format,
-    see http://genome.ucsc.edu/FAQ/FAQformat.html#format12"""
-    f = open(name + '-diffpeaks.narrowPeak', 'w')
-    for i in range(len(pvalues)):
-        c, s, e, strand, _ = output[i]
-        p_tmp = -log10(pvalues[i]) if pvalues[i] > 0 else sys.maxint
-        if filter[i]:
-            print(c, s, e, 'Peak' + str(i), 0, strand, 0, p_tmp, 0, -1, sep='\t', file=f)
-    f.close()
-    
-def filter_deadzones(bed_deadzones, peak_regions):
-    """Filter by peaklist by deadzones"""
+        pvalues = np.concatenate(self.pvalues) if self.pvalues else np.zeros(0)
+        ratios = np.concatenate(self.ratios) if self.ratios else np.zeros(0)
+        if len(pvalues):
+            pvalues, filter_pass = filter_by_pvalue_strand_lag(pvalues, ratios, self.pcutoff, self.no_correction,
+                                                               self.singlestrand)
+        else:
+            filter_pass = []
+        if self.no_correction:
+            pvalues = 10 ** -np.asarray(pvalues)
+        
+        self.tmp.seek(0)
+        with open(self.name + '-diffpeaks.bed', 'w') as f_bed, open(self.name + '-diffpeaks.narrowPeak', 'w') as f_np:
+            for i, line in enumerate(self.tmp):
+                if filter_pass[i]:
+                    fields = line.rstrip('\n').split('\t')
+                    print(_bed_line(i, fields, pvalues[i]), file=f_bed)
+                    print(_narrowPeak_line(i, fields, pvalues[i]), file=f_np)
+        self.tmp.close()
+
+
+def filter_deadzones(bed_deadzones, peaks):
+    """Return peaks that do not overlap with deadzones"""
     deadzones = GenomicRegionSet('deadzones')
     deadzones.read(bed_deadzones)
-    peak_regions = peak_regions.subtract(deadzones, whole_region=True)
-    
-    return peak_regions
-    
-if __name__ == '__main__':
-    ext_size1 = int(sys.argv[1]) #100
-    ext_size2 = int(sys.argv[2]) #100
-    path = sys.argv[3] # '/home/manuel/merge_test.data'
-    merge = sys.argv[4] #True #for histones
-    
-    regions = merge_delete(path, ext_size1, '+', merge)
-    #regions_minus = merge_delete(path, ext_size2, '-', merge)
-    
-    i = 0
-    i = output(regions, i)
-    #i = output(regions_minus, i, '-')
-    
     
+    chroms = np.array([r.chrom for r in deadzones], dtype=object)
+    zones = np.array([(r.initial, r.final) for r in deadzones], dtype=np.int64).reshape(-1, 2)
+    
+    keep = np.ones(len(peaks), dtype=bool)
+    for chrom in np.unique(peaks['chrom']):
+        z = zones[chroms == chrom]
+        if not len(z):
+            continue
+        z = z[np.argsort(z[:, 0], kind='mergesort')]
+        max_end = np.maximum.accumulate(z[:, 1])
+        i = np.flatnonzero(peaks['chrom'] == chrom)
+        k = np.searchsorted(z[:, 0], peaks['end'][i], side='left') #zones that start before the peak ends
+        i, k = i[k > 0], k[k > 0]
+        keep[i] = max_end[k - 1] <= peaks['start'][i]
+    
+    return peaks[keep]
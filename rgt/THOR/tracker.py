@@ -23,13 +23,37 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from __future__ import print_function
+import os
 import re
+import sys
+import json
+import time
+import resource
 import numpy as np
 from ..Util import Html
 from collections import OrderedDict
 from os import path
 # import sys
 from datetime import datetime
+from contextlib import contextmanager
+
+
+def get_usage():
+    """Return wall time and CPU time (s) of this process and its finished child processes as well as the peak
+    resident memory (MB) of this process"""
+    t = os.times()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return time.time(), t[0] + t[1] + t[2] + t[3], rss / 1024.0 ** (2 if sys.platform == 'darwin' else 1)
+
+
+def get_profile(stage, start, chrom=None):
+    """Return profile of <stage> (on chromosome <chrom>) that started with usage <start> (see get_usage).
+    peak_rss_mb is cumulative, it is the peak memory of the process from its start up to the end of <stage>.
+    peak_rss_increase_mb is the amount by which <stage> raised this peak, 0 if the stage stayed below it."""
+    end = get_usage()
+    return {'stage': stage, 'chrom': chrom, 'wall_time': round(end[0] - start[0], 3),
+            'cpu_time': round(end[1] - start[1], 3), 'peak_rss_mb': round(end[2], 1),
+            'peak_rss_increase_mb': round(end[2] - start[2], 1)}
 
 
 class Tracker:
@@ -48,6 +72,7 @@ class Tracker:
         self.samples = map(lambda x: path.splitext(path.basename(x))[0], bamfiles)
         self.options = options
         self.version = version
+        self.profiles = []
     
     def write(self, text, header):
         if header:
@@ -77,6 +102,25 @@ class Tracker:
             text = " ".join(new)
         self.data.append((header, text))
 
+    @contextmanager
+    def profile(self, stage, chrom=None):
+        """Record wall time, CPU time and peak memory of the enclosed <stage> (on chromosome <chrom>)"""
+        start = get_usage()
+        try:
+            yield
+        finally:
+            self.profiles.append(get_profile(stage, start, chrom))
+    
+    def add_profile(self, profile):
+        """Add <profile> of get_profile, e.g. of a stage that ran in a worker process"""
+        self.profiles.append(profile)
+    
+    def write_profile(self, p):
+        """Write the profiles of all stages as JSON to <p>"""
+        with open(p, 'w') as f:
+            json.dump({'version': self.version, 'name': self.options.name, 'date': datetime.now().isoformat(),
+                       'stages': self.profiles}, f, indent=1)
+    
     def _read_hk(self, p):
         d = []
         if path.isfile(p):
@@ -118,9 +118,8 @@ tools_dictionary = {
     "THOR": (
         "rgt-THOR",
         "rgt.THOR.THOR:main",
-        ["scikit-learn>=0.19.0", "hmmlearn>=0.2", "matplotlib>=1.1.0", "mpmath", "HTSeq"],
-        ["data/bin/" + bin_dir + "/wigToBigWig", "data/bin/" + bin_dir + "/bigWigMerge",
-         "data/bin/" + bin_dir + "/bedGraphToBigWig"]
+        ["scikit-learn>=0.19.0", "hmmlearn>=0.2", "matplotlib>=1.1.0"],
+        []
     ),
     "filterVCF": (
         "rgt-filterVCF",
@@ -1,6 +1,13 @@
+import os
+import shutil
+import tempfile
 import unittest
 
-from rgt.CoverageSet import CoverageSet
+import numpy as np
+import pyBigWig
+import pysam
+
+from rgt.CoverageSet import CoverageSet, get_gc_context, get_library_size
 from rgt.GenomicRegionSet import *
 
 regions = GenomicRegionSet("test")
@@ -18,3 +25,241 @@ class CoverageSetTest(unittest.TestCase):
         cov.coverage_from_genomicset(bamfile)
         print(cov.coverage)
         self.assertEqual(cov.coverage, 4)
+
+
+class CoverageSetBigWigTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bigwig = os.path.join(self.dir, "signal.bw")
+        bw = pyBigWig.open(self.bigwig, "w")
+        bw.addHeader([("chr1", 10000), ("chr2", 5000)])
+        bw.addEntries("chr1", np.arange(0, 10000, 10, dtype=np.int64), values=np.arange(1000, dtype=np.float64),
+                      span=5)
+        bw.close()
+
+        self.regions = GenomicRegionSet("bigwig")
+        self.regions.add(GenomicRegion("chr1", 1000, 2537))
+        self.regions.add(GenomicRegion("chr2", 0, 1000))
+        self.regions.add(GenomicRegion("chr1", 0, 1500))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_coverage_from_bigwig(self):
+        c = CoverageSet("bigwig", self.regions)
+        c.coverage_from_bigwig(self.bigwig, stepsize=100)
+
+        bw = pyBigWig.open(self.bigwig)
+        for r, values in zip(self.regions, c.coverage):
+            steps = int(len(r) / 100)
+            if r.chrom == "chr2":
+                expected = [0] * steps
+            else:
+                expected = bw.stats(r.chrom, r.initial, r.final, type="mean", nBins=steps, exact=True)
+            self.assertEqual(len(values), steps)
+            self.assertTrue(np.allclose(values, expected))
+        bw.close()
+
+    def test_coverage_from_genomicset_bigwig(self):
+        c = CoverageSet("bigwig", self.regions)
+        c.coverage_from_genomicset(self.bigwig)
+        self.assertEqual(len(c.coverage), 3)
+        self.assertEqual(c.coverage[1], 0)
+        self.assertAlmostEqual(c.coverage[2], np.mean(np.arange(150)))
+
+    def test_write_bigwig(self):
+        chrom_sizes = os.path.join(self.dir, "chrom.sizes")
+        with open(chrom_sizes, "w") as f:
+            f.write("chr1\t10000\nchr2\t520\n")
+        out_regions = GenomicRegionSet("out")
+        out_regions.add(GenomicRegion("chr2", 0, 520))
+        out_regions.add(GenomicRegion("chr1", 1000, 2000))
+        c = CoverageSet("out", out_regions)
+        c.coverage = [np.arange(10), np.array([0, 1, 2, 0] * 5)]
+
+        path = os.path.join(self.dir, "out.bw")
+        c.write_bigwig(path, chrom_sizes)
+
+        bw = pyBigWig.open(path)
+        self.assertEqual(bw.intervals("chr1")[:2], ((1075, 1125, 1.0), (1125, 1175, 2.0)))
+        self.assertEqual(len(bw.intervals("chr1")), 10)
+        self.assertEqual(bw.intervals("chr2")[-1], (475, 520, 9.0))
+        self.assertEqual(len(bw.intervals("chr2")), 9)
+        bw.close()
+
+
+class GCContentTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.genome = os.path.join(self.dir, "genome.fa")
+        with open(self.genome, "w") as f:
+            f.write(">chr1\n" + "GC" * 50 + "AT" * 50 + "gA" * 50 + "\n")
+        pysam.faidx(self.genome)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get_gc_context(self):
+        cov = np.array([4, 2, 3, 6, 8, 10, 5])
+        gc_cov, gc_avg, gc_hist = get_gc_context(50, 49, self.genome, [cov], {"chr1": 300})
+
+        # bins of 50bp with 100%, 100%, 0%, 0%, 50%, 50% GC, the last bin exceeds the genome
+        self.assertAlmostEqual(gc_hist[100], 3)
+        self.assertAlmostEqual(gc_hist[0], 4.5)
+        self.assertAlmostEqual(gc_hist[50], 9)
+        self.assertAlmostEqual(gc_avg, 16.5 / 101)
+        self.assertTrue(np.allclose(gc_cov[0], [3, 3, 4.5, 4.5, 9, 9, 4.5]))
+
+    def test_get_gc_context_cache(self):
+        cov = np.array([4, 2, 3, 6, 8, 10, 5])
+        get_gc_context(50, 49, self.genome, [cov], {"chr1": 300})
+
+        # another bin layout of the same genome is not served from the cache
+        gc_cov, _, gc_hist = get_gc_context(100, 99, self.genome, [cov[:3]], {"chr1": 300})
+        self.assertAlmostEqual(gc_hist[100], 4)
+        self.assertAlmostEqual(gc_hist[0], 2)
+        self.assertAlmostEqual(gc_hist[50], 3)
+
+        # nor is another genome
+        other = os.path.join(self.dir, "other.fa")
+        with open(other, "w") as f:
+            f.write(">chr1\n" + "AT" * 150 + "\n")
+        pysam.faidx(other)
+        _, _, gc_hist = get_gc_context(50, 49, other, [cov], {"chr1": 300})
+        self.assertAlmostEqual(gc_hist[0], np.mean(cov[:6]))
+        self.assertEqual(gc_hist[100], 0)
+
+
+class CoverageFromBamTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bam = os.path.join(self.dir, "reads.bam")
+        self._write_bam(self.bam, [(100, 300, True), (1000, 100, False)])
+
+        self.regions = GenomicRegionSet("bam")
+        self.regions.add(GenomicRegion("chr1", 0, 2000))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write_bam(self, filename, pairs):
+        """Write pairs (start of leftmost mate, fragment length, leftmost mate is read1) of 36bp reads"""
+        header = {"HD": {"VN": "1.0", "SO": "coordinate"}, "SQ": [{"SN": "chr1", "LN": 2000}]}
+        reads = []
+        for i, (start, tlen, first) in enumerate(pairs):
+            for pos, reverse in [(start, False), (start + tlen - 36, True)]:
+                read = pysam.AlignedSegment()
+                read.query_name = "pair%s" % i
+                read.query_sequence = "A" * 36
+                read.reference_id = read.next_reference_id = 0
+                read.reference_start = pos
+                read.next_reference_start = start + tlen - 36 if not reverse else start
+                read.cigar = [(0, 36)]
+                read.template_length = -tlen if reverse else tlen
+                read.flag = 0x1 | 0x2 | (0x10 if reverse else 0x20) | (0x40 if first != reverse else 0x80)
+                reads.append(read)
+        reads.sort(key=lambda r: r.reference_start)
+        with pysam.AlignmentFile(filename, "wb", header=header) as f:
+            for read in reads:
+                f.write(read)
+        pysam.index(filename)
+
+    def test_coverage_from_bam(self):
+        cov = CoverageSet("reads", self.regions)
+        cov.coverage_from_bam(self.bam, extension_size=0, get_strand_info=True)
+        self.assertEqual(cov.coverage[0].sum(), 14)
+        self.assertEqual(np.flatnonzero(cov.coverage[0]).tolist(), [2, 3, 4, 7, 8, 9, 10, 20, 21, 22, 23, 24])
+        self.assertEqual(cov.cov_strand_all[0].sum(axis=0).tolist(), [6, 8])
+
+    def test_coverage_from_bam_fragments(self):
+        cov = CoverageSet("fragments", self.regions)
+        cov.coverage_from_bam(self.bam, fragments=True)
+        self.assertEqual(np.flatnonzero(cov.coverage[0]).tolist(), [2, 3, 4, 5, 6, 7, 8, 20, 21, 22])
+        self.assertEqual(cov.coverage[0].max(), 1)
+
+        cov = CoverageSet("fragments", self.regions)
+        cov.coverage_from_bam(self.bam, fragments=True, min_fragment_size=200)
+        self.assertEqual(np.flatnonzero(cov.coverage[0]).tolist(), [2, 3, 4, 5, 6, 7, 8])
+
+    def test_coverage_from_bam_duplicates(self):
+        bam = os.path.join(self.dir, "duplicates.bam")
+        self._write_bam(bam, [(100, 300, True), (100, 300, True), (100, 300, False), (100, 200, True)])
+
+        cov = CoverageSet("reads", self.regions)
+        cov.coverage_from_bam(bam, extension_size=0)
+        self.assertEqual(cov.coverage[0][2], 4)
+        # the duplicated pair is counted once, same start and strand with another mate position is no duplicate
+        self.assertEqual(cov.unique_reads[bam], 4)
+
+        cov = CoverageSet("reads", self.regions)
+        cov.coverage_from_bam(bam, extension_size=0, rmdup=True)
+        self.assertEqual(cov.coverage[0][2], 2)
+        cov.coverage_from_bam(bam, extension_size=0, maxdup=2)
+        self.assertEqual(cov.coverage[0][2], 3)
+
+    def test_count_unique_reads(self):
+        mask = os.path.join(self.dir, "mask.bed")
+        with open(mask, "w") as f:
+            f.write("chr1\t0\t500\n")
+
+        cov = CoverageSet("reads", self.regions)
+        # both mates of a pair have the same name
+        self.assertEqual(cov.count_unique_reads(self.bam), 2)
+        cov.coverage_from_bam(self.bam, mask_file=mask)
+        self.assertEqual(cov.unique_reads[(self.bam, ("mask_file", mask))], 2)
+        # the count of filtered reads without duplicates does not change the number of unique reads
+        self.assertEqual(cov.count_unique_reads(self.bam), 2)
+
+        regions = GenomicRegionSet("bam")
+        regions.add(GenomicRegion("chr1", 120, 300))
+        # reads overlapping the region are counted, even if they start before it
+        self.assertEqual(CoverageSet("reads", regions).count_unique_reads(self.bam), 1)
+
+    def test_get_library_size(self):
+        sizes = get_library_size(self.bam)
+        self.assertEqual(sizes["mapped"], 4)
+        self.assertEqual(sizes["unmapped"], 0)
+        self.assertEqual(sizes["chroms"], {"chr1": 4})
+        self.assertIsNone(sizes["unique"])
+        self.assertTrue(os.path.exists(self.bam + ".libsize"))
+
+        self.assertEqual(get_library_size(self.bam, unique=True)["unique"], 4)
+        cov = CoverageSet("reads", self.regions)
+        cov._init_read_number(self.bam)
+        self.assertEqual((cov.reads, cov.mapped_reads), (4, 4))
+
+    def test_coverage_from_genomicset_bam(self):
+        regions = GenomicRegionSet("regions")
+        regions.add(GenomicRegion("chr1", 90, 110, orientation="+"))
+        regions.add(GenomicRegion("chr1", 300, 400, orientation="-"))
+        regions.add(GenomicRegion("chr1", 500, 950, orientation="+"))
+        regions.add(GenomicRegion("chr1", 1050, 1070, orientation="-"))
+        cov = CoverageSet("regions", regions)
+        cov.coverage_from_genomicset(self.bam, readSize=0)
+        self.assertEqual(cov.coverage, [1, 1, 0, 1])
+        cov.coverage_from_genomicset(self.bam, readSize=0, strand_specific=True)
+        self.assertEqual(cov.coverage, [1, 1, 0, 1])
+        cov.coverage_from_genomicset(self.bam, readSize=100, strand_specific=True)
+        self.assertEqual(cov.coverage, [1, 1, 1, 1])
+
+    def test_index2coordinates(self):
+        regions = GenomicRegionSet("regions")
+        regions.add(GenomicRegion("chr1", 0, 1000))
+        regions.add(GenomicRegion("chr1", 1500, 2000))
+        cov = CoverageSet("reads", regions)
+        cov.coverage_from_bam(self.bam)
+        self.assertEqual(cov.index2coordinates(3, regions), ("chr1", 150, 200))
+        self.assertEqual(cov.index2coordinates(21, regions), ("chr1", 1550, 1600))
+
+        chroms, starts, ends = cov.indices2coordinates([3, 20, 29], regions)
+        self.assertEqual(chroms.tolist(), ["chr1"] * 3)
+        self.assertEqual(starts.tolist(), [150, 1500, 1950])
+        self.assertEqual(ends.tolist(), [200, 1550, 2000])
+
+        self.assertEqual(cov.coordinates2indices("chr1", 120, 260, regions).tolist(), [2, 3, 4, 5])
+        self.assertEqual(cov.coordinates2indices("chr1", 950, 1620, regions).tolist(), [19, 20, 21, 22])
+        self.assertEqual(cov.coordinates2indices("chr1", 1000, 1500, regions).tolist(), [])
+        self.assertEqual(cov.coordinates2indices("chr2", 0, 100, regions).tolist(), [])
+        for i in [0, 19, 20, 29]:
+            chrom, start, end = cov.index2coordinates(i, regions)
+            self.assertEqual(cov.coordinates2indices(chrom, start, end, regions).tolist(), [i])
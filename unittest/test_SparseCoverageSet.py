@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pyBigWig
+import pysam
+
+from rgt.CoverageSet import CoverageSet
+from rgt.SparseCoverageSet import RunLengthArray, SparseCoverageSet
+from rgt.GenomicRegionSet import *
+
+
+class RunLengthArrayTest(unittest.TestCase):
+    def setUp(self):
+        self.a = np.array([0, 0, 3, 3, 3, 0, 1, 1, 0, 0])
+        self.b = np.array([1, 1, 1, 0, 0, 0, 0, 2, 2, 0])
+
+    def test_from_dense(self):
+        r = RunLengthArray.from_dense(self.a)
+        self.assertEqual(r.ends.tolist(), [2, 5, 6, 8, 10])
+        self.assertEqual(r.values.tolist(), [0, 3, 0, 1, 0])
+        self.assertEqual(len(r), 10)
+        self.assertEqual(r.to_dense().tolist(), self.a.tolist())
+
+    def test_arithmetic(self):
+        ra, rb = RunLengthArray.from_dense(self.a), RunLengthArray.from_dense(self.b)
+        self.assertEqual((ra + rb).to_dense().tolist(), (self.a + self.b).tolist())
+        self.assertEqual((ra - rb).clip(0).to_dense().tolist(), np.clip(self.a - self.b, 0, None).tolist())
+        self.assertEqual((ra + self.b).to_dense().tolist(), (self.a + self.b).tolist())
+        self.assertEqual((ra * 2).to_dense().tolist(), (self.a * 2).tolist())
+        self.assertEqual(ra.sum(), self.a.sum())
+
+    def test_concatenate(self):
+        r = RunLengthArray.concatenate([RunLengthArray.from_dense(self.a), RunLengthArray.from_dense(self.b)])
+        self.assertEqual(r.to_dense().tolist(), np.concatenate((self.a, self.b)).tolist())
+        self.assertEqual(r.ends.tolist(), [2, 5, 6, 8, 10, 13, 17, 19, 20])
+
+
+class SparseCoverageSetTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.chrom_file = os.path.join(self.dir, "chrom.sizes")
+        with open(self.chrom_file, "w") as f:
+            f.write("chr1\t1000\nchr2\t500\n")
+
+        regions = GenomicRegionSet("sparse")
+        regions.add(GenomicRegion("chr1", 0, 1000))
+        regions.add(GenomicRegion("chr2", 0, 500))
+        self.cov = SparseCoverageSet("sparse", regions)
+        self.cov.binsize, self.cov.stepsize = 100, 50
+        self.dense = [np.zeros(20, dtype=int), np.zeros(10, dtype=int)]
+        self.dense[0][3:6] = 4
+        self.dense[1][7] = 2
+        self.cov.coverage = [RunLengthArray.from_dense(c) for c in self.dense]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_add_subtract(self):
+        self.cov.add(self.cov.to_dense())
+        self.assertEqual(self.cov.coverage[0].to_dense().tolist(), (2 * self.dense[0]).tolist())
+        self.cov.subtract(self.cov.to_dense())
+        self.assertEqual(self.cov.coverage[1].to_dense().tolist(), [0] * 10)
+
+    def test_write_bigwig(self):
+        filename = os.path.join(self.dir, "sparse.bw")
+        self.cov.write_bigwig(filename, self.chrom_file)
+        dense = self.cov.to_dense()
+        dense_filename = os.path.join(self.dir, "dense.bw")
+        dense.write_bigwig(dense_filename, self.chrom_file)
+
+        sparse_bw, dense_bw = pyBigWig.open(filename), pyBigWig.open(dense_filename)
+        for chrom, length in [("chr1", 1000), ("chr2", 500)]:
+            self.assertEqual(np.nan_to_num(sparse_bw.values(chrom, 0, length, numpy=True)).tolist(),
+                             np.nan_to_num(dense_bw.values(chrom, 0, length, numpy=True)).tolist())
+        sparse_bw.close()
+        dense_bw.close()
+
+
+class SparseCoverageFromBamTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bam = os.path.join(self.dir, "reads.bam")
+        header = {"HD": {"VN": "1.0", "SO": "coordinate"}, "SQ": [{"SN": "chr1", "LN": 1000000}]}
+        rs = np.random.RandomState(0)
+        reads = []
+        # two clusters of properly paired 36bp reads in an otherwise empty chromosome
+        for i, start in enumerate(np.sort(np.concatenate((rs.randint(10000, 12000, 150),
+                                                            rs.randint(500000, 501000, 100))))):
+            tlen = int(rs.randint(150, 300))
+            for pos, reverse in [(int(start), False), (int(start) + tlen - 36, True)]:
+                read = pysam.AlignedSegment()
+                read.query_name = "pair%s" % i
+                read.query_sequence = "A" * 36
+                read.reference_id = read.next_reference_id = 0
+                read.reference_start = pos
+                read.next_reference_start = int(start) + tlen - 36 if not reverse else int(start)
+                read.cigar = [(0, 36)]
+                read.template_length = -tlen if reverse else tlen
+                read.flag = 0x1 | 0x2 | (0x10 if reverse else 0x20) | (0x80 if reverse else 0x40)
+                reads.append(read)
+        reads.sort(key=lambda r: r.reference_start)
+        with pysam.AlignmentFile(self.bam, "wb", header=header) as f:
+            for read in reads:
+                f.write(read)
+        pysam.index(self.bam)
+
+        self.regions = GenomicRegionSet("bam")
+        self.regions.add(GenomicRegion("chr1", 0, 600000))
+        self.regions.add(GenomicRegion("chr1", 600000, 1000000))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_coverage_from_bam(self):
+        for kwargs in [{}, {"extension_size": 0, "binsize": 200, "stepsize": 50}, {"fragments": True},
+                       {"rmdup": True, "stepsize": 100}]:
+            dense = CoverageSet("dense", self.regions)
+            dense.coverage_from_bam(self.bam, **kwargs)
+            sparse = SparseCoverageSet("sparse", self.regions)
+            sparse.coverage_from_bam(self.bam, **kwargs)
+            for d, s in zip(dense.coverage, sparse.coverage):
+                self.assertTrue(isinstance(s, RunLengthArray))
+                self.assertEqual(s.to_dense().tolist(), d.tolist())
+            self.assertEqual(sparse.overall_cov.to_dense().tolist(), dense.overall_cov.tolist())
+
+    def test_nbytes(self):
+        dense = CoverageSet("dense", self.regions)
+        dense.coverage_from_bam(self.bam)
+        sparse = SparseCoverageSet("sparse", self.regions)
+        sparse.coverage_from_bam(self.bam)
+        self.assertTrue(sparse.coverage[0].max() > 0)
+        self.assertLess(sparse.nbytes() * 20, sum(c.nbytes for c in dense.coverage))
@@ -0,0 +1,60 @@
+import unittest
+
+import numpy as np
+
+from rgt.THOR.MultiCoverageSet import MultiCoverageSet, _top_indices
+
+
+class DummyTracker():
+    def __init__(self):
+        self.written = []
+
+    def write(self, text, header=None):
+        self.written.append((header, text))
+
+
+def top_indices_sort(values, k):
+    """Indices of the k largest values by a stable sort, ties are resolved by the smaller index"""
+    order = np.argsort(-np.asarray(values), kind='mergesort')
+    return np.sort(order[:k])
+
+
+class TopIndicesTest(unittest.TestCase):
+    def test_top_indices(self):
+        rs = np.random.RandomState(6)
+        for values in [rs.random_sample(100), rs.randint(0, 5, 100).astype(float), np.ones(10)]:
+            for k in [0, 1, 7, 50, 99, 100, 150]:
+                self.assertEqual(_top_indices(values, k).tolist(), top_indices_sort(values, k).tolist())
+
+    def test_ties(self):
+        values = np.array([1., 3., 2., 3., 3., 0.])
+        self.assertEqual(_top_indices(values, 2).tolist(), [1, 3])
+        self.assertEqual(_top_indices(values, 4).tolist(), [1, 2, 3, 4])
+
+
+class TMMTest(unittest.TestCase):
+    def setUp(self):
+        self.mcs = MultiCoverageSet.__new__(MultiCoverageSet)
+        self.mcs.dim_1, self.mcs.dim_2 = 2, 1
+
+    def test_write_TMM_stats(self):
+        tracker = DummyTracker()
+        self.mcs._write_TMM_stats(tracker, [(100, 60, 0.12345, 2.5), (80, 50, -0.5, 3.), (90, 0, np.nan, np.nan)])
+        self.assertEqual(tracker.written, [("TMM normalization (M/A statistics)",
+                                            "s1-rep0: 100 bins, 60 bins after trimming, mean M 0.123, mean A 2.5\n"
+                                            "s1-rep1: 80 bins, 50 bins after trimming, mean M -0.5, mean A 3.0\n"
+                                            "s2-rep0: 90 bins, 0 bins after trimming, mean M nan, mean A nan")])
+
+    def test_norm_TMM_sample_size(self):
+        rs = np.random.RandomState(7)
+        base = rs.poisson(20, 5000)
+        overall_coverage = [np.array([rs.binomial(base, 0.5), rs.binomial(base, 0.5)]),
+                            np.array([rs.binomial(base, 0.25)])]
+        factors, stats = self.mcs._norm_TMM(overall_coverage, 80, 95)
+        positive = [np.sum(c > 0) for c in list(overall_coverage[0]) + list(overall_coverage[1])]
+        self.assertEqual([n for n, _, _, _ in stats], positive)
+        self.assertEqual(self.mcs._norm_TMM(overall_coverage, 80, 95, sample_size=10000), (factors, stats))
+
+        sampled, stats = self.mcs._norm_TMM(overall_coverage, 80, 95, top=10000, sample_size=2000)
+        self.assertTrue(all(n <= 2000 for n, _, _, _ in stats))
+        self.assertTrue(sampled[2] > sampled[0])
@@ -0,0 +1,111 @@
+import unittest
+
+import numpy as np
+from hmmlearn.hmm import _BaseHMM
+from scipy.special import logsumexp
+from scipy.stats import binom
+
+from rgt.THOR.binom_hmm import BinomialHMM
+from rgt.THOR.help_hmm import _valid_posteriors
+
+
+def log_likelihood_per_observation(X, n, p, dim):
+    """Sum of the replicates' binomial log-pmfs, observation by observation"""
+    res = np.zeros((len(X), 3))
+    for t, x in enumerate(X):
+        for i in range(3):
+            for k in range(dim[0] + dim[1]):
+                j = 0 if k < dim[0] else 1
+                res[t, i] += binom.logpmf(x[k], n[j], p[j][i])
+    return res
+
+
+def accumulate_per_observation(obs, posteriors, dim):
+    """Posterior sums and posterior weighted counts per condition, added up observation by observation"""
+    post, post_emission = np.zeros(3), np.zeros((2, 3))
+    for t, symbol in enumerate(obs):
+        for j, it in enumerate([range(dim[0]), range(dim[0], dim[0] + dim[1])]):
+            for i in it:
+                post += posteriors[t]
+                post_emission[j] += posteriors[t] * symbol[i]
+    return post, post_emission
+
+
+class BinomialHMMTest(unittest.TestCase):
+    def setUp(self):
+        self.n = np.array([60, 60])
+        self.p = np.array([[0.05, 0.4, 0.1], [0.05, 0.1, 0.4]])
+        self.dim = [2, 3]
+
+    def _get_hmm(self, n_iter=1):
+        hmm = BinomialHMM(n=self.n.copy(), p=self.p.copy(), dim_cond_1=2, dim_cond_2=3, n_components=3,
+                          startprob_prior=1.0, transmat_prior=1.0, n_iter=n_iter, init_params='')
+        hmm.startprob_ = np.array([0.8, 0.1, 0.1])
+        hmm.transmat_ = np.array([[0.9, 0.05, 0.05], [0.2, 0.7, 0.1], [0.2, 0.1, 0.7]])
+        return hmm
+
+    def _get_sequences(self):
+        rs = np.random.RandomState(8)
+        seqs = []
+        for n in [30, 45, 25]:
+            states = rs.choice(3, size=n, p=[0.6, 0.2, 0.2])
+            seqs.append(np.array([[rs.binomial(60, self.p[int(k >= 2), s]) for k in range(5)] for s in states]))
+        return seqs
+
+    def test_compute_log_likelihood(self):
+        X = np.concatenate(self._get_sequences())
+        X[3, 1] = 61 #more successes than trials
+        hmm = self._get_hmm()
+        expected = log_likelihood_per_observation(X, self.n, self.p, self.dim)
+        res = hmm._compute_log_likelihood(X)
+        self.assertTrue(np.isneginf(res[3]).all())
+        np.testing.assert_allclose(res, expected)
+
+    def test_help_accumulate_sufficient_statistics(self):
+        hmm = self._get_hmm()
+        obs = self._get_sequences()[0]
+        posteriors = np.random.RandomState(9).dirichlet(np.ones(3), size=len(obs))
+        stats = hmm._initialize_sufficient_statistics()
+        hmm._help_accumulate_sufficient_statistics(obs, stats, posteriors)
+
+        post, post_emission = accumulate_per_observation(obs, posteriors, self.dim)
+        np.testing.assert_allclose(stats['post'], post)
+        np.testing.assert_allclose(stats['post_emission'], post_emission)
+
+    def test_fit_lengths(self):
+        seqs = self._get_sequences()
+
+        #reference: E-step sequence by sequence with the emission loops
+        ref = self._get_hmm()
+        stats = ref._initialize_sufficient_statistics()
+        post, post_emission = np.zeros(3), np.zeros((2, 3))
+        for seq in seqs:
+            framelogprob = log_likelihood_per_observation(seq, self.n, self.p, self.dim)
+            _, fwdlattice = ref._do_forward_pass(framelogprob)
+            bwdlattice = ref._do_backward_pass(framelogprob)
+            gamma = fwdlattice + bwdlattice
+            posteriors = np.exp(gamma.T - logsumexp(gamma, axis=1)).T
+            _BaseHMM._accumulate_sufficient_statistics(ref, stats, seq, framelogprob, posteriors, fwdlattice,
+                                                       bwdlattice)
+            p, pe = accumulate_per_observation(seq, _valid_posteriors(posteriors, seq, self.dim), self.dim)
+            post += p
+            post_emission += pe
+
+        hmm = self._get_hmm()
+        batch_stats = []
+        hmm._do_mstep = lambda s: batch_stats.append(s)
+        hmm.fit(np.concatenate(seqs), lengths=[len(seq) for seq in seqs])
+        np.testing.assert_allclose(batch_stats[0]['post'], post)
+        np.testing.assert_allclose(batch_stats[0]['post_emission'], post_emission)
+        np.testing.assert_allclose(batch_stats[0]['start'], stats['start'])
+        np.testing.assert_allclose(batch_stats[0]['trans'], stats['trans'])
+
+    def test_fit(self):
+        seqs = self._get_sequences()
+        m1 = self._get_hmm(n_iter=3).fit(seqs)
+        m2 = self._get_hmm(n_iter=3).fit(np.concatenate(seqs), lengths=[len(seq) for seq in seqs])
+        np.testing.assert_allclose(m1.p, m2.p)
+        np.testing.assert_allclose(m1.transmat_, m2.transmat_)
+        self.assertTrue(((m1.p > 0) & (m1.p < 1)).all())
+        self.assertEqual(m1.p[0, 1], m1.p[1, 2])
+        self.assertEqual(m1.p[1, 1], m1.p[0, 2])
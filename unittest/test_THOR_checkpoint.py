@@ -0,0 +1,113 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from optparse import Values
+
+import numpy as np
+
+from rgt.GenomicRegionSet import GenomicRegionSet
+from rgt.GenomicRegion import GenomicRegion
+from rgt.THOR.checkpoint import Checkpoint, FINGERPRINT_OPTIONS, get_fingerprint
+from rgt.THOR.neg_bin_rep_hmm import NegBinRepHMM
+from rgt.THOR.postprocessing import peak_dtype
+
+
+def get_region(chrom, start, end):
+    region = GenomicRegionSet(chrom)
+    region.add(GenomicRegion(chrom, start, end))
+    return region
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'exp-checkpoint.json')
+        options = dict((k, None) for k in FINGERPRINT_OPTIONS)
+        options.update(binsize=100, stepsize=50, exts=[], exts_inputs=[], pcutoff=0.1, merge=False, merge_bin=True,
+                       deadzones='deadzones.bed')
+        self.options = Values(options)
+        self.fingerprint = get_fingerprint(self.options, ['a.bam', 'b.bam'], 'genome.fa', (1, 1), ['i.bam'] * 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_fingerprint(self):
+        self.assertEqual(self.fingerprint['bamfiles'], [os.path.abspath('a.bam'), os.path.abspath('b.bam')])
+        self.assertEqual(self.fingerprint['deadzones'], os.path.abspath('deadzones.bed'))
+        self.assertEqual(self.fingerprint['dims'], [1, 1])
+        self.assertEqual(self.fingerprint['binsize'], 100)
+        self.assertIsNone(self.fingerprint['norm_regions'])
+
+    def _get_hmm(self):
+        mu = np.matrix([[5., 40., 3.], [5., 3., 40.]])
+        alpha = np.matrix([[0.2, 0.5, 0.1], [0.2, 0.1, 0.5]])
+        m = NegBinRepHMM(alpha=alpha, mu=mu, dim_cond_1=1, dim_cond_2=1)
+        m.startprob_ = np.array([0.8, 0.1, 0.1])
+        m.transmat_ = np.array([[0.9, 0.05, 0.05], [0.2, 0.7, 0.1], [0.2, 0.1, 0.7]])
+        return m
+
+    def test_round_trip(self):
+        checkpoint = Checkpoint(self.filename, self.fingerprint)
+        m = self._get_hmm()
+        checkpoint.set_model(m, [np.array([0.1, 1.]), np.array([0.2, 2.])])
+        peaks = np.zeros(2, dtype=peak_dtype(1, 1))
+        peaks['chrom'], peaks['start'], peaks['end'], peaks['strand'] = 'chr1', [100, 500], [300, 650], ['+', '-']
+        peaks['counts1'], peaks['counts2'], peaks['pvalue'] = [[20], [1]], [[2], [15]], [4.5, 3.1]
+        checkpoint.add_region(get_region('chr1', 0, 1000), peaks)
+        checkpoint.save()
+
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dir, 'exp-checkpoint'))), ['chr1_0_1000.npy'])
+        with open(self.filename) as f:
+            self.assertEqual(json.load(f)['regions'], ['chr1_0_1000'])
+
+        checkpoint = Checkpoint.load(self.filename, self.fingerprint)
+        self.assertTrue(checkpoint.has('model'))
+        self.assertFalse(checkpoint.has('normalization'))
+        self.assertTrue(checkpoint.is_done(get_region('chr1', 0, 1000)))
+        self.assertFalse(checkpoint.is_done(get_region('chr2', 0, 1000)))
+        self.assertEqual(checkpoint.get_region(get_region('chr1', 0, 1000)).tolist(), peaks.tolist())
+        m2, func_para = checkpoint.get_model()
+        np.testing.assert_allclose(m2.mu, m.mu)
+        np.testing.assert_allclose(m2.transmat_, m.transmat_)
+        np.testing.assert_allclose(func_para[1], [0.2, 2.])
+
+    def test_regions_after_save(self):
+        checkpoint = Checkpoint(self.filename, self.fingerprint)
+        checkpoint.set_model(self._get_hmm(), [np.ones(2)])
+        checkpoint.save()
+        empty = np.zeros(0, dtype=peak_dtype(1, 1))
+        checkpoint.add_region(get_region('chr1', 0, 1000), empty)
+        checkpoint.add_region(get_region('chrUn_gl000220', 0, 500), empty)
+
+        #regions written after the last save are done as well
+        checkpoint = Checkpoint.load(self.filename, self.fingerprint)
+        self.assertTrue(checkpoint.is_done(get_region('chr1', 0, 1000)))
+        self.assertTrue(checkpoint.is_done(get_region('chrUn_gl000220', 0, 500)))
+        self.assertEqual(len(checkpoint.get_region(get_region('chr1', 0, 1000))), 0)
+
+        #a new run removes the region files
+        checkpoint = Checkpoint(self.filename, self.fingerprint)
+        self.assertFalse(checkpoint.is_done(get_region('chr1', 0, 1000)))
+        self.assertEqual(os.listdir(os.path.join(self.dir, 'exp-checkpoint')), [])
+
+    def test_mismatch(self):
+        Checkpoint(self.filename, self.fingerprint).save()
+        self.options.binsize = 200
+        self.options.pcutoff = 0.01
+        fingerprint = get_fingerprint(self.options, ['a.bam', 'b.bam'], 'genome.fa', (1, 1), ['i.bam'] * 2)
+        with self.assertRaises(ValueError) as cm:
+            Checkpoint.load(self.filename, fingerprint)
+        self.assertIn('(binsize, pcutoff)', str(cm.exception))
+
+        self.options.binsize, self.options.pcutoff = 100, 0.1
+        fingerprint = get_fingerprint(self.options, ['a.bam', 'c.bam'], 'genome.fa', (1, 1), ['i.bam'] * 2)
+        with self.assertRaises(ValueError) as cm:
+            Checkpoint.load(self.filename, fingerprint)
+        self.assertIn('(bamfiles)', str(cm.exception))
+
+    def test_missing(self):
+        checkpoint = Checkpoint.load(self.filename, self.fingerprint)
+        self.assertFalse(checkpoint.has('model'))
+        self.assertEqual(checkpoint.data['fingerprint'], self.fingerprint)
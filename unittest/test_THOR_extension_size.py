@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pysam
+
+from rgt.THOR.get_extension_size import _get_block_number, _sample_blocks, get_extension_size
+
+
+def write_bam(filename, chroms, reads):
+    """Write BAM file with unpaired 36bp reads (chrom index, pos, reverse)"""
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"}, "SQ": [{"SN": c, "LN": l} for c, l in chroms]}
+    with pysam.AlignmentFile(filename, "wb", header=header) as f:
+        for i, (chrom, pos, reverse) in enumerate(sorted(reads)):
+            read = pysam.AlignedSegment()
+            read.query_name = "read%s" % i
+            read.query_sequence = "A" * 36
+            read.reference_id = chrom
+            read.reference_start = pos
+            read.cigar = [(0, 36)]
+            read.flag = 0x10 if reverse else 0
+            f.write(read)
+    pysam.index(filename)
+
+
+def ccf_loop(filename, start=0, end=600, stepsize=5):
+    """Cross-correlation of forward and reverse read starts of the first chromosome, computed shift by shift"""
+    f = pysam.Samfile(filename, "rb")
+    cov_f, cov_r = set(), set()
+    for read in f.fetch(f.references[0]):
+        (cov_r if read.is_reverse else cov_f).add(read.pos)
+    return [(len(cov_f & set(p - k for p in cov_r)), k) for k in range(start, end, stepsize)]
+
+
+class ExtensionSizeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get_extension_size(self):
+        bam = os.path.join(self.dir, "reads.bam")
+        rs = np.random.RandomState(5)
+        reads = []
+        for start in rs.randint(0, 60000, 400):
+            length = int(rs.normal(220, 15))
+            reads += [(0, int(start), False), (0, int(start) + length - 36, True)]
+        write_bam(bam, [("chr1", 61000)], reads)
+
+        ext, values = get_extension_size(bam)
+        expected = ccf_loop(bam, start=-36)
+        self.assertEqual(values, expected)
+        self.assertEqual(ext, max(expected[36 // 5 * 2:])[1])
+        self.assertTrue(170 <= ext <= 200)
+
+    def test_sample_blocks(self):
+        bam = os.path.join(self.dir, "blocks.bam")
+        chroms = [("chr1", 100000), ("chr2", 30000), ("chr3", 2000)] + [("small%s" % i, 500) for i in range(20)]
+        reads = [(0, p, False) for p in range(0, 100000, 100)] + [(1, p, False) for p in range(0, 30000, 100)]
+        reads += [(2, 10, False)] + [(i, 10, False) for i in range(3, 23)]
+        write_bam(bam, chroms, reads)
+
+        f = pysam.Samfile(bam, "rb")
+        blocks = _sample_blocks(f, 1000, 8)
+        self.assertEqual(len(blocks), 8)
+        self.assertEqual(set(c for c, _, _ in blocks), set(["chr1", "chr2"]))
+        #blocks are centered in their strides
+        self.assertEqual([(s, e) for c, s, e in blocks if c == "chr2"], [(7000, 8000), (22000, 23000)])
+
+        #blocks cover whole chromosomes if there is room for it
+        blocks = _sample_blocks(f, 1000, 200)
+        self.assertEqual(sum(e - s for _, s, e in blocks), sum(l for _, l in chroms))
+        self.assertTrue(len(blocks) <= 200)
+
+    def test_known_shift(self):
+        bam = os.path.join(self.dir, "shift.bam")
+        chroms = [("chr%s" % i, 400000) for i in range(1, 4)]
+        rs = np.random.RandomState(7)
+        reads = []
+        for chrom in range(3):
+            for start in rs.randint(0, 399000, 300):
+                reads += [(chrom, int(start), False), (chrom, int(start) + 200 - 36, True)]
+        write_bam(bam, chroms, reads)
+
+        #reverse reads start 200 - 36 bp behind the forward reads, the shifts are -36, -31, ..., 164, ...
+        ext, _ = get_extension_size(bam)
+        self.assertEqual(ext, 164)
+
+        #the sample is limited by both keywords, but still covers the largest chromosome
+        f = pysam.Samfile(bam, "rb")
+        self.assertEqual(_get_block_number(f, 100000, None, 0), 4)
+        self.assertEqual(_get_block_number(f, 100000, 200000, 0), 2)
+        self.assertEqual(_get_block_number(f, 100000, None, 1200), 8) #1800 reads on 1.2 Mb
+        ext, _ = get_extension_size(bam, sample_size=200000, min_reads=0)
+        self.assertEqual(ext, 164)
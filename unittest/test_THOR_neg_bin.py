@@ -0,0 +1,138 @@
+import unittest
+
+import numpy as np
+from scipy.stats import nbinom
+
+from hmmlearn.hmm import _BaseHMM
+from scipy.special import logsumexp
+
+from rgt.THOR.neg_bin import NegBin
+from rgt.THOR.neg_bin_rep_hmm import NegBinRepHMM
+
+
+def nbinom_logpmf(x, mu, alpha):
+    v = 1. / alpha
+    return nbinom.logpmf(x, v, v / (v + mu))
+
+
+class NegBinTest(unittest.TestCase):
+    def setUp(self):
+        self.distr = NegBin(12.5, 0.3, max_count=50)
+        self.counts = np.array([0, 1, 7, 50, 51, 400, 3.5])
+
+    def test_logpmf(self):
+        expected = nbinom_logpmf(np.floor(self.counts[:-1]), 12.5, 0.3)
+        np.testing.assert_allclose(self.distr.logpmf(self.counts[:-1]), expected)
+        np.testing.assert_allclose(self.distr.pmf(self.counts[:-1]), np.exp(expected))
+        np.testing.assert_allclose(self.distr.cdf(self.counts), nbinom.cdf(self.counts, 1 / 0.3, (1 / 0.3) / (1 / 0.3 + 12.5)))
+
+    def test_pdf(self):
+        self.assertIsInstance(self.distr.pdf(7), float)
+        self.assertAlmostEqual(self.distr.logpdf(7), nbinom_logpmf(7, 12.5, 0.3))
+        self.assertAlmostEqual(self.distr.pdf(400), np.exp(nbinom_logpmf(400, 12.5, 0.3)))
+        np.testing.assert_allclose(self.distr.logpdf(self.counts[:-1]), nbinom_logpmf(self.counts[:-1], 12.5, 0.3))
+        np.testing.assert_allclose(self.distr.pdf([[1, 2], [3, 4]]), np.exp(nbinom_logpmf([[1, 2], [3, 4]], 12.5, 0.3)))
+
+    def test_degenerate(self):
+        distr = NegBin(0, 0.3, max_count=50)
+        self.assertEqual(distr.pdf(0), 1)
+        self.assertEqual(distr.logpdf(0), 0)
+        self.assertEqual(distr.pmf(self.counts).tolist(), [1, 0, 0, 0, 0, 0, 0])
+        self.assertTrue(np.isneginf(distr.logpmf(self.counts[1:])).all())
+        self.assertEqual(distr.cdf(self.counts).tolist(), [1] * len(self.counts))
+        self.assertEqual(distr.rvs(), 0)
+
+
+def accumulate_per_observation(obs, posteriors, dim):
+    """Posterior sums and posterior weighted counts per condition, added up observation by observation"""
+    post, post_emission = np.zeros((2, 3)), np.zeros((2, 3))
+    for t, symbol in enumerate(obs):
+        post[0] += posteriors[t]
+        post[1] += posteriors[t]
+        for j, it in enumerate([range(dim[0]), range(dim[0], dim[0] + dim[1])]):
+            for i in it:
+                post_emission[j] += posteriors[t] * symbol[i]
+    post[0] *= dim[0]
+    post[1] *= dim[1]
+    return post, post_emission
+
+
+class NegBinRepHMMTest(unittest.TestCase):
+    def setUp(self):
+        self.mu = np.matrix([[5., 40., 3.], [5., 3., 40.]])
+        self.alpha = np.matrix([[0.2, 0.5, 0.1], [0.2, 0.1, 0.5]])
+
+    def _get_hmm(self):
+        hmm = NegBinRepHMM(alpha=self.alpha.copy(), mu=self.mu.copy(), dim_cond_1=2, dim_cond_2=3, n_iter=1,
+                           init_params='')
+        hmm.startprob_ = np.array([0.8, 0.1, 0.1])
+        hmm.transmat_ = np.array([[0.9, 0.05, 0.05], [0.2, 0.7, 0.1], [0.2, 0.1, 0.7]])
+        return hmm
+
+    def _get_sequences(self):
+        rs = np.random.RandomState(2)
+        seqs = []
+        for n in [30, 45, 25]:
+            states = rs.choice(3, size=n, p=[0.6, 0.2, 0.2])
+            seq = np.array([[rs.negative_binomial(2, 2. / (2 + self.mu[int(k >= 2), s])) for k in range(5)]
+                            for s in states])
+            seqs.append(seq)
+        return seqs
+
+    def test_help_accumulate_sufficient_statistics(self):
+        hmm = self._get_hmm()
+        obs = self._get_sequences()[0]
+        posteriors = np.random.RandomState(3).dirichlet(np.ones(3), size=len(obs))
+        stats = hmm._initialize_sufficient_statistics()
+        hmm._help_accumulate_sufficient_statistics(obs, stats, posteriors)
+
+        post, post_emission = accumulate_per_observation(obs, posteriors, hmm.dim)
+        np.testing.assert_allclose(stats['post'], post)
+        np.testing.assert_allclose(stats['post_emission'], post_emission)
+        np.testing.assert_allclose(stats['posterior'], posteriors)
+
+    def test_fit_lengths(self):
+        seqs = self._get_sequences()
+
+        #reference: E-step sequence by sequence, emission statistics observation by observation
+        ref = self._get_hmm()
+        stats = ref._initialize_sufficient_statistics()
+        post, post_emission = np.zeros((2, 3)), np.zeros((2, 3))
+        for seq in seqs:
+            framelogprob = ref._compute_log_likelihood(seq)
+            _, fwdlattice = ref._do_forward_pass(framelogprob)
+            bwdlattice = ref._do_backward_pass(framelogprob)
+            gamma = fwdlattice + bwdlattice
+            posteriors = np.exp(gamma.T - logsumexp(gamma, axis=1)).T
+            _BaseHMM._accumulate_sufficient_statistics(ref, stats, seq, framelogprob, posteriors, fwdlattice,
+                                                       bwdlattice)
+            p, pe = accumulate_per_observation(seq, ref._valid_posteriors(posteriors, seq), ref.dim)
+            post += p
+            post_emission += pe
+
+        for obs, lengths in [(seqs, None), (np.concatenate(seqs), [len(seq) for seq in seqs])]:
+            hmm = self._get_hmm()
+            batch_stats = []
+            hmm._do_mstep = lambda s, three_para: batch_stats.append(s)
+            hmm.fit(obs, True, lengths=lengths)
+
+            self.assertEqual(len(batch_stats), 1)
+            np.testing.assert_allclose(batch_stats[0]['post'], post)
+            np.testing.assert_allclose(batch_stats[0]['post_emission'], post_emission)
+            np.testing.assert_allclose(batch_stats[0]['start'], stats['start'])
+            np.testing.assert_allclose(batch_stats[0]['trans'], stats['trans'])
+
+    def test_compute_log_likelihood(self):
+        mu, alpha = self.mu, self.alpha
+        hmm = NegBinRepHMM(alpha=alpha, mu=mu, dim_cond_1=2, dim_cond_2=3)
+        X = np.random.RandomState(1).randint(0, 1500, size=(40, 5))
+
+        #per-observation sum of the replicates' log-pmfs, as computed before the vectorization
+        expected = np.zeros((len(X), 3))
+        for t, x in enumerate(X):
+            for i in range(3):
+                for k in range(5):
+                    j = 0 if k < 2 else 1
+                    expected[t, i] += nbinom_logpmf(x[k], mu[j, i], alpha[j, i])
+
+        np.testing.assert_allclose(hmm._compute_log_likelihood(X), expected)
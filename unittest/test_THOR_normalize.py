@@ -0,0 +1,50 @@
+import unittest
+
+import numpy as np
+
+from rgt.CoverageSet import CoverageSet
+from rgt.GenomicRegion import GenomicRegion
+from rgt.GenomicRegionSet import GenomicRegionSet
+from rgt.THOR.normalize import get_bin_counts, get_binstats, get_normalization_factor
+
+
+def get_coverage_set(name, coverage, stepsize):
+    regions = GenomicRegionSet(name)
+    for i, c in enumerate(coverage):
+        regions.add(GenomicRegion("chr%s" % (i + 1), 0, len(c) * stepsize))
+    cov = CoverageSet(name, regions)
+    cov.stepsize = stepsize
+    cov.coverage = [np.array(c) for c in coverage]
+    return cov
+
+
+class NormalizeTest(unittest.TestCase):
+    def test_get_bin_counts(self):
+        cov = get_coverage_set("ip", [[1, 2, 3, 4, 5], [6, 7]], 500)
+        self.assertEqual(get_bin_counts(cov, 1000).tolist(), [3, 7, 5, 13])
+        self.assertEqual(get_bin_counts(cov, 100).tolist(), [1, 2, 3, 4, 5, 6, 7])
+
+    def test_normalization_factor(self):
+        #windows: IP 1 6 0 1 1 1, input 2 2 7 2 2 2
+        #windows with IP sorted by IP: p = .1 .2 .3 .4 1, q = .2 .4 .6 .8 1, max. distance at k = 3
+        ip = get_coverage_set("ip", [[1, 0, 5, 1, 0, 0], [0, 1, 1, 0, 0, 1]], 500)
+        inp = get_coverage_set("input", [[1, 1, 1, 1, 3, 4], [2, 0, 1, 1, 0, 2]], 500)
+        pq_list, max_index, max_value, factor1, factor2 = get_binstats(ip, inp, 1000, zero_counts=False)
+        np.testing.assert_allclose(pq_list, [[.1, .2], [.2, .4], [.3, .6], [.4, .8], [1, 1]])
+        self.assertEqual(max_index, 3)
+        self.assertAlmostEqual(max_value, 0.4)
+        self.assertAlmostEqual(factor1, 0.5)
+        self.assertAlmostEqual(factor2, 2)
+
+        _, factor = get_normalization_factor(ip, inp, 1000, zero_counts=0, filename=None, debug=False)
+        self.assertAlmostEqual(factor, 0.5)
+
+        #with the zero window of the IP first: p = 0 .1 .2 .3 .4 1, q = 7 9 11 13 15 17 / 17
+        pq_list, max_index, _, factor1, _ = get_binstats(ip, inp, 1000, zero_counts=True)
+        self.assertEqual(max_index, 4)
+        self.assertAlmostEqual(factor1, 0.4 / (15 / 17.))
+
+    def test_no_counts(self):
+        ip = get_coverage_set("ip", [[0, 0, 0, 0]], 500)
+        inp = get_coverage_set("input", [[1, 2, 3, 4]], 500)
+        self.assertEqual(get_normalization_factor(ip, inp, 1000, 0, None, False), (None, None))
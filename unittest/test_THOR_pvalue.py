@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from rgt.THOR.get_fast_gen_pvalue import PValueTable, get_log_pvalues
+from rgt.THOR.neg_bin import NegBin
+from rgt.THOR.neg_bin_rep_hmm import _get_pvalue_distr
+
+
+class DummyTracker():
+    def write(self, text, header=None):
+        pass
+
+
+class PValueTableTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'test-pvalue-table.npz')
+        self.table = PValueTable(NegBin(3.2, 0.4), max_count=40)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get_many(self):
+        rs = np.random.RandomState(4)
+        x, y = rs.randint(0, 60, size=200), rs.randint(0, 60, size=200)
+        side = np.where(rs.random_sample(200) < 0.5, 'l', 'r')
+        expected = [self.table.get(a, b, s) for a, b, s in zip(x, y, side)]
+        np.testing.assert_allclose(self.table.get_many(x, y, side), expected)
+        np.testing.assert_allclose(get_log_pvalues(x, y, side, {'table': self.table}), expected)
+
+    def test_table_exact(self):
+        for x, y in [(0, 0), (0, 12), (5, 40), (17, 18)]:
+            self.assertAlmostEqual(self.table.get(x, y, 'r'), self.table._exact(x, y))
+            self.assertAlmostEqual(self.table.get(y, x, 'l'), self.table._exact(x, y))
+
+    def test_save_load(self):
+        self.table.save(self.filename)
+        table = PValueTable.load(self.filename, NegBin(3.2, 0.4))
+        self.assertEqual(table.max_count, 40)
+        np.testing.assert_array_equal(table.table, self.table.table)
+        self.assertIsNone(PValueTable.load(self.filename, NegBin(3.3, 0.4)))
+        self.assertIsNone(PValueTable.load(self.filename, NegBin(3.2, 0.5)))
+        self.assertIsNone(PValueTable.load(os.path.join(self.dir, 'missing.npz'), NegBin(3.2, 0.4)))
+
+    def test_get_pvalue_distr(self):
+        mu, alpha = np.matrix([[3.2, 1, 1], [1, 1, 1]]), np.matrix([[4000., 1, 1], [1, 1, 1]])
+        distr = _get_pvalue_distr(mu, alpha, DummyTracker(), self.filename)
+        self.assertTrue(os.path.isfile(self.filename))
+        self.assertIsNotNone(PValueTable.load(self.filename, distr['distr']))
+
+        #other parameters: the stored table is not reused, but rebuilt and replaced
+        mu[0, 0] = 5.
+        distr = _get_pvalue_distr(mu, alpha, DummyTracker(), self.filename)
+        self.assertEqual(distr['distr'].mu, 5.)
+        np.testing.assert_allclose(distr['table'].table, PValueTable(NegBin(5., 0.4)).table)
+        self.assertIsNotNone(PValueTable.load(self.filename, NegBin(5., 0.4)))
@@ -0,0 +1,50 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from optparse import Values
+
+from rgt.THOR.tracker import Tracker, get_profile, get_usage
+
+
+class TrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.tracker = Tracker(os.path.join(self.dir, 'exp-setup.info'), ['a.bam', 'b.bam'], None, 'chrom.sizes',
+                               [1, 1], [], Values({'name': 'exp'}), '0.0')
+
+    def tearDown(self):
+        self.tracker.file.close()
+        shutil.rmtree(self.dir)
+
+    def test_profile_exception(self):
+        with self.assertRaises(ValueError):
+            with self.tracker.profile('output', 'chr1'):
+                raise ValueError()
+        self.assertEqual([(p['stage'], p['chrom']) for p in self.tracker.profiles], [('output', 'chr1')])
+
+    def test_cpu_time_children(self):
+        start = get_usage()
+        subprocess.check_call([sys.executable, '-c', 'import time\nt = time.time()\nwhile time.time() - t < 0.5: pass'])
+        profile = get_profile('child', start)
+        self.assertTrue(profile['cpu_time'] >= 0.3)
+
+    def test_peak_rss(self):
+        start = get_usage()
+        data = bytearray(200 * 1024 ** 2)
+        profile = get_profile('alloc', start)
+        del data
+        self.assertTrue(profile['peak_rss_increase_mb'] >= 100)
+        self.assertTrue(profile['peak_rss_mb'] >= profile['peak_rss_increase_mb'])
+
+        #the peak is not raised again
+        profile = get_profile('small', get_usage())
+        self.assertEqual(profile['peak_rss_increase_mb'], 0)
+
+        self.tracker.add_profile(profile)
+        self.tracker.write_profile(os.path.join(self.dir, 'exp-profile.json'))
+        with open(os.path.join(self.dir, 'exp-profile.json')) as f:
+            self.assertEqual(json.load(f)['stages'], [profile])